@@ -0,0 +1,382 @@
+"""Measures what the code the macros emit costs when it runs.
+
+    python bench_macros.py [--benchmarks quote,lambda,vectorize,dispatch,search] [--sizes 1,10,100] [--number 1000] [--repeat 3]
+
+quote: instantiating a quoted template of N statements with one hole, the way q does it (a tree of constructor calls,
+see ast_genast), against building it once and copying it each time (pickle, ast_dumps/ast_loads, copy.deepcopy),
+then filling the hole in. Reports the best time per instantiation, in microseconds.
+
+lambda: calling the functions f expands to, as a sort key and a reduction over N items, against the handwritten lambda
+and the one taking its arguments as a tuple (what f expands to when its body uses _macro_args). Reports the best time
+per call, in nanoseconds.
+
+vectorize: running a loop mapping and reducing arrays of N items as it is written, and as vectorize rewrites it, over
+lists and over NumPy arrays (the rewritten loop falls back to the original over lists). Reports the best time per item,
+in nanoseconds. Needs NumPy.
+
+dispatch: expanding a module of 1000 sites of N inline macros, the visitor finding the macros a node may fit with its
+MatcherTree, against trying every macro in turn. Reports the best time per site, in microseconds (try
+--sizes 1,10,100,1000).
+
+search: looking for N queries (calls of given functions, names, attributes, with statements) in a module of 1000
+functions, with a TreeIndex built once, its building included, against walking the tree for each query. Reports the
+best time per query, in microseconds.
+"""
+import config
+import pyns.macros
+from pyns.core import MacroVisitor, ast_genast, ast_dumps, ast_loads, macro_inline
+from pyns.macros import _Embedded, _q_specific
+from pyns.matching import m_any, m_dict, m_inst
+from pyns.search import TreeIndex
+import argparse
+import ast
+import copy
+import functools
+import pickle
+import sys
+import time
+
+
+# ######## ######## ##     ## ########  ##          ###    ######## ########  ######
+#    ##    ##       ###   ### ##     ## ##         ## ##      ##    ##       ##    ##
+#    ##    ##       #### #### ##     ## ##        ##   ##     ##    ##       ##
+#    ##    ######   ## ### ## ########  ##       ##     ##    ##    ######    ######
+#    ##    ##       ##     ## ##        ##       #########    ##    ##             ##
+#    ##    ##       ##     ## ##        ##       ##     ##    ##    ##       ##    ##
+#    ##    ######## ##     ## ##        ######## ##     ##    ##    ########  ######
+
+def template(statements):
+    """A function of statements assignments, returning the hole, as a quote gets it: without locations"""
+    src = 'def f(a, b):\n%s    return None\n' % ''.join(
+        '    x%d = a.y%d + g(b, "k%d")[%d]\n' % (i, i, i, i) for i in range(statements))
+    tree = ast.parse(src).body[0]
+    for node in ast.walk(tree):
+        for name in node._attributes:
+            if hasattr(node, name):
+                delattr(node, name)
+    return tree
+
+
+def fill(tree, hole):
+    tree.body[-1].value = hole
+    return tree
+
+
+def by_calls(tree, hole):
+    tree = copy.deepcopy(tree)
+    tree.body[-1].value = _Embedded(ast.Name('hole', ast.Load()))
+    code = compile(ast.fix_missing_locations(ast.Expression(ast_genast(tree, _q_specific))), 'quote', 'eval')
+    env = dict(vars(ast), hole=hole)
+    return lambda: eval(code, env)
+
+
+def by_pickle(tree, hole):
+    data = pickle.dumps(tree, pickle.HIGHEST_PROTOCOL)
+    return lambda: fill(pickle.loads(data), hole)
+
+
+def by_ast_loads(tree, hole):
+    data = ast_dumps(tree)
+    return lambda: fill(ast_loads(data), hole)
+
+
+def by_deepcopy(tree, hole):
+    return lambda: fill(copy.deepcopy(tree), hole)
+
+
+strategies = {
+    'calls': by_calls,
+    'pickle': by_pickle,
+    'ast_loads': by_ast_loads,
+    'deepcopy': by_deepcopy,
+}
+
+
+# ##          ###    ##     ## ########  ########     ###     ######
+# ##         ## ##   ###   ### ##     ## ##     ##   ## ##   ##    ##
+# ##        ##   ##  #### #### ##     ## ##     ##  ##   ##  ##
+# ##       ##     ## ## ### ## ########  ##     ## ##     ##  ######
+# ##       ######### ##     ## ##     ## ##     ## #########       ##
+# ##       ##     ## ##     ## ##     ## ##     ## ##     ## ##    ##
+# ######## ##     ## ##     ## ########  ########  ##     ##  ######
+
+class Item:
+    def __init__(self, x):
+        self.x = x
+
+
+def expand(src):
+    """Runs src with its f macros expanded, and returns its namespace"""
+    env = {}
+    tree = MacroVisitor(vars(pyns.macros)).expand(ast.parse(src))
+    exec(compile(tree, 'lambdas', 'exec'), env)
+    return env
+
+
+def lambdas():
+    """Maps each case to its implementations"""
+    by_f = expand('key = f[_0.x]\nadd = f[_0 + _1]')
+    return {
+        'key': {
+            'handwritten': lambda o: o.x,
+            'f': by_f['key'],
+            'tuple': lambda *_macro_args: _macro_args[0].x,
+        },
+        'reduce': {
+            'handwritten': lambda a, b: a + b,
+            'f': by_f['add'],
+            'tuple': lambda *_macro_args: _macro_args[0] + _macro_args[1],
+        },
+    }
+
+
+def use(case, function, items):
+    if case == 'key':
+        return lambda: sorted(items, key=function)
+    return lambda: functools.reduce(function, items)
+
+
+# ##     ## ########  ######  ########  #######  ########  #### ######## ########
+# ##     ## ##       ##    ##    ##    ##     ## ##     ##  ##       ##  ##
+# ##     ## ##       ##          ##    ##     ## ##     ##  ##      ##   ##
+# ##     ## ######   ##          ##    ##     ## ########   ##     ##    ######
+#  ##   ##  ##       ##          ##    ##     ## ##   ##    ##    ##     ##
+#   ## ##   ##       ##    ##    ##    ##     ## ##    ##   ##   ##      ##
+#    ###    ########  ######     ##     #######  ##     ## #### ######## ########
+
+loop = '''
+def %s(a, b, out, c):
+    total = 0.
+    %s
+        for i in range(len(a)):
+            out[i] = a[i] * b[i] + c if a[i] > 0 else b[i]
+            total += a[i] * b[i]
+    return total
+'''
+
+
+def loops():
+    """The loop as written, and as vectorize rewrites it"""
+    env = expand(loop % ('written', 'if True:') + loop % ('vectorized', 'with vectorize:'))
+    return {'written': env['written'], 'vectorized': env['vectorized']}
+
+
+# ########  ####  ######  ########     ###    ########  ######  ##     ##
+# ##     ##  ##  ##    ## ##     ##   ## ##      ##    ##    ## ##     ##
+# ##     ##  ##  ##       ##     ##  ##   ##     ##    ##       ##     ##
+# ##     ##  ##   ######  ########  ##     ##    ##    ##       #########
+# ##     ##  ##        ## ##        #########    ##    ##       ##     ##
+# ##     ##  ##  ##    ## ##        ##     ##    ##    ##    ## ##     ##
+# ########  ####  ######  ##        ##     ##    ##     ######  ##     ##
+
+@macro_inline
+def identity(node, **kwargs):
+    return node
+
+
+class Linear:
+    """Tries every matcher in turn, as the visitor did before indexing them"""
+
+    def __init__(self, tree):
+        self.all = tree.entries()
+
+    def candidates(self, node):
+        return self.all
+
+
+def visitors(size):
+    """Visitors of size macros, with and without their MatcherTrees"""
+    macros = {'m%d' % i: identity for i in range(size)}
+    indexed = MacroVisitor(macros)
+    linear = MacroVisitor(macros)
+    linear.macros = {cls: Linear(tree) for cls, tree in linear.macros.items()}
+    return {'tree': indexed, 'linear': linear}
+
+
+def sites(size, count=1000):
+    return ast.parse(''.join('x%d = m%d[%d]\n' % (i, i % size, i) for i in range(count)))
+
+
+#  ######  ########    ###    ########   ######  ##     ##
+# ##    ## ##         ## ##   ##     ## ##    ## ##     ##
+# ##       ##        ##   ##  ##     ## ##       ##     ##
+#  ######  ######   ##     ## ########  ##       #########
+#       ## ##       ######### ##   ##   ##       ##     ##
+# ##    ## ##       ##     ## ##    ##  ##    ## ##     ##
+#  ######  ######## ##     ## ##     ##  ######  ##     ##
+
+def module(count=1000):
+    return ast.parse(''.join('def f%d(x, y):\n'
+                             '    with open(x) as fp:\n'
+                             '        data = fp.read().split(y%d)\n'
+                             '    return g%d(data, h%d(x.attr%d + y))\n' % ((i,) + (i % 100,) * 4)
+                             for i in range(count)))
+
+
+def queries(size):
+    kinds = [
+        lambda i: m_inst(ast.Call, func=m_inst(ast.Name, id='g%d' % i)),
+        lambda i: m_inst(ast.Name, id='y%d' % i),
+        lambda i: m_inst(ast.Attribute, attr='attr%d' % i),
+        lambda i: m_inst(ast.With, items=m_any(m_dict(context_expr=m_inst(ast.Call, func=m_dict(id='h%d' % i))))),
+    ]
+    return [kinds[i % len(kinds)](i // len(kinds)) for i in range(size)]
+
+
+def walk_search(tree, matchers):
+    return [[n for n in ast.walk(tree) if m(n)] for m in matchers]
+
+
+def index_search(tree, matchers):
+    index = TreeIndex(tree)
+    return [index.find(m) for m in matchers]
+
+
+# ########  ##     ## ##    ##
+# ##     ## ##     ## ###   ##
+# ##     ## ##     ## ####  ##
+# ########  ##     ## ## ## ##
+# ##   ##   ##     ## ##  ####
+# ##    ##  ##     ## ##   ###
+# ##     ##  #######  ##    ##
+
+def timed(build, number, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            build()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_quote(sizes, number, repeat):
+    row = '%-10s %8s' + ' %12s' * len(strategies)
+    print(row % tuple(['statements', 'nodes'] + ['%s us' % s for s in strategies]))
+    hole = ast.Name('h', ast.Load())
+    for size in sizes:
+        tree = template(size)
+        expected = ast.dump(fill(copy.deepcopy(tree), hole))
+        times = []
+        for make in strategies.values():
+            build = make(tree, hole)
+            if ast.dump(build()) != expected:
+                raise AssertionError('%s builds another tree' % make.__name__)
+            times.append('%.1f' % (timed(build, number, repeat) * 1e6))
+        print(row % tuple([size, sum(1 for _ in ast.walk(tree))] + times))
+        sys.stdout.flush()
+
+
+def run_lambda(sizes, number, repeat):
+    cases = lambdas()
+    names = list(cases['key'])
+    row = '%-8s %10s' + ' %14s' * len(names)
+    print(row % tuple(['case', 'items'] + ['%s ns' % n for n in names]))
+    for case, functions in cases.items():
+        for size in sizes:
+            items = [Item(i * 7 % size) for i in range(size)] if case == 'key' else list(range(size))
+            results, times = [], []
+            for function in functions.values():
+                run = use(case, function, items)
+                results.append(run())
+                times.append('%.1f' % (timed(run, max(1, number // size), repeat) / size * 1e9))
+            if any(r != results[0] for r in results):
+                raise AssertionError('%s: the implementations disagree' % case)
+            print(row % tuple([case, size] + times))
+            sys.stdout.flush()
+
+
+def run_vectorize(sizes, number, repeat):
+    try:
+        import numpy
+    except ImportError:
+        print('vectorize: NumPy is not available')
+        return
+    functions = loops()
+    columns = ['%s %s' % (f, kind) for kind in ('list', 'array') for f in functions]
+    row = '%-8s' + ' %18s' * len(columns)
+    print(row % tuple(['items'] + ['%s ns' % c for c in columns]))
+    for size in sizes:
+        a = numpy.sin(numpy.arange(size, dtype=float))
+        b = numpy.cos(numpy.arange(size, dtype=float))
+        times = []
+        for convert in (list, numpy.array):
+            results = []
+            for function in functions.values():
+                args = convert(a), convert(b), convert(numpy.zeros(size))
+                run = functools.partial(function, *args, 1.)
+                results.append((run(), list(args[2])))
+                times.append('%.1f' % (timed(run, max(1, number // size), repeat) / size * 1e9))
+            (t0, out0), (t1, out1) = results
+            if not numpy.isclose(t0, t1) or out0 != out1:
+                raise AssertionError('vectorize: the loops disagree')
+        print(row % tuple([size] + times))
+        sys.stdout.flush()
+
+
+def run_dispatch(sizes, number, repeat):
+    count = 1000
+    row = '%-8s' + ' %12s' * 2
+    print(row % ('macros', 'tree us', 'linear us'))
+    for size in sizes:
+        times, results = [], []
+        for name, visitor in visitors(size).items():
+            trees = [sites(size, count) for _ in range(repeat)]
+            best = None
+            for tree in trees:
+                visitor.expanded.clear()
+                start = time.perf_counter()
+                tree = visitor.expand(tree)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            results.append(ast.dump(tree))
+            times.append('%.2f' % (best / count * 1e6))
+        if any(r != results[0] for r in results):
+            raise AssertionError('dispatch: the expansions differ')
+        print(row % tuple([size] + times))
+        sys.stdout.flush()
+
+
+def run_search(sizes, number, repeat):
+    tree = module()
+    row = '%-8s' + ' %12s' * 2
+    print(row % ('queries', 'index us', 'walk us'))
+    for size in sizes:
+        matchers = queries(size)
+        times, results = [], []
+        for search in (index_search, walk_search):
+            results.append([sorted(map(id, r)) for r in search(tree, matchers)])
+            times.append('%.1f' % (timed(lambda: search(tree, matchers), 1, repeat) / size * 1e6))
+        if results[0] != results[1]:
+            raise AssertionError('search: the results differ')
+        print(row % tuple([size] + times))
+        sys.stdout.flush()
+
+
+benchmarks = {
+    'quote': run_quote,
+    'lambda': run_lambda,
+    'vectorize': run_vectorize,
+    'dispatch': run_dispatch,
+    'search': run_search,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--benchmarks', default=','.join(benchmarks))
+    parser.add_argument('--sizes', default='1,10,100', help='statements of the quoted templates, items of the calls')
+    parser.add_argument('--number', type=int, default=1000, help='instantiations (or items) per run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs to take the best time of')
+    args = parser.parse_args(argv)
+
+    for i, name in enumerate(args.benchmarks.split(',')):
+        if i:
+            print()
+        benchmarks[name]([int(s) for s in args.sizes.split(',')], args.number, args.repeat)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""Measures the parser combinators on generated JSON-like and arithmetic inputs.
+
+    python bench_parsers.py [--sizes 1K,10K,100K,1M,10M] [--packrat] [--fuse] [--save FILE] [--compare FILE]
+
+For each grammar and input size, reports the throughput, and from a second, instrumented run, the number of parser
+invocations, the number of failed ones (each of them makes its caller backtrack) and the peak memory. Results can be
+saved, and compared against saved ones: a throughput lower than the baseline by more than --tolerance, or more
+invocations or backtracks than it, is reported as a regression and makes the script exit with 1.
+"""
+import config
+import pyns.parsers
+from pyns.parsers import *
+from pyns.utils import tmp_attr
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+
+#  ######   ########     ###    ##     ## ##     ##    ###    ########   ######
+# ##    ##  ##     ##   ## ##   ###   ### ###   ###   ## ##   ##     ## ##    ##
+# ##        ##     ##  ##   ##  #### #### #### ####  ##   ##  ##     ## ##
+# ##   #### ########  ##     ## ## ### ## ## ### ## ##     ## ########   ######
+# ##    ##  ##   ##   ######### ##     ## ##     ## ######### ##   ##         ##
+# ##    ##  ##    ##  ##     ## ##     ## ##     ## ##     ## ##    ##  ##    ##
+#  ######   ##     ## ##     ## ##     ## ##     ## ##     ## ##     ##  ######
+
+def json_grammar():
+    ws = p_regex(r'[\t\n ]*')
+    comma = p_regex(r'[\t\n ]*,[\t\n ]*')
+    string = p_regex(r'"(?:[^"\\]|\\.)*"')
+    number = p_regex(r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?')
+    value = p_defer(lambda: p_or(obj, array, string, number, p_str('true'), p_str('false'), p_str('null')))
+    pair = p_phrase(string, p_str(':'), value, keep=[0, 2], wp=ws)
+    obj = p_phrase(p_str('{'), p_opt(p_mult(pair, separator=comma), []), p_str('}'), extract=1, wp=ws)
+    array = p_phrase(p_str('['), p_opt(p_mult(value, separator=comma), []), p_str(']'), extract=1, wp=ws)
+    return p_and(value, ws, extract=0)
+
+
+def json_input(size, rng):
+    items = []
+    length = 2
+    while length < size:
+        item = '{"id": %d, "name": "%s", "tags": [%s], "score": %.3f, "ok": %s, "parent": null}' % (
+            rng.randrange(10**6),
+            ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randrange(3, 12))),
+            ', '.join('"t%d"' % rng.randrange(100) for _ in range(rng.randrange(4))),
+            rng.random() * 100,
+            rng.choice(['true', 'false']))
+        items.append(item)
+        length += len(item) + 2
+    return '[' + ',\n '.join(items) + ']'
+
+
+def arith_grammar():
+    num = p_regex(r'[0-9]+(?:\.[0-9]+)?')
+    expr = p_defer(lambda: p_and(term, p_mult(p_phrase(p_regex(r'[+-]'), term), separator=p_str(''))))
+    term = p_defer(lambda: p_and(factor, p_mult(p_phrase(p_regex(r'[*/]'), factor), separator=p_str(''))))
+    factor = p_phrase(p_or(num, p_phrase(p_str('('), expr, p_str(')'), extract=1), p_and(p_str('-'), num)), extract=0)
+    return p_and(expr, p_regex(r'[\t\n ]*'), extract=0)
+
+
+def arith_input(size, rng):
+    def operand(depth):
+        if depth < 3 and rng.random() < 0.2:
+            return '(%s)' % ' - '.join(operand(depth + 1) for _ in range(rng.randrange(2, 4)))
+        return str(rng.randrange(1000))
+    parts = [operand(0)]
+    length = len(parts[0])
+    while length < size:
+        part = ' %s %s' % (rng.choice('+-*/'), operand(0))
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+
+grammars = {
+    'json': (json_grammar, json_input),
+    'arith': (arith_grammar, arith_input),
+}
+
+
+# ########  ##     ## ##    ##
+# ##     ## ##     ## ###   ##
+# ##     ## ##     ## ####  ##
+# ########  ##     ## ## ## ##
+# ##   ##   ##     ## ##  ####
+# ##    ##  ##     ## ##   ###
+# ##     ##  #######  ##    ##
+
+class Counters:
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+
+    def sugar(self, parser):
+        """Replaces SugarParser while building a grammar, so that every parser it is made of gets counted."""
+        counters = self
+
+        def parse(str, offset=0):
+            counters.calls += 1
+            n, l = parser(str, offset)
+            if l < 0:
+                counters.failures += 1
+            return n, l
+
+        return _SugarParser(parse)
+
+
+_SugarParser = pyns.parsers.SugarParser
+
+
+def build(factory, packrat, fuse=False):
+    grammar = factory()
+    if fuse:
+        grammar = p_fuse(grammar)
+    return p_packrat(grammar) if packrat else grammar
+
+
+def mode(r):
+    return ('packrat' if r['packrat'] else 'plain') + ('+fused' if r.get('fused') else '')
+
+
+def run(name, size, packrat, repeat, counters=True, fuse=False):
+    factory, generate = grammars[name]
+    text = generate(size, random.Random(size))
+
+    grammar = build(factory, packrat, fuse)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        node, length = grammar(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    if length != len(text):
+        raise AssertionError('%s: parsed %d characters out of %d' % (name, length, len(text)))
+
+    result = {'grammar': name, 'size': len(text), 'packrat': packrat, 'fused': fuse, 'seconds': best,
+              'bytes_per_sec': len(text) / best}
+    if counters:
+        c = Counters()
+        with tmp_attr(pyns.parsers, SugarParser=c.sugar):
+            grammar = build(factory, packrat, fuse)
+        tracemalloc.start()
+        grammar(text)
+        result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result['invocations'] = c.calls
+        result['backtracks'] = c.failures
+    return result
+
+
+def parse_size(s):
+    units = {'K': 10**3, 'M': 10**6}
+    if s[-1].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+
+def key(r):
+    return '%s/%d/%s' % (r['grammar'], r['size'], mode(r))
+
+
+def compare(results, baseline, tolerance):
+    base = {key(r): r for r in baseline}
+    regressions = []
+    for r in results:
+        b = base.get(key(r))
+        if b is None:
+            continue
+        if r['bytes_per_sec'] < b['bytes_per_sec'] * (1 - tolerance):
+            regressions.append('%s: %.0f bytes/sec, baseline %.0f' % (key(r), r['bytes_per_sec'], b['bytes_per_sec']))
+        for counter in ('invocations', 'backtracks'):
+            if counter in r and counter in b and r[counter] > b[counter]:
+                regressions.append('%s: %d %s, baseline %d' % (key(r), r[counter], counter, b[counter]))
+    return regressions
+
+
+_row = '%-8s %10s %14s %14s %12s %12s %12s'
+
+
+def header():
+    print(_row % ('grammar', 'size', 'mode', 'bytes/sec', 'invocations', 'backtracks', 'peak KiB'))
+
+
+def row(r):
+    print(_row % (r['grammar'], r['size'], mode(r), '%.0f' % r['bytes_per_sec'],
+                  r.get('invocations', '-'), r.get('backtracks', '-'),
+                  '%.0f' % (r['peak_memory'] / 1024) if 'peak_memory' in r else '-'))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--grammars', default=','.join(grammars))
+    parser.add_argument('--sizes', default='1K,10K,100K,1M,10M')
+    parser.add_argument('--packrat', action='store_true', help='also run the grammars in packrat mode')
+    parser.add_argument('--fuse', action='store_true', help='also run the grammars fused (see p_fuse)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs to take the best time of')
+    parser.add_argument('--no-counters', dest='counters', action='store_false',
+                        help='skip the instrumented run (invocations, backtracks, peak memory)')
+    parser.add_argument('--save', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with saved ones')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='throughput drop allowed by --compare')
+    args = parser.parse_args(argv)
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    results = []
+    header()
+    for name in args.grammars.split(','):
+        for size in args.sizes.split(','):
+            for packrat in ([False, True] if args.packrat else [False]):
+                for fuse in ([False, True] if args.fuse else [False]):
+                    results.append(run(name, parse_size(size), packrat, args.repeat, args.counters, fuse))
+                    row(results[-1])
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print('REGRESSION ' + r)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Command line tools of pyns.
+
+    python -m pyns profile [--sort cost|name|hits|attempts] [--limit N] FILE [ARGS...]
+    python -m pyns compile [--jobs N] [--source DIR] PATH...
+
+profile runs FILE as the main module, with the import hook installed, and reports on stderr what expanding its macros
+(and the ones of the modules it imports) cost: per macro, per site, and per expanded module or function.
+
+compile expands the modules calling with_macros found in the PATHs (files or packages) over a pool of processes, and
+writes them to the cache, or as expanded source to DIR (see pyns.compileall).
+"""
+import argparse
+import runpy
+import sys
+
+from . import profiling
+from .compileall import compile_all
+from .core import install_import_hook, uninstall_import_hook, PathFinder
+
+
+def profile(args):
+    sys.argv = [args.file] + args.args
+    hooked = PathFinder in sys.meta_path
+    install_import_hook()
+    try:
+        with profiling.profile() as stats:
+            try:
+                runpy.run_path(args.file, run_name='__main__')
+            finally:
+                print(stats.report(args.sort, args.limit), file=sys.stderr)
+    finally:
+        if not hooked:
+            uninstall_import_hook()
+    return 0
+
+
+def compile_packages(args):
+    return 1 if compile_all(args.paths, args.jobs, args.source) else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyns', description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('profile', help='run a script and report what expanding its macros cost')
+    cmd.add_argument('--sort', choices=sorted(profiling._sorts), default='cost')
+    cmd.add_argument('--limit', type=int, default=None, help='lines per table')
+    cmd.add_argument('file')
+    cmd.add_argument('args', nargs=argparse.REMAINDER)
+    cmd.set_defaults(run=profile)
+
+    cmd = commands.add_parser('compile', help='expand the macros of packages ahead of time')
+    cmd.add_argument('--jobs', '-j', type=int, default=None, help='worker processes (default: one per core)')
+    cmd.add_argument('--source', metavar='DIR', help='write the expanded source to DIR instead of the cache')
+    cmd.add_argument('paths', nargs='+')
+    cmd.set_defaults(run=compile_packages)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Expands the macros of whole packages ahead of time, in parallel.
+
+The modules calling with_macros are expanded the way the import hook does (see MacroLoader): with the macros they
+import, which must be importable by the worker processes. The results are written to the cache the import hook and
+with_macros read from, or, with source_dir, as expanded source files.
+"""
+from ast import parse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import importlib.util
+import os
+import sys
+import time
+import traceback
+
+from .utils import tmp_attr
+from .core import _calls_with_macros, _uses_macros, _digest, cache_store, expand_module, macro_deps, unparse
+
+
+def module_name(path):
+    """Returns the directory path has to be imported from, and the name of its module"""
+    dirname, base = os.path.split(os.path.abspath(path))
+    parts = [] if base == '__init__.py' else [os.path.splitext(base)[0]]
+    while os.path.exists(os.path.join(dirname, '__init__.py')):
+        dirname, package = os.path.split(dirname)
+        parts.insert(0, package)
+    return dirname, '.'.join(parts)
+
+
+def find_modules(paths):
+    """Yields the files of paths (files, or directories walked recursively) that call with_macros"""
+    for path in paths:
+        if os.path.isdir(path):
+            files = (os.path.join(d, f) for d, dirs, fs in sorted(os.walk(path)) for f in sorted(fs))
+        else:
+            files = [path]
+        for f in files:
+            if not f.endswith('.py'):
+                continue
+            with open(f, 'rb') as fp:
+                data = fp.read()
+            if _uses_macros.search(data) is None:
+                continue
+            try:
+                tree = parse(data, f)
+            except SyntaxError:
+                # reported by the expansion
+                yield f
+                continue
+            if _calls_with_macros(tree):
+                yield f
+
+
+# the optimization level the modules are compiled with, the one of the process running compile_all in its workers
+_optimize = -1
+
+
+def _init_worker(dont_write_bytecode, optimize):
+    """Gives a worker the settings of the process running compile_all, which it does not inherit when spawned"""
+    global _optimize
+    sys.dont_write_bytecode = dont_write_bytecode
+    _optimize = optimize
+
+
+def _pool(jobs):
+    settings = (sys.dont_write_bytecode, sys.flags.optimize)
+    try:
+        return ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=settings)
+    except TypeError:
+        # no initializer before Python 3.7, but no spawned workers either: they are forked from this process
+        return ProcessPoolExecutor(jobs)
+
+
+def compile_module(path, source_dir=None):
+    """Expands the module at path, and writes it to the cache, or to source_dir as source. Returns the error, if any,
+    as a string."""
+    try:
+        root, name = module_name(path)
+        if root not in sys.path:
+            sys.path.insert(0, root)
+        package = name if os.path.basename(path) == '__init__.py' else name.rpartition('.')[0]
+        with open(path, 'rb') as f:
+            data = f.read()
+        source = importlib.util.decode_source(data)
+        tree, candidates = expand_module(parse(source, path, 'exec'), source, package, path)
+        if source_dir is None:
+            code = compile(tree, path, 'exec', dont_inherit=True, optimize=_optimize)
+            cache_store(path, _digest(data), macro_deps(candidates), code, _optimize)
+        else:
+            target = os.path.join(source_dir, os.path.relpath(os.path.abspath(path), root))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'w') as f:
+                f.write(unparse(tree) + '\n')
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
+def compile_all(paths, jobs=None, source_dir=None, out=sys.stderr):
+    """Expands the modules found in paths (see find_modules) over jobs processes, reporting the progress and the
+    failures to out. Returns the list of (path, error) that failed."""
+    modules = list(find_modules(paths))
+    failures = []
+    start = time.perf_counter()
+    # writing the cache is the point, whatever the environment says
+    with tmp_attr(sys, dont_write_bytecode=False), _pool(jobs) as pool:
+        futures = {pool.submit(compile_module, m, source_dir): m for m in modules}
+        for i, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            error = future.result()
+            print('[%d/%d] %s %s' % (i, len(modules), 'FAILED' if error else 'ok', path), file=out)
+            if error:
+                failures.append((path, error))
+    print('%d modules expanded, %d failed in %.2fs' % (len(modules) - len(failures), len(failures),
+                                                         time.perf_counter() - start), file=out)
+    for path, error in failures:
+        print('\n%s:\n%s' % (path, error), file=out)
+    return failures
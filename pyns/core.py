@@ -1,16 +1,25 @@
 from ast import *
 from .matching import *
+from . import profiling
 from functools import wraps
 from contextlib import contextmanager
+from types import CodeType, FunctionType
 
 import re
+import os
+import bisect
 import sys
+import marshal
+import hashlib
 import inspect
+import importlib.util
 import collections
+import builtins
 import io
-
-
-# TODO: Add import bootstrap
+import linecache
+import pickle
+import threading
+from array import array
 
 
 _ast = None
@@ -41,8 +50,15 @@ class Macro:
 
         def instr_Subscript(self, node):
             return locate(ast_genast(node), node)
+
+    The matchers of a macro are expected to only match nodes mentioning its name, as a Name node in their subtree.
+    A macro matching other nodes has to set named to False, otherwise the expansion could skip them.
+
+    What the matchers capture (see m_capture) is given to the instrumentation functions as keyword arguments.
     """
 
+    named = True
+
     def __init__(self, name, **kwargs):
         self.name = name
         for k, v in kwargs.items():
@@ -55,10 +71,19 @@ class Macro:
             # ...
         }
 
-    def instr(self, node):
+    def instr(self, node, **bindings):
         method = 'instr_'+node.__class__.__name__
         visitor = getattr(self, method)
-        return visitor(node)
+        return visitor(node, **bindings) if bindings else visitor(node)
+
+
+class MacroError(SyntaxError):
+    """Raised while expanding, by a macro site that cannot be expanded"""
+
+    def __init__(self, msg, node=None):
+        col_offset = getattr(node, 'col_offset', None)
+        SyntaxError.__init__(self, msg, (None, getattr(node, 'lineno', None),
+                                         None if col_offset is None else col_offset + 1, None))
 
 
 class MacroMixer():
@@ -84,14 +109,15 @@ class MacroMixer():
                         self.handlers[k] = m
                 return matchers
 
-            def instr(self, node):
+            def instr(self, node, **bindings):
                 handler = self.handlers[node.__class__]
-                return handler.instr(node)
+                return handler.instr(node, **bindings) if bindings else handler.instr(node)
 
             @classmethod
             def register(cls, macro):
                 return mixer.register(macro)
 
+        _MixedMacro.mixer = mixer
         self.cls = _MixedMacro
 
     def register(self, macro):
@@ -115,6 +141,8 @@ def macro_inline(f=None):
             def instr_Subscript(self, node):
                 return f(node.slice.value, container=node, **self.kwargs)
 
+        _InlineMacro.__module__ = getattr(f, '__module__', __name__)
+        _InlineMacro.__name__ = getattr(f, '__name__', _InlineMacro.__name__)
         return _InlineMacro
 
     return _(f) if f is not None else _
@@ -129,21 +157,16 @@ def macro_block(f=None):
                 self.kwargs = kwargs
 
             def matchers(self, name):
-                self.item_matcher = m_inst(withitem, context_expr=m_inst(Name, id=name))
                 return {
-                    With: m_dict(items=m_any(self.item_matcher))
+                    With: m_dict(items=m_any(m_capture('item', m_inst(withitem, context_expr=m_inst(Name, id=name)))))
                 }
 
-            def instr_With(self, node):
-                var = None
-                items = []
-                for i in node.items:
-                    if self.item_matcher(i):
-                        var = i.optional_vars
-                    else:
-                        items.append(i)
-                return f(var, items, node.body, container=node, **self.kwargs)
+            def instr_With(self, node, item):
+                items = [i for i in node.items if i is not item]
+                return f(item.optional_vars, items, node.body, container=node, **self.kwargs)
 
+        _BlockMacro.__module__ = getattr(f, '__module__', __name__)
+        _BlockMacro.__name__ = getattr(f, '__name__', _BlockMacro.__name__)
         return _BlockMacro
 
     return _(f) if f is not None else _
@@ -159,33 +182,374 @@ def macro_block(f=None):
 
 
 def locate(newnode, oldnode):
+    """Gives newnode the location of oldnode, and to its descendants without any, the one of their parent. The
+    descendants having one are expected to be located entirely, as the parsed and the expanded ones are, and are not
+    walked: locating the result of every macro site stays linear in the size of the results.
+    """
     if isinstance(newnode, AST):
-        return fix_missing_locations(copy_location(newnode, oldnode))
+        copy_location(newnode, oldnode)
+        _fill_locations(newnode, getattr(newnode, 'lineno', 1), getattr(newnode, 'col_offset', 0))
     return newnode
 
 
+def _fill_locations(node, lineno, col_offset):
+    for child in iter_child_nodes(node):
+        if 'lineno' in child._attributes:
+            if hasattr(child, 'lineno'):
+                continue
+            child.lineno, child.col_offset = lineno, col_offset
+        _fill_locations(child, lineno, col_offset)
+
+
+_scopes = (Module, FunctionDef, AsyncFunctionDef, ClassDef, Lambda, ListComp, SetComp, DictComp, GeneratorExp)
+
+
+def bound_names(scope):
+    """Returns the set of the names bound in scope (one of _scopes), not counting the scopes nested in it. "*" is
+    part of it when a star import binds names that cannot be known.
+    """
+    names = set()
+    if isinstance(scope, (FunctionDef, AsyncFunctionDef, Lambda)):
+        args = scope.args
+        for arg in args.args + args.kwonlyargs + getattr(args, 'posonlyargs', []) + [args.vararg, args.kwarg]:
+            if arg is not None:
+                names.add(arg.arg)
+        todo = list(scope.body) if isinstance(scope.body, list) else [scope.body]
+    elif isinstance(scope, (ListComp, SetComp, DictComp, GeneratorExp)):
+        todo = [g.target for g in scope.generators]
+    else:
+        todo = list(scope.body)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, Name):
+            if not isinstance(node.ctx, Load):
+                names.add(node.id)
+            continue
+        if isinstance(node, (Import, ImportFrom)):
+            names.update((a.asname or a.name).split('.')[0] for a in node.names)
+            continue
+        if isinstance(node, (Global, Nonlocal)):
+            names.update(node.names)
+            continue
+        # functions, classes, exception handlers and match captures
+        name = getattr(node, 'name', None)
+        if isinstance(name, str):
+            names.add(name)
+        if isinstance(getattr(node, 'rest', None), str):
+            names.add(node.rest)
+        if isinstance(node, _scopes):
+            # only what they are decorated with is part of the enclosing scope
+            todo.extend(getattr(node, 'decorator_list', ()))
+            continue
+        todo.extend(iter_child_nodes(node))
+    return names
+
+
 class MacroVisitor(NodeTransformer):
     """Given a dictionary, registers the macros using their name, then it is
     able to apply all the modifications.
+
+    expand first looks for the subtrees that cannot contain any macro, so that the expansion goes straight to the
+    macro sites, without walking or rebuilding the rest of the tree. When the source of the tree is given, the lines
+    mentioning the macros are found with a regex, and only the statements spanning them are looked into.
+
+    The result of a macro is expanded in turn, so that macros can produce macro sites. The subtrees a macro already
+    expanded through transform are recorded in expanded, and not walked again: every node is visited a bounded number
+    of times, however deeply the macros are nested.
+
+    macros maps the node classes to the MatcherTree of the matchers of the macros for them, so that a node is only
+    tried against the macros that may match it.
+
+    scopes is the stack of the scopes (modules, functions, classes, lambdas and comprehensions) enclosing the node
+    being visited, so that macros can tell whether a name is bound where they are used (see bound).
+
+    volatile is set by the macros whose results depend on more than the source and the macros, like the values of the
+    globals pyns.macros.const evaluates: with_macros does not cache such an expansion.
     """
 
     def __init__(self, candidates):
-        self.macros = collections.defaultdict(list)
+        self.macros = {}
+        self.names = set()
+        self.cold = {}
+        self.expanded = {}
+        self.globals = candidates
+        self.scopes = []
+        self._bound = {}
+        self.volatile = False
+        anywhere = set()
+        profile = profiling.active()
         for name, cls in candidates.items():
             if isinstance(cls, type) and issubclass(cls, Macro):
-                current = cls(name, transform=self.visit)
+                current = cls(name, transform=self.transform, visitor=self)
+                self.names.add(name)
                 for nodecls, matcher in current.matchers.items():
-                    self.macros[nodecls].append((matcher, current))
+                    compiled = m_bind(matcher, nodecls) if m_captures(matcher) else m_compile(matcher, nodecls)
+                    matcher, instr = compiled, current.instr
+                    if profile is not None:
+                        handler = getattr(current, 'handlers', {}).get(nodecls)
+                        key = name if handler is None else '%s/%s' % (name, handler.__class__.__name__)
+                        matcher, instr = profile.matcher(key, matcher), profile.instr(key, instr)
+                    self.macros.setdefault(nodecls, MatcherTree()).add(matcher, instr)
+                    if not current.named:
+                        anywhere.add(nodecls)
+        self.anywhere = frozenset(anywhere)
+
+    def scan(self, node, lines=None, end=None):
+        """Returns whether node could contain a macro site. The children of node that cannot are recorded in cold,
+        which keeps them alive as long as the visitor, so that their ids cannot be reused by new nodes.
+
+        lines is the sorted list of the lines mentioning a macro, if known, and end the last line node can span.
+        """
+        hot = node.__class__ in self.anywhere or (node.__class__ is Name and node.id in self.names)
+        cold = []
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, AST):
+                if self.scan(value):
+                    hot = True
+                else:
+                    cold.append(value)
+            elif isinstance(value, list):
+                if lines is not None and value and isinstance(value[0], stmt):
+                    if self.scan_body(value, lines, end, cold):
+                        hot = True
+                    continue
+                for item in value:
+                    if isinstance(item, AST):
+                        if self.scan(item):
+                            hot = True
+                        else:
+                            cold.append(item)
+        if hot:
+            for c in cold:
+                self.cold[id(c)] = c
+        return hot
+
+    def scan_body(self, stmts, lines, end, cold):
+        """Scans the statements spanning lines mentioning a macro, the other ones are appended to cold.
+        A statement spans from its first line (or the one of its first decorator) to the line before the next one.
+        """
+        hot = False
+        starts = [min([s.lineno] + [d.lineno for d in getattr(s, 'decorator_list', ())]) for s in stmts]
+        starts.append(end + 1)
+        for i, s in enumerate(stmts):
+            j = bisect.bisect_left(lines, starts[i])
+            if j < len(lines) and lines[j] < starts[i + 1] and self.scan(s, lines, starts[i + 1] - 1):
+                hot = True
+            else:
+                cold.append(s)
+        return hot
+
+    def mentions(self, source):
+        """Returns the sorted list of the lines of source mentioning the name of a macro.
+        """
+        lines = []
+        if not self.names:
+            return lines
+        names = re.compile(r'\b(?:%s)\b' % '|'.join(re.escape(n) for n in sorted(self.names)))
+        line, last = 1, 0
+        for m in names.finditer(source):
+            line += source.count('\n', last, m.start())
+            last = m.start()
+            if not lines or lines[-1] != line:
+                lines.append(line)
+        return lines
+
+    def expand(self, tree, source=None, filename=None):
+        """Expands the macros of tree, skipping the subtrees that cannot contain any. source is the code tree has been
+        parsed from, if available, and filename the file it comes from, which the MacroErrors raised are located in.
+        """
+        if source is not None and not self.anywhere and isinstance(tree, Module):
+            hot = self.scan(tree, self.mentions(source), float('inf'))
+        else:
+            hot = self.scan(tree)
+        if not hot:
+            return tree
+        try:
+            return self.visit(tree)
+        except MacroError as e:
+            if e.filename is None and filename is not None:
+                e.filename = filename
+                if e.lineno:
+                    e.text = linecache.getline(filename, e.lineno) or None
+            raise
+
+    def transform(self, node):
+        """Expands node (an AST or a list of them). The result is not walked again by the expansion of the enclosing
+        macro sites.
+        """
+        result = self.visit(node)
+        for n in (result if isinstance(result, list) else [result]):
+            if isinstance(n, AST):
+                self.expanded[id(n)] = n
+        return result
+
+    def bound_names(self, scope):
+        """bound_names(scope), for one of the scopes enclosing the node being visited, computed once"""
+        names = self._bound.get(id(scope))
+        if names is None:
+            names = self._bound[id(scope)] = bound_names(scope)
+        return names
+
+    def scope_of(self, name):
+        """Returns the innermost scope enclosing the node being visited that binds name (the bodies of the enclosing
+        classes excepted), or None.
+        """
+        for i, scope in enumerate(reversed(self.scopes)):
+            if i and scope.__class__ is ClassDef:
+                continue
+            names = self.bound_names(scope)
+            if name in names or '*' in names:
+                return scope
+        return None
 
     def visit(self, node):
         if isinstance(node, list):
             return [self.visit(n) for n in node]
-        for matcher, macro in self.macros[node.__class__]:
-            if matcher(node):
-                return locate(macro.instr(node), node)
+        if id(node) in self.cold or id(node) in self.expanded:
+            return node
+        macros = self.macros.get(node.__class__)
+        if macros is not None:
+            for i, matcher, instr in macros.candidates(node):
+                # True, or the bindings of the captures
+                match = matcher(node)
+                if match is not None and match is not False:
+                    self.expanded[id(node)] = node
+                    result = instr(node, **match) if match is not True and match else instr(node)
+                    return locate(self.transform(result), node)
+        if node.__class__ in _scopes:
+            self.scopes.append(node)
+            try:
+                return self.generic_visit(node)
+            finally:
+                self.scopes.pop()
+                self._bound.pop(id(node), None)
         return self.generic_visit(node)
 
 
+#  ######     ###     ######  ##     ## ########
+# ##    ##   ## ##   ##    ## ##     ## ##
+# ##        ##   ##  ##       ##     ## ##
+# ##       ##     ## ##       ######### ######
+# ##       ######### ##       ##     ## ##
+# ##    ## ##     ## ##    ## ##     ## ##
+#  ######  ##     ##  ######  ##     ## ########
+
+
+# Expanded modules are cached next to the regular bytecode, in __pycache__/<module>.<tag>.opt-pyns<level>.pyc, one per
+# optimization level. An entry records the digest of the source it was expanded from and the digest of every module the
+# macros it used were defined in, so that editing any of them invalidates it. The interpreter version is part of both
+# the file name and the magic.
+cache_enabled = True
+
+_cache_magic = importlib.util.MAGIC_NUMBER + b'pyns'
+_engine = (__name__, m_dict.__module__)
+_file_digests = {}
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _file_digest(path):
+    """Digest of the content of a file, only recomputed when its modification time or size changes.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (st.st_mtime, st.st_size)
+    known = _file_digests.get(path)
+    if known is not None and known[0] == key:
+        return known[1]
+    with open(path, 'rb') as f:
+        digest = _digest(f.read())
+    _file_digests[path] = (key, digest)
+    return digest
+
+
+def _macro_modules(cls):
+    """The modules defining cls, its bases, and the macros of its mixer"""
+    for base in cls.__mro__:
+        if base.__module__ != 'builtins':
+            yield base.__module__
+    mixer = getattr(cls, 'mixer', None)
+    if mixer is not None:
+        for m in mixer.macros:
+            yield from _macro_modules(m)
+
+
+def macro_deps(candidates):
+    """Describes the macros found in candidates by the modules defining them, as a sorted tuple of
+    (module name, file, digest). The modules of the expansion engine are always part of it.
+    """
+    names = set(_engine)
+    for cls in candidates.values():
+        if isinstance(cls, type) and issubclass(cls, Macro):
+            names.update(_macro_modules(cls))
+        elif getattr(cls, 'inlinable', False) is True:
+            # the inline macro copies their code
+            names.add(cls.__module__)
+    deps = []
+    for name in names:
+        path = getattr(sys.modules.get(name), '__file__', None)
+        deps.append((name, path, _file_digest(path) if path else None))
+    return tuple(sorted(deps))
+
+
+def _cache_path(path, optimize=-1):
+    """The cache file of the source file at path, one per optimization level (-1 for the one of the interpreter)"""
+    level = sys.flags.optimize if optimize == -1 else optimize
+    return importlib.util.cache_from_source(path, optimization='pyns%d' % level)
+
+
+def cache_load(path, source_digest, deps=None, optimize=-1):
+    """Returns the expanded code cached for the source file at path, or None if there is none or it is stale.
+
+    If deps is given, the entry must have been expanded with exactly those macros. Otherwise, every module the entry
+    depends on is checked against the file it was defined in. optimize is the optimization level the code is compiled
+    with, as for compile.
+    """
+    if not cache_enabled:
+        return None
+    try:
+        with open(_cache_path(path, optimize), 'rb') as f:
+            if f.read(len(_cache_magic)) != _cache_magic:
+                return None
+            digest, cached_deps = marshal.load(f)
+            if digest != source_digest:
+                return None
+            if deps is not None:
+                if cached_deps != deps:
+                    return None
+            elif any(_file_digest(p) != d for _, p, d in cached_deps):
+                return None
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def cache_store(path, source_digest, deps, code, optimize=-1):
+    """Writes code, the expansion of the source file at path compiled at the optimization level optimize, to the
+    cache. Just like the import system does for bytecode, failures are silently ignored.
+    """
+    if not cache_enabled or sys.dont_write_bytecode:
+        return
+    if any(d is None for _, _, d in deps):
+        return
+    try:
+        cpath = _cache_path(path, optimize)
+        os.makedirs(os.path.dirname(cpath), exist_ok=True)
+        tmp = '%s.%d' % (cpath, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(_cache_magic)
+            f.write(marshal.dumps((source_digest, deps)))
+            f.write(marshal.dumps(code))
+        os.replace(tmp, cpath)
+    except (OSError, NotImplementedError):
+        pass
+
+
 # ########   #######   #######  ########  ######  ######## ########     ###    ########
 # ##     ## ##     ## ##     ##    ##    ##    ##    ##    ##     ##   ## ##   ##     ##
 # ##     ## ##     ## ##     ##    ##    ##          ##    ##     ##  ##   ##  ##     ##
@@ -195,24 +559,165 @@ class MacroVisitor(NodeTransformer):
 # ########   #######   #######     ##     ######     ##    ##     ## ##     ## ##
 
 
-from _frozen_importlib_external import PathFinder as _PathFinder
+from _frozen_importlib_external import PathFinder as _PathFinder, SourceFileLoader as _SourceFileLoader
+
+
+# the sources of the modules that may bring macros: the ones defining them, and the ones importing them from pyns
+_brings_macros = re.compile(rb'\b(?:Macro|MacroMixer|macro_inline|macro_block|pyns)\b')
+
+
+def _may_bring_macros(name):
+    """Whether the module name may bring macros, which is worth importing it before the module importing it runs: it
+    has been imported already, or its source mentions them.
+    """
+    if name in sys.modules:
+        return True
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return False
+    if spec is None or not spec.has_location or not spec.origin.endswith('.py'):
+        return False
+    try:
+        with open(spec.origin, 'rb') as f:
+            return _brings_macros.search(f.read()) is not None
+    except OSError:
+        return False
+
+
+def imported_macros(tree, package=None):
+    """Looks at the top-level "from ... import ..." statements of a module, imports the modules that may bring macros
+    (see _may_bring_macros), and returns the macros they bring as a dictionary, the same way with_macros would find
+    them in the globals of the module.
+    """
+    candidates = {}
+    for stmt in tree.body:
+        if not isinstance(stmt, ImportFrom):
+            continue
+        name = importlib.util.resolve_name('.' * stmt.level + (stmt.module or ''), package)
+        if not _may_bring_macros(name):
+            continue
+        mod = importlib.import_module(name)
+        for alias in stmt.names:
+            if alias.name == '*':
+                names = getattr(mod, '__all__', None) or [n for n in vars(mod) if not n.startswith('_')]
+                objs = ((n, getattr(mod, n, None)) for n in names)
+            else:
+                objs = [(alias.asname or alias.name, getattr(mod, alias.name, None))]
+            for n, obj in objs:
+                if isinstance(obj, type) and issubclass(obj, Macro):
+                    candidates[n] = obj
+    return candidates
+
+
+# the sources that may call with_macros, before they are parsed to know (see _calls_with_macros)
+_uses_macros = re.compile(rb'\bwith_macros\(')
+
+
+def _calls_with_macros(tree):
+    """Whether the module tree calls with_macros, rather than mentioning it in its comments, strings or definitions"""
+    for node in walk(tree):
+        if isinstance(node, Call):
+            func = node.func
+            if isinstance(func, Name) and func.id == 'with_macros' \
+                    or isinstance(func, Attribute) and func.attr == 'with_macros':
+                return True
+    return False
+
+
+def expand_module(tree, source=None, package=None, filename=None):
+    """Expands the macros a module imports in its tree. Returns the expanded tree, and the macros used (see
+    imported_macros).
+    """
+    candidates = imported_macros(tree, package)
+    return MacroVisitor(candidates).expand(tree, source, filename), candidates
+
+
+class MacroLoader(_SourceFileLoader):
+    """Loads the modules calling with_macros with their macros already expanded, so that they are parsed, expanded and
+    executed only once. Since the expansion happens before the module runs, only the macros it imports are known
+    (see imported_macros): a module defining its own is expanded again by with_macros, the way it is without the hook.
+    """
+
+    expanded = False
+
+    def get_code(self, fullname):
+        path = self.get_filename(fullname)
+        code = self.expand(self.get_data(path), path)
+        # the regular modules get their bytecode from the regular cache
+        return code if code is not None else super().get_code(fullname)
+
+    def source_to_code(self, data, path, *, _optimize=-1):
+        # also called by SourceFileLoader.get_code, for the regular modules
+        code = self.expand(data, path, _optimize)
+        return code if code is not None else super().source_to_code(data, path, _optimize=_optimize)
+
+    def expand(self, data, path, _optimize=-1):
+        """The code of the source data, with its macros expanded, or None if it does not call with_macros. The modules
+        expanded once are loaded from the cache (see cache_load) without being parsed."""
+        if _uses_macros.search(data) is None:
+            return None
+        with profiling.record('import', path) as rec:
+            digest = _digest(data)
+            code = cache_load(path, digest, optimize=_optimize)
+            rec.lap('load')
+            if code is not None:
+                self.expanded = True
+                return code
+
+            source = importlib.util.decode_source(data)
+            tree = parse(source, path, 'exec')
+            rec.lap('parse')
+            if not _calls_with_macros(tree):
+                return None
+            self.expanded = True
+            package = self.name if self.is_package(self.name) else self.name.rpartition('.')[0]
+            tree, candidates = expand_module(tree, source, package, path)
+            rec.lap('expand')
+
+            code = compile(tree, path, 'exec', dont_inherit=True, optimize=_optimize)
+            cache_store(path, digest, macro_deps(candidates), code, _optimize)
+            rec.lap('compile')
+            return code
 
 
 class PathFinder(_PathFinder):
     @classmethod
     def find_spec(cls, fullname, path=None, target=None):
         ret = _PathFinder.find_spec(fullname, path, target)
+        if ret is not None and type(ret.loader) is _SourceFileLoader:
+            ret.loader = MacroLoader(ret.loader.name, ret.loader.path)
         return ret
 
 
+def install_import_hook():
+    """Makes every following import expand the macros of the modules calling with_macros.
+    """
+    sys.meta_path[:] = [PathFinder if f is _PathFinder else f for f in sys.meta_path]
+
+
+def uninstall_import_hook():
+    sys.meta_path[:] = [_PathFinder if f is PathFinder else f for f in sys.meta_path]
+
+
 @contextmanager
 def import_macro():
     copy = sys.meta_path
     sys.meta_path = [PathFinder if f is _PathFinder else f for f in copy]
+    try:
+        yield
+    finally:
+        sys.meta_path = copy
+
+
+def _loaded_expanded(globals):
+    return getattr(globals.get('__loader__'), 'expanded', False)
 
-    yield
 
-    sys.meta_path = copy
+def _defines_macros(name, globals):
+    """Whether the module name defines some of the macros found in its globals"""
+    return any(isinstance(v, type) and issubclass(v, Macro) and name in _macro_modules(v)
+               for v in list(globals.values()))
 
 
 def without_macros():
@@ -227,21 +732,50 @@ def with_macros(name, globals, locals):
 
         if with_macros(__name__, globals(), locals()):
             # ... My code to be processed by macros
+
+    When the module has been imported through the import hook (see import_macro), its macros are already expanded
+    and the body simply runs, unless the module defines macros of its own.
     """
     global _ast
     _mod = sys.modules[name]
 
+    # the module has been expanded by the MacroLoader before running. The macros it defines were not known then: it is
+    # expanded again with them, in two passes
+    if _loaded_expanded(globals) and (_ast is not None or not _defines_macros(name, globals)):
+        return True
+
     # _ast is not defined yet, we want to take it and expand macros
     if _ast is None:
-        # we take the whole module, parse it
-        _ast = parse(inspect.getsource(_mod), _mod.__file__, 'exec')
-
-        # we look for global macros, use them on the module using their name
-        m = MacroVisitor(globals)
-        _ast = m.visit(_ast)
-
-        exec(compile(_ast, _mod.__file__, 'exec'), globals, locals)
-        _ast = None
+        path = _mod.__file__
+        with profiling.record('with_macros', path) as rec:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = _digest(data)
+            deps = macro_deps(globals)
+
+            # if the module has already been expanded with the same macros, parsing and expansion are skipped
+            _ast = cache_load(path, digest, deps)
+            rec.lap('load')
+            if _ast is None:
+                # we take the whole module, parse it
+                source = importlib.util.decode_source(data)
+                _ast = parse(source, path, 'exec')
+                rec.lap('parse')
+
+                # we look for global macros, use them on the module using their name
+                m = MacroVisitor(globals)
+                _ast = m.expand(_ast, source, path)
+                rec.lap('expand')
+
+                _ast = compile(_ast, path, 'exec')
+                if not m.volatile:
+                    cache_store(path, digest, deps, _ast)
+                rec.lap('compile')
+
+        try:
+            exec(_ast, globals, locals)
+        finally:
+            _ast = None
         return False
     # we are willing to execute the module body
     else:
@@ -266,20 +800,36 @@ def strip_decorators(src):
     return '\n'.join(src[i:])
 
 
-def compile_with_macros(globals, locals):
+def compile_with_macros(globals, locals, lazy=False):
+    """Expands the macros found in globals in the decorated function or class. With lazy, a function is only expanded
+    on its first call (see _LazyFunction).
+    """
     def _(f):
-        # if macros are enabled, it has already been compiled
+        # if macros are enabled, it has already been compiled. The import hook only expands the imported macros, the
+        # ones defined in the module still have to be
         if macros_enabled():
             return f
 
-        # get the ast from the source of the function
-        ast = parse(strip_decorators(inspect.getsource(f)))
+        if lazy and _LazyFunction.can_defer(f):
+            rec = _LazyFunction.of(f) or _LazyFunction(f, globals, {} if locals is globals else dict(locals))
+            rec.steps.append(('compile_with_macros',
+                              lambda ast, src: MacroVisitor(globals).expand(ast, src, source_file(f))))
+            return f
+
+        with profiling.record('compile_with_macros', '%s.%s' % (f.__module__, f.__qualname__)) as rec:
+            # get the ast from the source of the function
+            ast, src = definition_ast(f)
+            rec.lap('parse')
 
-        # we look for global macros, use them on the source using their name
-        m = MacroVisitor(globals)
-        ast = m.visit(ast)
+            # we look for global macros, use them on the source using their name
+            m = MacroVisitor(globals)
+            ast = m.expand(ast, src, source_file(f))
+            rec.lap('expand')
 
-        exec(compile(ast, f.__name__, 'exec'), globals, locals)
+            code = compile(ast, source_file(f), 'exec')
+            rec.lap('compile')
+
+        exec(code, globals, locals)
         return eval(f.__name__, globals, locals)
 
     return _
@@ -324,8 +874,8 @@ def unparse(tree):
     """We generate the python code from its AST
     """
     if isinstance(tree, list):
-        return [CodeGenerator().visit(t) for t in tree]
-    return CodeGenerator().visit(tree)
+        return [CodeGenerator().generate(t) for t in tree]
+    return CodeGenerator().generate(tree)
 
 
 def _ast_genast(tree, specific=None):
@@ -346,17 +896,120 @@ def _ast_genast(tree, specific=None):
         for e in tree:
             elems.append(ast_genast(e, specific))
         return List(elems, Load())
+    if isinstance(tree, tuple):
+        return Tuple([ast_genast(e, specific) for e in tree], Load())
+    if isinstance(tree, dict):
+        return Dict([ast_genast(k, specific) for k in tree], [ast_genast(v, specific) for v in tree.values()])
+    if isinstance(tree, set):
+        if not tree:
+            return Call(Name('set', Load()), [], [])
+        return Set([ast_genast(e, specific) for e in tree])
     if tree is None or tree is True or tree is False:
         return NameConstant(tree)
     if isinstance(tree, (int, float, complex)):
         return Num(tree)
     if isinstance(tree, str):
         return Str(tree)
+    if isinstance(tree, bytes):
+        return Bytes(tree)
     return tree
 
 def ast_genast(tree, specific=None):
     return _ast_genast(tree, specific)
 
+
+# ast_dumps lays a tree out as an array of integers, in prefix order: a node is the index of its class in a table
+# (which also lists the fields and attributes following it, so that a tree loads back into the AST classes of another
+# version), a list is _LIST followed by its length, and a constant the (negated) index in a table where equal
+# constants are stored once. Both tables and the array, of the narrowest type its integers fit in, are marshalled
+# together.
+_FORMAT = 1
+_NONE = -1
+_LIST = -2
+_CONST = -3
+_ast_classes = {}
+
+
+def ast_dumps(tree):
+    """Serializes tree (an AST node, a list of them, or a field value), locations included, to bytes that ast_loads
+    turns back into an equal tree. The constants must be marshallable: ValueError is raised otherwise."""
+    classes, layouts = [], {}
+    consts, const_ids = [], {}
+    tokens = []
+    append = tokens.append
+
+    def dump(value):
+        cls = value.__class__
+        if isinstance(value, AST):
+            layout = layouts.get(cls)
+            if layout is None:
+                layout = layouts[cls] = (len(classes), cls._fields + cls._attributes)
+                classes.append((cls.__module__, cls.__qualname__, cls._fields, cls._attributes))
+            append(layout[0])
+            for name in layout[1]:
+                dump(getattr(value, name, None))
+        elif cls is list:
+            append(_LIST)
+            append(len(value))
+            for v in value:
+                dump(v)
+        elif value is None:
+            append(_NONE)
+        else:
+            # 1, 1.0 and True are equal, 0.0 and -0.0 too
+            key = (cls, repr(value)) if cls is float or cls is complex else (cls, value)
+            i = const_ids.get(key)
+            if i is None:
+                i = const_ids[key] = len(consts)
+                consts.append(value)
+            append(_CONST - i)
+
+    dump(tree)
+    # the class and constant indices, and the list lengths
+    bound = max(max(tokens), -min(tokens))
+    typecode = next(c for c in 'bhiq' if bound < 1 << (8 * array(c).itemsize - 1))
+    return marshal.dumps((_FORMAT, classes, consts, typecode, array(typecode, tokens).tobytes()))
+
+
+def ast_loads(data):
+    """Builds back the tree serialized by ast_dumps"""
+    version, classes, consts, typecode, buf = marshal.loads(data)
+    if version != _FORMAT:
+        raise ValueError('unsupported AST serialization format %r' % (version,))
+    tokens = array(typecode)
+    tokens.frombytes(buf)
+    layouts = []
+    for module, qualname, fields, attributes in classes:
+        cls = _ast_classes.get((module, qualname))
+        if cls is None:
+            cls = importlib.import_module(module)
+            for name in qualname.split('.'):
+                cls = getattr(cls, name)
+            _ast_classes[module, qualname] = cls
+        layouts.append((cls, fields, attributes))
+    next_token = iter(tokens).__next__
+
+    def load():
+        t = next_token()
+        if t >= 0:
+            cls, fields, attributes = layouts[t]
+            node = cls()
+            d = node.__dict__
+            for name in fields:
+                d[name] = load()
+            for name in attributes:
+                v = load()
+                if v is not None:
+                    d[name] = v
+            return node
+        if t == _NONE:
+            return None
+        if t == _LIST:
+            return [load() for _ in range(next_token())]
+        return consts[_CONST - t]
+
+    return load()
+
 def comp_expr(ast, name=None):
     if name is None:
         name = unparse(ast)
@@ -367,6 +1020,121 @@ def comp_block(ast, name=None):
         name = unparse(ast)
     return compile(ast, '\n'.join(name), 'exec')
 
+#  ######   #######  ##     ## ########   ######  ########  ######
+# ##    ## ##     ## ##     ## ##     ## ##    ## ##       ##    ##
+# ##       ##     ## ##     ## ##     ## ##       ##       ##
+#  ######  ##     ## ##     ## ########  ##       ######    ######
+#       ## ##     ## ##     ## ##   ##   ##       ##             ##
+# ##    ## ##     ## ##     ## ##    ##  ##    ## ##       ##    ##
+#  ######   #######   #######  ##     ##  ######  ########  ######
+
+
+class SourceIndex:
+    """The definitions (functions and classes) of a source file, parsed once. The functions are found by the first
+    line of their code (co_firstlineno, the one of their first decorator), the classes by their qualified name.
+    """
+
+    def __init__(self, filename, lines):
+        self.filename = filename
+        self.lines = lines
+        self.source = ''.join(lines)
+        self.by_line = {}
+        self.by_qualname = {}
+        self._pickles = {}
+        self._index(parse(self.source, filename, 'exec'), '')
+
+    def _index(self, node, prefix):
+        for child in iter_child_nodes(node):
+            if isinstance(child, (FunctionDef, AsyncFunctionDef, ClassDef)):
+                qualname = prefix + child.name
+                self.by_qualname[qualname] = child
+                self.by_line[min([child.lineno] + [d.lineno for d in child.decorator_list])] = child
+                self._index(child, qualname + ('.' if isinstance(child, ClassDef) else '.<locals>.'))
+            else:
+                self._index(child, prefix)
+
+    def node(self, obj):
+        """The definition of obj (a function, its code, or a class), or None"""
+        code = getattr(obj, '__code__', obj)
+        if isinstance(code, CodeType):
+            node = self.by_line.get(code.co_firstlineno)
+            return node if node is not None and node.name == code.co_name else None
+        if isinstance(obj, type):
+            return self.by_qualname.get(obj.__qualname__)
+        return None
+
+    def definition(self, obj):
+        """A module made of a copy of the definition of obj, without its decorators, or None"""
+        node = self.node(obj)
+        if node is None:
+            return None
+        data = self._pickles.get(id(node))
+        if data is None:
+            decorators, node.decorator_list = node.decorator_list, []
+            data = self._pickles[id(node)] = pickle.dumps(node, pickle.HIGHEST_PROTOCOL)
+            node.decorator_list = decorators
+        module = parse('')
+        module.body.append(pickle.loads(data))
+        return module
+
+
+# the SourceIndexes of the files most recently looked up, least recently used first
+_source_indexes = collections.OrderedDict()
+_source_indexes_max = 32
+
+
+def source_index(obj):
+    """Returns the SourceIndex of the file obj (a function, its code, or a class) is defined in, or None. It is built
+    again when linecache sees that the file changed."""
+    try:
+        filename = inspect.getsourcefile(obj)
+    except TypeError:
+        return None
+    if filename is None:
+        return None
+    linecache.checkcache(filename)
+    module = getattr(obj, '__globals__', None) or getattr(sys.modules.get(getattr(obj, '__module__', None)),
+                                                          '__dict__', None)
+    lines = linecache.getlines(filename, module)
+    if not lines:
+        return None
+    index = _source_indexes.pop(filename, None)
+    if index is None or index.lines is not lines:
+        try:
+            index = SourceIndex(filename, lines)
+        except SyntaxError:
+            return None
+    _source_indexes[filename] = index
+    while len(_source_indexes) > _source_indexes_max:
+        _source_indexes.popitem(last=False)
+    return index
+
+
+def definition_ast(obj):
+    """Returns a module made of the definition of obj (a function, its code, or a class) without its decorators, and
+    the source its locations refer to. The source files are read and parsed once for all the definitions they hold
+    (see source_index), the definitions only found by inspect are parsed on their own.
+    """
+    index = source_index(obj)
+    ast = index.definition(obj) if index is not None else None
+    if ast is not None:
+        return ast, index.source
+    lines, first = inspect.getsourcelines(obj)
+    src = strip_decorators(''.join(lines))
+    # moved down to where the definition is found in its file, for the locations to be the ones of the file
+    src = '\n' * max(0, first - 1 + len(lines) - src.count('\n') - 1) + src
+    return parse(src, source_file(obj), 'exec'), src
+
+
+def source_file(obj):
+    """The file obj (a function, its code, or a class) is defined in, which the code expanded from its definition is
+    compiled as coming from"""
+    try:
+        return inspect.getsourcefile(obj) or inspect.getfile(obj)
+    except TypeError:
+        return '<{}>'.format(obj.__name__ if hasattr(obj, '__name__') else obj.co_name)
+
+
 #    ###     ######  ########    ##     ##  #######  ########  #### ######## #### ######## ########
 #   ## ##   ##    ##    ##       ###   ### ##     ## ##     ##  ##  ##        ##  ##       ##     ##
 #  ##   ##  ##          ##       #### #### ##     ## ##     ##  ##  ##        ##  ##       ##     ##
@@ -376,29 +1144,155 @@ def comp_block(ast, name=None):
 # ##     ##  ######     ##       ##     ##  #######  ########  #### ##       #### ######## ##     ##
 
 
-def ASTModifier(f):
-    """Makes a function taking one argument an AST modifier.
+def function_ast(f):
+    """Returns the module defining the function f: the one its AST modifiers produced, or the one parsed from its
+    source.
     """
-    def _(to_modify):
-        ast = getattr(to_modify, 'ast', None)
-        if ast is None:
-            src = strip_decorators(inspect.getsource(to_modify))
-            # now, we parse to get the AST
-            ast = parse(src, '<{}>'.format(to_modify.__name__), 'exec')
-
-        ast = f(ast)
-        exec(compile(ast, to_modify.__name__, 'exec'))
-        res = wraps(to_modify)(eval(to_modify.__name__))
-        res.ast = ast
-        return res
+    rec = _LazyFunction.of(f)
+    if rec is not None:
+        return rec.tree()[0]
+    ast = getattr(f, 'ast', None)
+    if ast is None:
+        ast, src = definition_ast(f)
+    return ast
 
-    return _
+
+def _trampoline(*args, _pyns_lazy=None, **kwargs):
+    return _pyns_lazy(args, kwargs)
+
+
+class _LazyFunction:
+    """The expansion a function waits for until its first call. Meanwhile, the function runs the code of _trampoline,
+    which finds it in its keyword defaults: the first call parses the source of the function, runs steps on it (pairs
+    of a kind and a function of the AST and the source), and compiles the result in globals, with locals as the local
+    namespace. The code of the result then replaces the one of the function, so that it stays the same object, and
+    the later calls do not go through the trampoline. When the result cannot lend its code (it needs a closure), the
+    trampoline keeps calling it instead. The calls racing the first one wait for its expansion.
+
+    Until then, the function has the signature of the trampoline, and the expansion errors are raised by its calls.
+    """
+
+    def __init__(self, function, globals, locals):
+        self.function = function
+        self.code, self.defaults, self.kwdefaults = function.__code__, function.__defaults__, function.__kwdefaults__
+        self.globals, self.locals = globals, locals
+        self.steps = []
+        self.keep_ast = False
+        self.target = None
+        self.lock = threading.RLock()
+        function.__code__ = _trampoline.__code__
+        function.__defaults__, function.__kwdefaults__ = None, {'_pyns_lazy': self}
+
+    @staticmethod
+    def can_defer(f):
+        # the code of the trampoline has no free variable, it cannot replace one that has
+        return isinstance(f, FunctionType) and f.__closure__ is None
+
+    @staticmethod
+    def of(f):
+        """The expansion f waits for, if any"""
+        if getattr(f, '__code__', None) is _trampoline.__code__:
+            return f.__kwdefaults__['_pyns_lazy']
+        return None
+
+    def tree(self, rec=profiling._no_record):
+        """The AST of the function, modified by the steps, and its source"""
+        ast, src = definition_ast(self.code)
+        rec.lap('parse')
+        for kind, step in self.steps:
+            ast = step(ast, src)
+        rec.lap('expand')
+        return ast, src
+
+    def __call__(self, args, kwargs):
+        with self.lock:
+            if self.target is None:
+                self.expand()
+        return self.target(*args, **kwargs)
+
+    def expand(self):
+        function, name = self.function, self.code.co_name
+        kinds = []
+        for kind, step in self.steps:
+            if kind not in kinds:
+                kinds.append(kind)
+        with profiling.record('lazy ' + '+'.join(kinds), '%s.%s' % (function.__module__, function.__qualname__)) as rec:
+            ast, src = self.tree(rec)
+            # the defaults have been evaluated along with the definition, unless the steps changed the parameters
+            fdef = ast.body[-1] if ast.body and isinstance(ast.body[-1], FunctionDef) else None
+            defaults = fdef is not None and fdef.name == name and _parameters(fdef.args) == self.parameters()
+            if defaults:
+                args = fdef.args
+                kept = args.defaults, args.kw_defaults
+                args.defaults = [locate(NameConstant(None), d) for d in args.defaults]
+                args.kw_defaults = [d and locate(NameConstant(None), d) for d in args.kw_defaults]
+            code = compile(ast, source_file(self.code), 'exec')
+            if defaults:
+                args.defaults, args.kw_defaults = kept
+            rec.lap('compile')
+        namespace = dict(self.locals)
+        exec(code, self.globals, namespace)
+        new = namespace[name]
+        if defaults:
+            new.__defaults__, new.__kwdefaults__ = self.defaults, self.kwdefaults
+        function.__dict__.update(new.__dict__)
+        if self.keep_ast:
+            function.ast = ast
+        if isinstance(new, FunctionType) and not new.__code__.co_freevars:
+            function.__code__ = new.__code__
+            function.__defaults__, function.__kwdefaults__ = new.__defaults__, new.__kwdefaults__
+            new = function
+        self.target = new
+
+    def parameters(self):
+        code = self.code
+        return (code.co_varnames[:code.co_argcount + code.co_kwonlyargcount],
+                bool(code.co_flags & inspect.CO_VARARGS), bool(code.co_flags & inspect.CO_VARKEYWORDS))
+
+
+def _parameters(args):
+    """The parameters of arguments, as _LazyFunction.parameters tells them"""
+    names = [a.arg for a in getattr(args, 'posonlyargs', []) + args.args + args.kwonlyargs]
+    return tuple(names), args.vararg is not None, args.kwarg is not None
+
+
+def ASTModifier(f=None, lazy=False):
+    """Makes a function taking one argument an AST modifier. With lazy, the functions it decorates are only modified
+    on their first call (see _LazyFunction): the lazy modifiers stacked on a function are run together.
+    """
+    def modifier(f):
+        def _(to_modify):
+            if lazy and _LazyFunction.can_defer(to_modify):
+                rec = _LazyFunction.of(to_modify) or _LazyFunction(to_modify, to_modify.__globals__, {})
+                rec.steps.append(('ASTModifier', lambda ast, src: f(ast)))
+                rec.keep_ast = True
+                return to_modify
+
+            with profiling.record('ASTModifier', '%s.%s' % (to_modify.__module__, to_modify.__qualname__)) as rec:
+                ast = f(function_ast(to_modify))
+                rec.lap('expand')
+                code = compile(ast, source_file(to_modify), 'exec')
+                rec.lap('compile')
+            # the new function lives in the module of the old one
+            namespace = {}
+            exec(code, to_modify.__globals__, namespace)
+            res = wraps(to_modify)(namespace[to_modify.__name__])
+            res.ast = ast
+            return res
+
+        return _
+
+    return modifier(f) if f is not None else modifier
 
 
 def no_ast(f):
     """removes the ast of a function when she has finished going through its modifiers
     """
-    delattr(f, 'ast')
+    rec = _LazyFunction.of(f)
+    if rec is not None:
+        rec.keep_ast = False
+    else:
+        delattr(f, 'ast')
     return f
 
 
@@ -411,137 +1305,567 @@ def no_ast(f):
 #  ######   #######  ########  ########     ######   ######## ##    ## ######## ##     ## ##     ##    ##     #######  ##     ##
 
 
-class CodeGenerator(NodeVisitor):
-
-    def shiftright(self,        nodes):             return '\n'.join('    '+l for n in nodes for l in self.visit(n).split('\n'))
-    def visit_or_None(self,     node):              return self.visit(node) if node is not None else ''  # Mostly for slices
-
-    def visit_Module(self,      node: Module):      return '\n'.join(self.visit(b) for b in node.body)
-    def visit_Import(self,      node: Import):      return 'import %s' % ', '.join((self.visit(n) for n in node.names))
-    def visit_ImportFrom(self,  node: ImportFrom):  return 'from %s%s import %s' % ('.'*node.level, node.module, ', '.join(self.visit(n) for n in node.names))
-    def visit_alias(self,       node: alias):       return '%s as %s' if node.asname else node.name
-    def visit_Assign(self,      node: Assign):      return '%s = %s' % (', '.join((self.visit(t) for t in node.targets)), self.visit(node.value))
-    def visit_With(self,        node: With):        return 'with %s:\n%s' % (', '.join(self.visit(n) for n in node.items), self.shiftright(node.body))
-    def visit_withitem(self,    node: withitem):    return '%s as %s' % (self.visit(node.context_expr), self.visit(node.optional_vars)) if node.optional_vars else self.visit(node.context_expr)
-
-    def visit_If(self, node: If):
-        ret = 'if %s:\n%s' % (self.visit(node.test), self.shiftright(node.body))
-        if not node.orelse:
-            return ret
-        return '%s\nelse:\n%s' % (ret, self.shiftright(node.orelse))
+# precedences of the expressions, from the loosest to the tightest binding
+_TUPLE, _YIELD, _TEST, _OR, _AND, _NOT, _CMP, _EXPR, _BOR, _BXOR, _BAND, _SHIFT, _ARITH, _TERM, _FACTOR, _POWER, \
+    _AWAIT, _ATOM = range(18)
 
-    def visit_While(self, node: While):
-        ret = 'while %s:\n%s' % (self.visit(node.test), self.shiftright(node.body))
-        if not node.orelse:
-            return ret
-        return '%s\nelse:\n%s' % (ret, self.shiftright(node.orelse))
-
-    def visit_For(self, node: For):
-        ret = 'for %s in %s:\n%s' % (self.visit(node.target), self.visit(node.iter), self.shiftright(node.body))
-        if not node.orelse:
-            return ret
-        return '%s\nelse:\n%s' % (ret, self.shiftright(node.orelse))
-
-    def visit_FunctionDef(self, node: FunctionDef):
-        ret = ''
-        for d in node.decorator_list:
-            ret += '@%s\n' % (self.visit(d))
-        ret += 'def %s(%s):\n%s' % (node.name, self.visit_arguments(node.args), self.shiftright(node.body))
-        return ret
+_binops = {
+    Add: ('+', _ARITH), Sub: ('-', _ARITH), Mult: ('*', _TERM), MatMult: ('@', _TERM), Div: ('/', _TERM),
+    Mod: ('%', _TERM), FloorDiv: ('//', _TERM), Pow: ('**', _POWER), LShift: ('<<', _SHIFT), RShift: ('>>', _SHIFT),
+    BitOr: ('|', _BOR), BitXor: ('^', _BXOR), BitAnd: ('&', _BAND),
+}
+_unaryops = {Invert: ('~', _FACTOR), Not: ('not ', _NOT), UAdd: ('+', _FACTOR), USub: ('-', _FACTOR)}
+_boolops = {And: (' and ', _AND), Or: (' or ', _OR)}
+_cmpops = {
+    Eq: ' == ', NotEq: ' != ', Lt: ' < ', LtE: ' <= ', Gt: ' > ', GtE: ' >= ', Is: ' is ', IsNot: ' is not ',
+    In: ' in ', NotIn: ' not in ',
+}
+_inf = '1e' + repr(sys.float_info.max_10_exp + 1)
 
-    def visit_arguments(self,   node: arguments):
-        lst = []
-        for i, a in enumerate(node.args):
-            a_str = self.visit(a)
-            if len(node.defaults) > i and node.defaults[i]:
-                a_str += '=%s' % self.visit(node.defaults[i])
-            lst.append(a_str)
 
-        if node.vararg:
-            lst.append('*%s' % self.visit(node.vararg))
+def _num(n):
+    return repr(n).replace('inf', _inf)
 
-        for i, kw in enumerate(node.kwonlyargs):
-            a_str = self.visit(kw)
 
-            if len(node.kw_defautls) > i and node.kw_defaults[i]:
-                a_str += '=%s' % self.visit(node.kw_defaults[i])
+class CodeGenerator(NodeVisitor):
+    """Generates the code of an AST into a single buffer. Statements are written at the indentation on top of the
+    stack, and expressions are only parenthesized where their precedence requires it, so that parsing the code gives
+    back the same tree.
+    """
 
-            lst.append(a_str)
+    def __init__(self):
+        self.out = io.StringIO()
+        self.write = self.out.write
+        self.indents = ['']
+        self.started = False
+
+    def generate(self, node):
+        self.visit(node)
+        return self.out.getvalue()
+
+    def fill(self, text=''):
+        """Begins a new line, at the current indentation"""
+        if self.started:
+            self.write('\n')
+        self.started = True
+        self.write(self.indents[-1])
+        self.write(text)
+
+    def block(self, body):
+        self.write(':')
+        self.indents.append(self.indents[-1] + '    ')
+        for stmt in body:
+            self.visit(stmt)
+        self.indents.pop()
+
+    def precedence(self, node):
+        cls = node.__class__
+        if cls is BinOp:
+            return _binops[node.op.__class__][1]
+        if cls is BoolOp:
+            return _boolops[node.op.__class__][1]
+        if cls is UnaryOp:
+            return _unaryops[node.op.__class__][1]
+        if cls is Compare:
+            return _CMP
+        if cls is IfExp or cls is Lambda:
+            return _TEST
+        if cls is Await:
+            return _AWAIT
+        return _ATOM
+
+    def expr(self, node, precedence=_TEST):
+        """Writes node, in parentheses if it binds looser than precedence"""
+        if self.precedence(node) < precedence:
+            self.write('(')
+            self.visit(node)
+            self.write(')')
+        else:
+            self.visit(node)
+
+    def items(self, nodes, precedence=_TEST, sep=', '):
+        for i, n in enumerate(nodes):
+            if i:
+                self.write(sep)
+            self.expr(n, precedence)
+
+    # statements
+
+    def visit_Module(self,      node: Module):      self.items(node.body, sep='')
+    def visit_Interactive(self, node: Interactive): self.items(node.body, sep='')
+    def visit_Expression(self,  node: Expression):  self.expr(node.body, _TUPLE)
+    def visit_Expr(self,        node: Expr):        self.fill(); self.expr(node.value, _YIELD)
+    def visit_Pass(self,        node: Pass):        self.fill('pass')
+    def visit_Break(self,       node: Break):       self.fill('break')
+    def visit_Continue(self,    node: Continue):    self.fill('continue')
+    def visit_Global(self,      node: Global):      self.fill('global %s' % ', '.join(node.names))
+    def visit_Nonlocal(self,    node: Nonlocal):    self.fill('nonlocal %s' % ', '.join(node.names))
+    def visit_Delete(self,      node: Delete):      self.fill('del '); self.items(node.targets, _TUPLE)
+    def visit_Import(self,      node: Import):      self.fill('import '); self.items(node.names)
+    def visit_ImportFrom(self,  node: ImportFrom):  self.fill('from %s%s import ' % ('.'*node.level, node.module or '')); self.items(node.names)
+    def visit_alias(self,       node: alias):       self.write('%s as %s' % (node.name, node.asname) if node.asname else node.name)
+
+    def visit_Assign(self, node: Assign):
+        self.fill()
+        for t in node.targets:
+            self.expr(t, _TUPLE)
+            self.write(' = ')
+        self.expr(node.value, _YIELD)
+
+    def visit_AugAssign(self, node: AugAssign):
+        self.fill()
+        self.expr(node.target, _TUPLE)
+        self.write(' %s= ' % _binops[node.op.__class__][0])
+        self.expr(node.value, _YIELD)
+
+    def visit_AnnAssign(self, node):
+        self.fill()
+        if not node.simple and isinstance(node.target, Name):
+            self.write('(%s)' % node.target.id)
+        else:
+            self.expr(node.target, _TUPLE)
+        self.write(': ')
+        self.expr(node.annotation)
+        if node.value is not None:
+            self.write(' = ')
+            self.expr(node.value, _YIELD)
+
+    def visit_Return(self, node: Return):
+        self.fill('return')
+        if node.value is not None:
+            self.write(' ')
+            self.expr(node.value, _TUPLE)
+
+    def visit_Raise(self, node: Raise):
+        self.fill('raise')
+        if node.exc is not None:
+            self.write(' ')
+            self.expr(node.exc)
+        if node.cause is not None:
+            self.write(' from ')
+            self.expr(node.cause)
+
+    def visit_Assert(self, node: Assert):
+        self.fill('assert ')
+        self.expr(node.test)
+        if node.msg is not None:
+            self.write(', ')
+            self.expr(node.msg)
 
-        if node.kwarg:
-            lst.append('**%s' % self.visit(node.kwarg))
+    def visit_If(self, node: If):
+        self.fill('if ')
+        self.expr(node.test)
+        self.block(node.body)
+        while len(node.orelse) == 1 and isinstance(node.orelse[0], If):
+            node = node.orelse[0]
+            self.fill('elif ')
+            self.expr(node.test)
+            self.block(node.body)
+        if node.orelse:
+            self.fill('else')
+            self.block(node.orelse)
 
-        return ', '.join(lst)
+    def visit_While(self, node: While):
+        self.fill('while ')
+        self.expr(node.test)
+        self.block(node.body)
+        if node.orelse:
+            self.fill('else')
+            self.block(node.orelse)
+
+    def visit_For(self, node: For, keyword='for '):
+        self.fill(keyword)
+        self.expr(node.target, _TUPLE)
+        self.write(' in ')
+        self.expr(node.iter, _TUPLE)
+        self.block(node.body)
+        if node.orelse:
+            self.fill('else')
+            self.block(node.orelse)
+
+    def visit_AsyncFor(self, node):
+        self.visit_For(node, 'async for ')
+
+    def visit_With(self, node: With, keyword='with '):
+        self.fill(keyword)
+        self.items(node.items)
+        self.block(node.body)
+
+    def visit_AsyncWith(self, node):
+        self.visit_With(node, 'async with ')
+
+    def visit_withitem(self, node: withitem):
+        self.expr(node.context_expr)
+        if node.optional_vars is not None:
+            self.write(' as ')
+            self.expr(node.optional_vars, _TUPLE)
+
+    def visit_Try(self, node: Try, keyword='except'):
+        self.fill('try')
+        self.block(node.body)
+        for h in node.handlers:
+            self.visit_ExceptHandler(h, keyword)
+        if node.orelse:
+            self.fill('else')
+            self.block(node.orelse)
+        if node.finalbody:
+            self.fill('finally')
+            self.block(node.finalbody)
+
+    def visit_TryStar(self, node):
+        self.visit_Try(node, 'except*')
+
+    def visit_ExceptHandler(self, node: ExceptHandler, keyword='except'):
+        self.fill(keyword)
+        if node.type is not None:
+            self.write(' ')
+            self.expr(node.type)
+        if node.name is not None:
+            self.write(' as %s' % node.name)
+        self.block(node.body)
+
+    def visit_Match(self, node):
+        self.fill('match ')
+        self.expr(node.subject, _TUPLE)
+        self.block(node.cases)
+
+    def visit_match_case(self, node):
+        self.fill('case ')
+        self.visit(node.pattern)
+        if node.guard is not None:
+            self.write(' if ')
+            self.expr(node.guard)
+        self.block(node.body)
+
+    def visit_MatchValue(self,      node):  self.expr(node.value)
+    def visit_MatchSingleton(self,  node):  self.write(repr(node.value))
+    def visit_MatchStar(self,       node):  self.write('*%s' % (node.name or '_'))
+
+    def visit_MatchOr(self, node):
+        for i, p in enumerate(node.patterns):
+            if i:
+                self.write(' | ')
+            if isinstance(p, MatchOr):
+                self.write('(')
+                self.visit(p)
+                self.write(')')
+            else:
+                self.visit(p)
+
+    def visit_MatchSequence(self, node):
+        self.write('[')
+        self.items(node.patterns)
+        self.write(']')
+
+    def visit_MatchMapping(self, node):
+        self.write('{')
+        for i, (k, p) in enumerate(zip(node.keys, node.patterns)):
+            if i:
+                self.write(', ')
+            self.expr(k)
+            self.write(': ')
+            self.visit(p)
+        if node.rest is not None:
+            self.write('%s**%s' % (', ' if node.keys else '', node.rest))
+        self.write('}')
+
+    def visit_MatchClass(self, node):
+        self.expr(node.cls, _ATOM)
+        self.write('(')
+        self.items(node.patterns)
+        for i, (k, p) in enumerate(zip(node.kwd_attrs, node.kwd_patterns)):
+            if i or node.patterns:
+                self.write(', ')
+            self.write('%s=' % k)
+            self.visit(p)
+        self.write(')')
+
+    def visit_MatchAs(self, node):
+        if node.pattern is None:
+            self.write(node.name or '_')
+            return
+        # a | b as c would bind a | (b as c)
+        self.write('(')
+        self.visit(node.pattern)
+        self.write(' as %s)' % node.name)
+
+    def visit_FunctionDef(self, node: FunctionDef, keyword='def '):
+        for d in node.decorator_list:
+            self.fill('@')
+            self.expr(d)
+        self.fill('%s%s(' % (keyword, node.name))
+        self.visit(node.args)
+        self.write(')')
+        if node.returns is not None:
+            self.write(' -> ')
+            self.expr(node.returns)
+        self.block(node.body)
+
+    def visit_AsyncFunctionDef(self, node):
+        self.visit_FunctionDef(node, 'async def ')
 
     def visit_ClassDef(self, node: ClassDef):
-        ret = ''
         for d in node.decorator_list:
-            ret += '@%s\n' % self.visit(d)
-
-        return '%sclass %s(%s):\n%s%s' % (ret, node.name, ', '.join(self.visit(b) for b in node.bases), self.shiftright(node.keywords), self.shiftright(node.body))
+            self.fill('@')
+            self.expr(d)
+        self.fill('class %s' % node.name)
+        if node.bases or node.keywords:
+            self.write('(')
+            self.items(node.bases + node.keywords)
+            self.write(')')
+        self.block(node.body)
+
+    def visit_arguments(self, node: arguments):
+        posonly = getattr(node, 'posonlyargs', [])
+        positional = posonly + node.args
+        defaults = [None] * (len(positional) - len(node.defaults)) + node.defaults
+        params = []
+        for i, (a, d) in enumerate(zip(positional, defaults)):
+            params.append((a, d))
+            if i == len(posonly) - 1:
+                params.append('/')
+        if node.vararg is not None or node.kwonlyargs:
+            params.append(('*', node.vararg))
+        params += zip(node.kwonlyargs, node.kw_defaults)
+        if node.kwarg is not None:
+            params.append(('**', node.kwarg))
+
+        for i, p in enumerate(params):
+            if i:
+                self.write(', ')
+            if p == '/':
+                self.write('/')
+            elif isinstance(p[0], str):
+                self.write(p[0])
+                if p[1] is not None:
+                    self.visit(p[1])
+            else:
+                self.visit(p[0])
+                if p[1] is not None:
+                    self.write('=')
+                    self.expr(p[1])
+
+    def visit_arg(self, node: arg):
+        self.write(node.arg)
+        if node.annotation is not None:
+            self.write(': ')
+            self.expr(node.annotation)
+
+    def visit_keyword(self, node: keyword):
+        if node.arg is None:
+            self.write('**')
+            self.expr(node.value, _EXPR)
+        else:
+            self.write('%s=' % node.arg)
+            self.expr(node.value)
+
+    # expressions
+
+    def visit_Name(self,        node: Name):        self.write(node.id)
+    def visit_NameConstant(self,node: NameConstant):self.write(repr(node.value))
+    def visit_Num(self,         node: Num):         self.write(_num(node.n))
+    def visit_Str(self,         node: Str):         self.write(repr(node.s))
+    def visit_Bytes(self,       node: Bytes):       self.write(repr(node.s))
+    def visit_Ellipsis(self,    node: Ellipsis):    self.write('...')
+    def visit_Starred(self,     node: Starred):     self.write('*'); self.expr(node.value, _EXPR)
+    def visit_List(self,        node: List):        self.write('['); self.items(node.elts); self.write(']')
+    def visit_Await(self,       node: Await):       self.write('await '); self.expr(node.value, _ATOM)
+    def visit_YieldFrom(self,   node: YieldFrom):   self.write('(yield from '); self.expr(node.value); self.write(')')
+    def visit_ListComp(self,    node: ListComp):    self.write('['); self.expr(node.elt); self.items(node.generators, sep=''); self.write(']')
+    def visit_SetComp(self,     node: SetComp):     self.write('{'); self.expr(node.elt); self.items(node.generators, sep=''); self.write('}')
+    def visit_GeneratorExp(self,node: GeneratorExp):self.write('('); self.expr(node.elt); self.items(node.generators, sep=''); self.write(')')
+
+    def visit_Constant(self, node):
+        value = node.value
+        if value is ...:
+            self.write('...')
+        elif isinstance(value, (int, float, complex)) and not isinstance(value, bool):
+            self.write(_num(value))
+        else:
+            self.write(('u' if getattr(node, 'kind', None) == 'u' else '') + repr(value))
+
+    def visit_Set(self, node: Set):
+        # {} would be a dict
+        self.write('{')
+        self.items(node.elts)
+        self.write('}' if node.elts else '*()}')
+
+    def visit_Tuple(self, node: Tuple):
+        self.write('(')
+        self.items(node.elts)
+        self.write(',)' if len(node.elts) == 1 else ')')
+
+    def visit_Dict(self, node: Dict):
+        self.write('{')
+        for i, (k, v) in enumerate(zip(node.keys, node.values)):
+            if i:
+                self.write(', ')
+            if k is None:
+                self.write('**')
+                self.expr(v, _EXPR)
+            else:
+                self.expr(k)
+                self.write(': ')
+                self.expr(v)
+        self.write('}')
+
+    def visit_DictComp(self, node: DictComp):
+        self.write('{')
+        self.expr(node.key)
+        self.write(': ')
+        self.expr(node.value)
+        self.items(node.generators, sep='')
+        self.write('}')
 
     def visit_comprehension(self, node: comprehension):
-        ret = 'for %s in %s' % (self.visit(node.target), self.visit(node.iter))
+        self.write(' async for ' if getattr(node, 'is_async', False) else ' for ')
+        self.expr(node.target, _TUPLE)
+        self.write(' in ')
+        self.expr(node.iter, _OR)
         for if_ in node.ifs:
-            ret = '%s if %s' % (ret, self.visit(if_))
-        return ret
-
-    def visit_IfExp(self,       node: IfExp):       return '(%s if %s else %s)' % (self.visit(node.body), self.visit(node.test), self.visit(node.orelse))
-    def visit_ListComp(self,    node: ListComp):    return '[%s %s]' % (self.visit(node.elt), ' '.join(self.visit(c) for c in node.generators))
-    def visit_GeneratorExp(self,node: GeneratorExp):return '(%s %s)' % (self.visit(node.elt), ' '.join(self.visit(c) for c in node.generators))
-    def visit_SetComp(self,     node: SetComp):     return '{%s %s}' % (self.visit(node.elt), ' '.join(self.visit(c) for c in node.generators))
-    def visit_DictComp(self,    node: DictComp):    return '{%s: %s %s}' % (self.visit(node.key), self.visit(node.value), ' '.join(self.visit(c) for c in node.generators))
-
-    def visit_arg(self,         node: arg):         return '%s:%s' % (node.arg, self.visit(node.annotation)) if node.annotation else node.arg
-    def visit_Return(self,      node: Return):      return 'return %s' % self.visit(node.value) if node.value else 'return'
-    def visit_Call(self,        node: Call):        return '%s(%s)' % (self.visit(node.func), ', '.join([self.visit(a) for a in node.args]+ [self.visit(kw) for kw in node.keywords]))
-    def visit_keyword(self,     node: keyword):     return '%s=%s' % (node.arg, self.visit(node.value))
-
-    def visit_Attribute(self,   node: Attribute):   return '%s.%s' % (self.visit(node.value), node.attr)
-    def visit_Subscript(self,   node: Subscript):   return '%s[%s]' % (self.visit(node.value), self.visit(node.slice))
-    def visit_Index(self,       node: Index):       return self.visit(node.value)
-    def visit_Slice(self,       node: Slice):       return '%s:%s:%s' % (self.visit_or_None(node.lower), self.visit_or_None(node.upper), self.visit_or_None(node.step))
-
-    def visit_List(self,        node: List):        return '[%s]' % (', '.join(self.visit(e) for e in node.elts))
-    def visit_Tuple(self,       node: Tuple):       return '(%s)' % (', '.join(self.visit(e) for e in node.elts)) if len(node.elts) != 1 else '(%s,)' % self.visit(node.elts[0])
-    def visit_Set(self,         node: Set):         return '{%s}' % (', '.join(self.visit(e) for e in node.elts))
-    def visit_Expr(self,        node: Expr):        return self.visit(node.value)
-    def visit_Str(self,         node: Str):         return '"%s"' % node.s
-    def visit_Name(self,        node: Name):        return '%s' % node.id
-    def visit_Num(self,         node: Num):         return '%d' % node.n
-
-    def visit_AugAssign(self,   node: AugAssign):   return '%s %s= %s' % (self.visit(node.target), self.visit(node.op), self.visit(node.value))
-
-    def visit_BinOp(self,       node: BinOp):       return '(%s %s %s)' % (self.visit(node.left), self.visit(node.op), self.visit(node.right))
-    def visit_Add(self,         node: Add):         return '+'
-    def visit_Sub(self,         node: Sub):         return '-'
-    def visit_Mult(self,        node: Mult):        return '*'
-    def visit_Mod(self,         node: Mod):         return '%'
-    def visit_Div(self,         node: Div):         return '/'
-    def visit_FloorDiv(self,    node: FloorDiv):    return '//'
-    def visit_LShift(self,      node: LShift):      return '<<'
-    def visit_RShift(self,      node: RShift):      return '>>'
-    def visit_MatMult(self,     node):              return '@'
-
-    def visit_BitAnd(self,      node: BitAnd):      return '&'
-    def visit_BitOr(self,       node: BitOr):       return '|'
-    def visit_BitXor(self,      node: BitXor):      return '^'
-
-    def visit_BoolOp(self,      node: BoolOp):      return '(%s)' % (' {} '.format(self.visit(node.op)).join(self.visit(v) for v in node.values))
-    def visit_And(self,         node: And):         return 'and'
-    def visit_Or(self,          node: Or):          return 'or'
-
-    def visit_Compare(self,     node: Compare):     return '(%s %s)' % (self.visit(node.left), ' '.join('%s %s' % (self.visit(op), self.visit(right)) for op, right in zip(node.ops, node.comparators)))
-    def visit_Eq(self,          node: Eq):          return '=='
-    def visit_NotEq(self,       node: NotEq):       return '!='
-    def visit_Gt(self,          node: Gt):          return '>'
-    def visit_GtE(self,         node: GtE):         return '>='
-    def visit_Lt(self,          node: Lt):          return '<'
-    def visit_LtE(self,         node: LtE):         return '<='
-    def visit_Is(self,          node: Is):          return 'is'
-    def visit_IsNot(self,       node: IsNot):       return 'is not'
-    def visit_In(self,          node: In):          return 'in'
-    def visit_NotIn(self,       node: NotIn):       return 'not in'
-
-    def visit_NameConstant(self,node: NameConstant):return str(node.value)
-    def visit_Global(self,      node: Global):      return 'global %s' % ', '.join(node.names)
+            self.write(' if ')
+            self.expr(if_, _OR)
+
+    def visit_Yield(self, node: Yield):
+        self.write('(yield')
+        if node.value is not None:
+            self.write(' ')
+            self.expr(node.value, _TUPLE)
+        self.write(')')
+
+    def visit_NamedExpr(self, node):
+        self.write('(')
+        self.expr(node.target, _ATOM)
+        self.write(' := ')
+        self.expr(node.value)
+        self.write(')')
+
+    def visit_Lambda(self, node: Lambda):
+        self.write('lambda')
+        a = node.args
+        if getattr(a, 'posonlyargs', None) or a.args or a.vararg or a.kwonlyargs or a.kwarg:
+            self.write(' ')
+            self.visit(a)
+        self.write(': ')
+        self.expr(node.body)
+
+    def visit_IfExp(self, node: IfExp):
+        self.expr(node.body, _OR)
+        self.write(' if ')
+        self.expr(node.test, _OR)
+        self.write(' else ')
+        self.expr(node.orelse)
+
+    def visit_BoolOp(self, node: BoolOp):
+        op, precedence = _boolops[node.op.__class__]
+        self.items(node.values, precedence + 1, op)
+
+    def visit_BinOp(self, node: BinOp):
+        op, precedence = _binops[node.op.__class__]
+        # ** is right associative, the other ones are left associative
+        if node.op.__class__ is Pow:
+            left, right = precedence + 1, _FACTOR
+        else:
+            left, right = precedence, precedence + 1
+        self.expr(node.left, left)
+        self.write(' %s ' % op)
+        self.expr(node.right, right)
+
+    def visit_UnaryOp(self, node: UnaryOp):
+        op, precedence = _unaryops[node.op.__class__]
+        self.write(op)
+        self.expr(node.operand, precedence)
+
+    def visit_Compare(self, node: Compare):
+        self.expr(node.left, _CMP + 1)
+        for op, right in zip(node.ops, node.comparators):
+            self.write(_cmpops[op.__class__])
+            self.expr(right, _CMP + 1)
+
+    def visit_Call(self, node: Call):
+        self.expr(node.func, _ATOM)
+        self.write('(')
+        self.items(node.args + node.keywords)
+        self.write(')')
+
+    def visit_Attribute(self, node: Attribute):
+        value = node.value
+        # 1.real would be read as a float
+        if isinstance(getattr(value, 'n', getattr(value, 'value', None)), int) and isinstance(value, (Num, Constant)):
+            self.write('(')
+            self.visit(value)
+            self.write(')')
+        else:
+            self.expr(value, _ATOM)
+        self.write('.%s' % node.attr)
+
+    def visit_Subscript(self, node: Subscript):
+        self.expr(node.value, _ATOM)
+        self.write('[')
+        s = node.slice
+        if isinstance(s, Tuple) and any(isinstance(e, Slice) for e in s.elts):
+            # since Python 3.9, slices are expressions, and a tuple of them can't have parentheses
+            self.items(s.elts)
+            if len(s.elts) == 1:
+                self.write(',')
+        else:
+            self.expr(s, _TUPLE)
+        self.write(']')
+
+    def visit_Index(self, node: Index):
+        self.expr(node.value, _TUPLE)
+
+    def visit_Slice(self, node: Slice):
+        if node.lower is not None:
+            self.expr(node.lower)
+        self.write(':')
+        if node.upper is not None:
+            self.expr(node.upper)
+        if node.step is not None:
+            self.write(':')
+            self.expr(node.step)
+
+    def visit_ExtSlice(self, node: ExtSlice):
+        self.items(node.dims)
+        if len(node.dims) == 1:
+            self.write(',')
+
+    def visit_JoinedStr(self, node: JoinedStr):
+        self.fstring(node.values)
+
+    def visit_FormattedValue(self, node: FormattedValue):
+        self.fstring([node])
+
+    def fstring(self, values):
+        """Writes the f-string made of values. Its expressions can't contain backslashes, nor its quotes: the quotes
+        are chosen among the ones the expressions don't use."""
+        parts = []
+        self.fstring_parts(values, parts)
+        code = ''.join(p for p, is_code in parts if is_code)
+        quote = next((q for q in ('\'', '"', "'''", '"""') if q not in code), "'")
+        self.write('f' + quote)
+        for p, is_code in parts:
+            if not is_code:
+                p = p.encode('unicode_escape').decode('ascii').replace(quote[0], '\\' + quote[0])
+            self.write(p)
+        self.write(quote)
+
+    def fstring_parts(self, values, parts):
+        """Appends to parts the (text, is_code) of the f-string made of values, text being escaped if not is_code"""
+        for v in values:
+            if isinstance(v, FormattedValue):
+                g = CodeGenerator()
+                # a lambda would end at the colon of the format spec
+                g.expr(v.value, _TEST + 1)
+                code = g.out.getvalue()
+                parts.append(('{ ' if code.startswith('{') else '{', False))
+                parts.append((code, True))
+                if v.conversion != -1:
+                    parts.append(('!%s' % chr(v.conversion), False))
+                if v.format_spec is not None:
+                    parts.append((':', False))
+                    self.fstring_parts(v.format_spec.values, parts)
+                parts.append(('}', False))
+            else:
+                s = v.s if isinstance(v, Str) else v.value
+                parts.append((s.replace('{', '{{').replace('}', '}}'), False))
@@ -1,5 +1,14 @@
 from .core import *
 from .matching import *
+from string import Formatter
+from _string import formatter_field_name_split
+from copy import deepcopy
+from types import FunctionType
+import ast as _ast
+import builtins
+import importlib.util
+import math
+import re
 
 
 class _Embedded(AST):
@@ -10,7 +19,7 @@ class _Embedded(AST):
 def u(node, container, transform, **kwargs):
     if not q.into:
         raise AssertionError('Cannot use the u macro without being in a quote')
-    with tmp_attr(q, intro=False):
+    with tmp_attr(q, into=False):
         return _Embedded(locate(transform(node), container))
 
 
@@ -18,7 +27,7 @@ def u(node, container, transform, **kwargs):
 def ast(node, container, transform, **kwargs):
     if not q.into:
         raise AssertionError('Cannot use the ast macro without being in a quote')
-    with tmp_attr(q, intro=False):
+    with tmp_attr(q, into=False):
         return _Embedded(locate(Call(Name('ast_genast', Load()), [transform(node)], []), container))
 
 
@@ -28,8 +37,9 @@ def _q_specific(node):
     return None
 
 
+# a quote is emitted as the constructor calls rebuilding it (see ast_genast): running them is cheaper than copying a
+# template built once, be it with pickle, ast_loads or deepcopy (see benchmarks/bench_macros.py)
 q = MacroMixer()
-q.into = False
 
 
 @q.register
@@ -46,27 +56,634 @@ def q(var, items, body, container, transform, **kwargs):
         return Assign(targets=[var], value=ast_genast(transform(body), _q_specific))
 
 
+# whether a quote is being expanded (set on the macro class the registrations return, that q now names)
+q.into = False
+
+
+def _field(name, container):
+    """The expression a replacement field of a format string refers to: a name, followed by attributes and indices.
+    The name is looked up when the string is formatted, like the ones of the code around it."""
+    first, rest = formatter_field_name_split(name)
+    if not isinstance(first, str) or not first.isidentifier():
+        raise MacroError('s: replacement fields must start with a name, not %r' % name, container)
+    value = Name(first, Load())
+    for is_attr, key in rest:
+        if is_attr:
+            value = Attribute(value, key, Load())
+        else:
+            value = Subscript(value, Index(Num(key) if isinstance(key, int) else Str(key)), Load())
+    return value
+
+
+def _interpolate(template, container):
+    """Parses template like str.format would, and returns the JoinedStr formatting it"""
+    values = []
+    try:
+        fields = list(Formatter().parse(template))
+    except ValueError as e:
+        raise MacroError('s: %s' % e, container)
+    for literal, name, spec, conversion in fields:
+        if literal:
+            values.append(Str(literal))
+        if name is None:
+            continue
+        if conversion not in (None, 's', 'r', 'a'):
+            raise MacroError('s: unknown conversion %r' % conversion, container)
+        values.append(FormattedValue(_field(name, container), ord(conversion) if conversion else -1,
+                                     _interpolate(spec, container) if spec else None))
+    return JoinedStr(values)
+
+
 @macro_inline
 @compile_with_macros(globals(), locals())
 def s(node, container, transform, **kwargs):
+    if isinstance(node, Str):
+        # the template is known: it is parsed once and for all, into an f-string
+        return _interpolate(node.s, container)
     return q[u[transform(node)].format(**locals())]
 
 
+_placeholder = re.compile(r'^_(?:[0-9]+|macro_args)$')
+
+
+def _bound_by(node):
+    """The names the parameters of node, a Lambda, bind"""
+    args = node.args
+    return {a.arg for a in args.args + args.kwonlyargs + [args.vararg, args.kwarg] if a is not None}
+
+
+def _placeholders(node, bound=frozenset()):
+    """Yields the placeholders (_0, _1, ... and _macro_args) node uses, except the ones its lambdas bind"""
+    if isinstance(node, Name):
+        if node.id not in bound and _placeholder.match(node.id):
+            yield node.id
+    elif isinstance(node, Lambda):
+        bound = bound | _bound_by(node)
+    for child in iter_child_nodes(node):
+        yield from _placeholders(child, bound)
+
+
 @macro_inline
 @instantiate
 @compile_with_macros(globals(), locals())
 class f(NodeTransformer):
     def __init__(self):
         self.var = m_dict(id__re=r'^\_[0-9]+$')
+        self.bound = frozenset()
 
     def visit_Name(self, node):
-        if self.var(node):
+        if self.var(node) and node.id not in self.bound:
             return locate(q[_macro_args[u[Num(int(node.id[1:]))]]], node)
         return self.generic_visit(node)
 
+    def visit_Lambda(self, node):
+        # the placeholders the nested f lambdas bind are theirs
+        with tmp_attr(self, bound=self.bound | _bound_by(node)):
+            return self.generic_visit(node)
+
     def __call__(self, node, container, transform, **kwargs):
-        # we convert the inner variables
-        value = self.visit(transform(node))
-        # we build the anonymous function
-        n = q[lambda *_macro_args: u[value]]
+        # we build the anonymous function first, for the macros of its body to know they are in it
+        n = transform(q[lambda *_macro_args: u[node]])
+        names = set(_placeholders(n.body))
+        if '_macro_args' in names:
+            # the arguments are used as a whole: we convert the inner variables to indices in them
+            return self.visit(n)
+        # otherwise, they get a parameter each, up to the last one used
+        n.args = q[lambda: None].args
+        n.args.args = [arg('_%d' % i, None) for i in range(max((int(name[1:]) + 1 for name in names), default=0))]
         return n
+
+
+def inlinable(f):
+    """Marks f, a function returning an expression of its arguments, as one the inline macro can substitute to its
+    calls from other modules. The functions of the module being expanded need no marker.
+    """
+    f.inlinable = True
+    return f
+
+
+_missing = object()
+
+
+def _inlined_def(name, visitor):
+    """Returns the definition of the function name refers to, if inline may substitute it, with the globals its code
+    runs in (None for the module being expanded)."""
+    module = visitor.scopes[0] if visitor.scopes and isinstance(visitor.scopes[0], Module) else None
+    if module is not None and visitor.scope_of(name) is module:
+        # defined once and for all in the module being expanded
+        defs = [s for s in module.body if isinstance(s, FunctionDef) and s.name == name]
+        if len(defs) != 1 or any(not (isinstance(d, Name) and d.id == 'inlinable') for d in defs[0].decorator_list):
+            return None, None
+        for n in walk(module):
+            if n is not defs[0] and (isinstance(n, Name) and n.id == name and not isinstance(n.ctx, Load)
+                                     or getattr(n, 'name', None) == name or isinstance(n, (Import, ImportFrom))
+                                     and any((a.asname or a.name) == name for a in n.names)):
+                return None, None
+        return defs[0], None
+    if visitor.scope_of(name) is not None:
+        return None, None
+    func = visitor.globals.get(name)
+    if isinstance(func, FunctionType) and (func.__globals__ is visitor.globals or getattr(func, 'inlinable', False)):
+        try:
+            tree = function_ast(func)
+        except (OSError, TypeError, SyntaxError):
+            # no source to copy
+            return None, None
+        defs = [s for s in tree.body if isinstance(s, FunctionDef) and s.name == func.__name__]
+        if len(defs) == 1:
+            return defs[0], func.__globals__
+    return None, None
+
+
+def _inlined_expr(fdef):
+    """Returns the expression fdef returns, if it is all it does, and its parameters do not need more than binding"""
+    args = fdef.args
+    if args.vararg or args.kwarg or args.kwonlyargs or getattr(args, 'posonlyargs', None):
+        return None
+    body = fdef.body[1:] if isinstance(fdef.body[0], Expr) and isinstance(fdef.body[0].value, Str) else fdef.body
+    if len(body) != 1 or not isinstance(body[0], Return) or body[0].value is None:
+        return None
+    # nothing binding names, or making a generator out of the caller
+    if any(isinstance(n, _binding) for n in walk(body[0].value)):
+        return None
+    return body[0].value
+
+
+_binding = tuple(getattr(_ast, n) for n in ['Lambda', 'ListComp', 'SetComp', 'DictComp', 'GeneratorExp', 'Yield',
+                                            'YieldFrom', 'Await', 'NamedExpr'] if hasattr(_ast, n))
+
+
+def _trivial(node):
+    """Whether evaluating node once, many times or never makes no difference"""
+    if isinstance(node, UnaryOp) and isinstance(node.op, (USub, UAdd)):
+        node = node.operand
+    return isinstance(node, (Num, Str, Bytes, NameConstant, Ellipsis)) \
+        or isinstance(node, Name) and isinstance(node.ctx, Load)
+
+
+def _inline_call(call, visitor):
+    """Returns the expression call can be replaced by, or None when substituting it is not safe"""
+    if not isinstance(call.func, Name):
+        return None
+    fdef, func_globals = _inlined_def(call.func.id, visitor)
+    expr = None if fdef is None else _inlined_expr(fdef)
+    if expr is None:
+        return None
+
+    # binds the arguments like a call would. The defaults are evaluated where the function is defined: only the
+    # constant ones can be used anywhere else
+    params = [a.arg for a in fdef.args.args]
+    if len(call.args) > len(params) or any(isinstance(a, Starred) for a in call.args):
+        return None
+    values = dict(zip(params, call.args))
+    for k in call.keywords:
+        if k.arg is None or k.arg not in params or k.arg in values:
+            return None
+        values[k.arg] = k.value
+    defaults = dict(zip(params[len(params) - len(fdef.args.defaults):], fdef.args.defaults))
+    for p in params:
+        if p not in values:
+            if p not in defaults or isinstance(defaults[p], Name):
+                return None
+            values[p] = defaults[p]
+    if not all(_trivial(v) for v in values.values()):
+        return None
+
+    # the other names must mean at the call site what they mean in the function
+    for n in walk(expr):
+        if isinstance(n, Name) and n.id not in values:
+            scope = visitor.scope_of(n.id)
+            if func_globals is None:
+                if scope is not None and scope is not visitor.scopes[0]:
+                    return None
+            elif scope is not None or visitor.globals.get(n.id, _missing) is not func_globals.get(n.id, _missing):
+                return None
+
+    class Substitute(NodeTransformer):
+        def visit_Name(self, node):
+            if node.id in values:
+                return copy_location(deepcopy(values[node.id]), node)
+            return node
+
+    return Substitute().visit(deepcopy(expr))
+
+
+@macro_inline
+def inline(node, container, transform, visitor, **kwargs):
+    """inline[expr] substitutes to the calls expr makes to small functions (see inlinable) the expression they return,
+    with their arguments in place of their parameters. The arguments have to be names or constants, and the names
+    the function uses must mean the same thing where it is called; otherwise, the call is left as it is.
+    """
+    class Inliner(NodeTransformer):
+        def visit_Call(self, call):
+            self.generic_visit(call)
+            inlined = _inline_call(call, visitor)
+            return call if inlined is None else locate(inlined, call)
+
+    return Inliner().visit(transform(node))
+
+
+# the builtins returning the same thing for the same arguments, without side effects
+_pure_builtins = frozenset([
+    'abs', 'all', 'any', 'bin', 'bool', 'bytes', 'chr', 'complex', 'dict', 'divmod', 'enumerate', 'float', 'hex',
+    'int', 'len', 'list', 'max', 'min', 'oct', 'ord', 'pow', 'range', 'repr', 'reversed', 'round', 'set', 'sorted',
+    'str', 'sum', 'tuple', 'zip',
+])
+_pure_nodes = tuple(getattr(_ast, n) for n in [
+    'Num', 'Str', 'Bytes', 'NameConstant', 'Constant', 'Ellipsis', 'JoinedStr', 'FormattedValue', 'Tuple', 'List',
+    'Set', 'Dict', 'BinOp', 'UnaryOp', 'BoolOp', 'Compare', 'IfExp', 'Subscript', 'Index', 'Slice', 'ExtSlice',
+    'Starred', 'Call', 'keyword', 'ListComp', 'SetComp', 'DictComp', 'GeneratorExp', 'comprehension',
+    'expr_context', 'operator', 'unaryop', 'boolop', 'cmpop',
+] if hasattr(_ast, n))
+_literals = (type(None), bool, int, float, complex, str, bytes)
+
+
+def _is_literal(value):
+    if isinstance(value, _literals):
+        return True
+    if isinstance(value, (tuple, list, set)):
+        return all(_is_literal(v) for v in value)
+    if isinstance(value, dict):
+        return all(_is_literal(k) and _is_literal(v) for k, v in value.items())
+    return False
+
+
+def _written(name, visitor):
+    """The literal the module being expanded binds name to, if it does it once, at its top level, else None"""
+    module = visitor.scopes[0] if visitor.scopes and isinstance(visitor.scopes[0], Module) else None
+    if module is None:
+        return None
+    assigns = [s for s in module.body if isinstance(s, Assign) and len(s.targets) == 1
+               and isinstance(s.targets[0], Name) and s.targets[0].id == name]
+    if len(assigns) != 1:
+        return None
+    try:
+        _ast.literal_eval(assigns[0].value)
+    except ValueError:
+        return None
+    target = assigns[0].targets[0]
+    for n in walk(module):
+        if isinstance(n, Name):
+            rebound = n.id == name and not isinstance(n.ctx, Load) and n is not target
+        elif isinstance(n, Global):
+            rebound = name in n.names
+        elif isinstance(n, (Import, ImportFrom)):
+            rebound = any((a.asname or a.name).split('.')[0] == name for a in n.names)
+        else:
+            # functions, classes and exception handlers
+            rebound = getattr(n, 'name', None) == name
+        if rebound:
+            return None
+    return assigns[0].value
+
+
+def _global_value(name, visitor):
+    """The value name has while expanding, if it refers to a literal or math (see _evaluate), else _missing. A value
+    the source of the module does not tell makes the expansion volatile (see MacroVisitor)."""
+    scope = visitor.scope_of(name)
+    if scope is not None and not isinstance(scope, Module):
+        return _missing
+    value = visitor.globals.get(name, _missing)
+    if value is _missing and name in _pure_builtins and (scope is None or name not in visitor.bound_names(scope)):
+        return getattr(builtins, name)
+    if value is _missing and scope is not None and any(
+            isinstance(s, Import) and any(a.name == 'math' and (a.asname or a.name) == name for a in s.names)
+            for s in scope.body):
+        # imported by the module being expanded, before it runs
+        return math
+    if value is math:
+        return value
+    if value is _missing and scope is not None:
+        # the module runs after its expansion under the import hook: the source tells the value
+        written = _written(name, visitor)
+        if written is not None:
+            return _ast.literal_eval(written)
+    if value is not _missing and _is_literal(value):
+        if _written(name, visitor) is None:
+            # imported, or computed: it may change while the source and the macros do not
+            visitor.volatile = True
+        return value
+    return _missing
+
+
+def _impure(node, visitor, namespace, bound=frozenset()):
+    """Returns the first node of the expression node that cannot be evaluated while expanding, or None. The globals
+    it refers to are put in namespace."""
+    if isinstance(node, Name):
+        if node.id in bound or not isinstance(node.ctx, Load):
+            return None
+        value = _global_value(node.id, visitor)
+        if value is _missing:
+            return node
+        namespace[node.id] = value
+        return None
+    if isinstance(node, Attribute):
+        # the functions and constants of math
+        if isinstance(node.value, Name) and _global_value(node.value.id, visitor) is math \
+                and not node.attr.startswith('_'):
+            namespace[node.value.id] = math
+            return None
+        return node
+    if not isinstance(node, _pure_nodes):
+        return node
+    if isinstance(node, Call) and not (isinstance(node.func, Name) and node.func.id in _pure_builtins
+                                       or isinstance(node.func, Attribute)):
+        return node
+    if isinstance(node, (ListComp, SetComp, DictComp, GeneratorExp)):
+        bound = bound | {n.id for g in node.generators for n in walk(g.target) if isinstance(n, Name)}
+    for child in iter_child_nodes(node):
+        impure = _impure(child, visitor, namespace, bound)
+        if impure is not None:
+            return impure
+    return None
+
+
+def _evaluate(node, visitor, macro):
+    """Evaluates the expression node while expanding. Only literals, the pure builtins, math and the globals bound to
+    literals can be used in it: MacroError is raised otherwise, or if the evaluation fails."""
+    namespace = {}
+    impure = _impure(node, visitor, namespace)
+    if impure is not None:
+        raise MacroError('%s: %s cannot be evaluated while expanding' % (macro, unparse(impure)), impure)
+    namespace['__builtins__'] = {}
+    try:
+        return eval(compile(fix_missing_locations(Expression(deepcopy(node))), '<%s>' % macro, 'eval'), namespace)
+    except Exception as e:
+        raise MacroError('%s: %s raised %s: %s' % (macro, unparse(node), e.__class__.__name__, e), node)
+
+
+def _literal(value, node, macro):
+    """The expression evaluating to value, located at node"""
+    if not _is_literal(value):
+        raise MacroError('%s: %r is not a literal' % (macro, value), node)
+    return locate(ast_genast(value), node)
+
+
+@macro_inline
+def const(node, container, transform, visitor, **kwargs):
+    """const[expr] evaluates expr while expanding, and puts its value in its place. See _evaluate for what expr can
+    use, its value has to be made of literals (tuples, lists, sets and dicts included).
+    """
+    return _literal(_evaluate(transform(node), visitor, 'const'), container, 'const')
+
+
+def _check_unroll(nodes, names, nested=False):
+    """Raises MacroError if the body of a loop over names cannot be repeated with their values in their place. nested
+    tells whether nodes are in the body of a loop nested in it."""
+    for n in nodes:
+        if isinstance(n, (Break, Continue)) and not nested:
+            raise MacroError('unroll: cannot unroll a loop using %s' % n.__class__.__name__.lower(), n)
+        if isinstance(n, Name) and n.id in names and not isinstance(n.ctx, Load):
+            raise MacroError('unroll: %s is assigned in the loop' % n.id, n)
+        if isinstance(n, (FunctionDef, AsyncFunctionDef, ClassDef, Lambda)):
+            # would see the last value, not the current one
+            if any(isinstance(m, Name) and m.id in names for m in walk(n)):
+                raise MacroError('unroll: %s is used by a function defined in the loop' % ', '.join(names), n)
+        elif isinstance(n, (For, AsyncFor, While)):
+            # the break and continue statements of their bodies are theirs
+            _check_unroll(n.body, names, True)
+            _check_unroll([c for c in iter_child_nodes(n) if c not in n.body], names, nested)
+        else:
+            _check_unroll(iter_child_nodes(n), names, nested)
+
+
+def _unroll(loop, visitor):
+    """The statements loop runs, one copy of its body per value of its iterable"""
+    target = loop.target
+    names = [target.id] if isinstance(target, Name) else [getattr(e, 'id', None) for e in getattr(target, 'elts', [])]
+    if not names or None in names:
+        raise MacroError('unroll: loops can only assign names', target)
+    values = list(_evaluate(loop.iter, visitor, 'unroll'))
+
+    _check_unroll(loop.body, names)
+
+    class Substitute(NodeTransformer):
+        def visit_Name(self, node):
+            if node.id in self.values:
+                return _literal(self.values[node.id], node, 'unroll')
+            return node
+
+    result = []
+    substitute = Substitute()
+    for value in values:
+        if len(names) == 1 and isinstance(target, Name):
+            substitute.values = {names[0]: value}
+        else:
+            if not isinstance(value, (tuple, list)) or len(value) != len(names):
+                raise MacroError('unroll: cannot assign %r to %s' % (value, unparse(target)), target)
+            substitute.values = dict(zip(names, value))
+        result.extend(substitute.visit(deepcopy(s)) for s in loop.body)
+    if values:
+        # the loop variables keep their last value
+        result.append(locate(Assign([deepcopy(target)], _literal(values[-1], loop, 'unroll')), loop))
+    result.extend(loop.orelse)
+    return result
+
+
+@macro_block
+def unroll(var, items, body, container, transform, visitor, **kwargs):
+    """with unroll: followed by for loops over constant iterables (see const) repeats the body of each loop for each
+    value, with the loop variables replaced by it.
+    """
+    result = []
+    for loop in body:
+        if not isinstance(loop, For):
+            raise MacroError('unroll: only for loops can be unrolled', loop)
+        result.extend(_unroll(loop, visitor))
+    return transform(result)
+
+
+def vectorizable(indices, written, read, scalars=()):
+    """Returns numpy if the elementwise loop over the range indices, writing the arrays written, reading the ones read
+    and the values scalars, can run on whole arrays instead: the arrays all are one-dimensional NumPy arrays the indices
+    are within, the ones written do not overlap the others, and the scalars are numbers, which broadcast the way the
+    loop uses them. Returns None otherwise, or when NumPy is not available.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    if not indices or indices.start < 0 or indices.step < 0:
+        return None
+    last = indices[-1]
+    for a in written + read:
+        if not isinstance(a, numpy.ndarray) or a.ndim != 1 or last >= len(a):
+            return None
+    if not all(isinstance(v, (int, float, complex, numpy.number, numpy.bool_)) for v in scalars):
+        return None
+    for w in written:
+        if any(a is not w and numpy.may_share_memory(a, w) for a in written + read):
+            return None
+    return numpy
+
+
+def _indexed(var):
+    """Matches name[var]"""
+    index = m_inst(Name, id=var)
+    return m_inst(Subscript, value=m_inst(Name), slice=m_or(m_inst(Index, value=index), index))
+
+
+_range_loop = m_inst(For, target=m_inst(Name), orelse=m_len(0),
+                     iter=m_inst(Call, func=m_inst(Name, id='range'), args=lambda a: 1 <= len(a) <= 3,
+                                 keywords=m_len(0)))
+_ufuncs = frozenset(['sqrt', 'exp', 'log', 'log10', 'log2', 'log1p', 'expm1', 'sin', 'cos', 'tan', 'asin', 'acos',
+                     'atan', 'sinh', 'cosh', 'tanh', 'floor', 'ceil', 'trunc', 'fabs', 'atan2', 'hypot', 'copysign'])
+_numpy_names = {'asin': 'arcsin', 'acos': 'arccos', 'atan': 'arctan', 'atan2': 'arctan2'}
+_reductions = {Add: 'sum', Sub: 'sum', Mult: 'prod'}
+
+
+class _Vectorizer:
+    """Rewrites the elementwise expressions of a loop over var into expressions on whole arrays, or returns None"""
+
+    def __init__(self, var, visitor):
+        self.var = var
+        self.visitor = visitor
+        self.indexed = _indexed(var)
+        self.arrays = []
+        self.names = set()
+
+    def numpy(self, name, *args):
+        return Call(Attribute(Name('_pyns_np', Load()), name, Load()), list(args), [])
+
+    def expr(self, node):
+        if self.indexed(node):
+            if node.value.id not in self.arrays:
+                self.arrays.append(node.value.id)
+            return Subscript(Name(node.value.id, Load()), Index(Name('_pyns_s', Load())), Load())
+        if isinstance(node, Name):
+            if node.id == self.var:
+                return self.numpy('arange', *[Attribute(Name('_pyns_r', Load()), a, Load())
+                                              for a in ('start', 'stop', 'step')])
+            self.names.add(node.id)
+            return Name(node.id, Load())
+        if isinstance(node, (Num, NameConstant)):
+            return deepcopy(node)
+        if isinstance(node, (BinOp, UnaryOp, Compare, Call, IfExp)):
+            children = [self.expr(c) for c in (node.args if isinstance(node, Call) else iter_child_nodes(node))
+                        if isinstance(c, expr)]
+            if any(c is None for c in children):
+                return None
+            if isinstance(node, BinOp):
+                return BinOp(children[0], node.op, children[1])
+            if isinstance(node, UnaryOp):
+                if isinstance(node.op, Not):
+                    return self.numpy('logical_not', children[0])
+                return UnaryOp(node.op, children[0])
+            if isinstance(node, Compare):
+                return Compare(children[0], node.ops, children[1:]) if len(node.ops) == 1 else None
+            if isinstance(node, IfExp):
+                # both branches are computed, where picks in them
+                return self.numpy('where', *children)
+            return self.call(node, children)
+        return None
+
+    def builtin(self, name):
+        """Whether name is the builtin where the loop is. The globals tell what a star import of the module binds."""
+        scope = self.visitor.scope_of(name)
+        if scope is not None and (not isinstance(scope, Module) or name in self.visitor.bound_names(scope)):
+            return False
+        return name not in self.visitor.globals
+
+    def call(self, node, args):
+        func = node.func
+        if node.keywords or any(isinstance(a, Starred) for a in node.args):
+            return None
+        if isinstance(func, Attribute) and func.attr in _ufuncs and isinstance(func.value, Name) \
+                and _global_value(func.value.id, self.visitor) is math:
+            self.names.discard(func.value.id)
+            return self.numpy(_numpy_names.get(func.attr, func.attr), *args)
+        if isinstance(func, Name) and self.builtin(func.id):
+            if func.id == 'abs' and len(args) == 1:
+                return self.numpy('abs', *args)
+            if func.id in ('min', 'max') and len(args) == 2:
+                return self.numpy('minimum' if func.id == 'min' else 'maximum', *args)
+        return None
+
+    def body(self, stmts):
+        """The statements running stmts on whole arrays, or None"""
+        result = []
+        written, accumulators = set(), set()
+        for s in stmts:
+            if isinstance(s, Assign) and len(s.targets) == 1 and self.indexed(s.targets[0]):
+                value = self.expr(s.value)
+                written.add(s.targets[0].value.id)
+                target = Subscript(Name(s.targets[0].value.id, Load()), Index(Name('_pyns_s', Load())), Store())
+                result.append(Assign([target], value))
+            elif isinstance(s, AugAssign) and isinstance(s.target, Name) and s.op.__class__ in _reductions:
+                if s.target.id in accumulators:
+                    # t += a[i]; t *= b[i] interleaves the updates, which separate reductions do not
+                    return None
+                value = self.expr(s.value)
+                accumulators.add(s.target.id)
+                result.append(AugAssign(Name(s.target.id, Store()), s.op,
+                                        self.numpy(_reductions[s.op.__class__], value)))
+            else:
+                return None
+            if value is None:
+                return None
+        # the accumulators are only updated, the names only read, and the arrays only indexed by the loop variable
+        if self.names & (written | accumulators) or self.var in accumulators \
+                or set(self.arrays) & (self.names | accumulators) or written & accumulators:
+            return None
+        self.written = [a for a in self.arrays if a in written] + sorted(written - set(self.arrays))
+        self.scalars = sorted(self.names)
+        return result
+
+
+_guard = '''
+_pyns_r = range()
+_pyns_np = _pyns_vectorizable(_pyns_r, (), (), ())
+if _pyns_np is not None:
+    _pyns_s = _pyns_np.s_[_pyns_r.start:_pyns_r[-1] + 1:_pyns_r.step]
+'''
+
+
+def _vectorize(loop, visitor):
+    """The statements running loop on whole NumPy arrays when it can, and as it is otherwise, or None when its
+    shape is not the one of an elementwise map or reduction"""
+    if not _range_loop(loop):
+        return None
+    vectorizer = _Vectorizer(loop.target.id, visitor)
+    body = vectorizer.body(loop.body)
+    if body is None:
+        return None
+    template = parse(_guard).body
+    for n in walk(Module(template)):
+        copy_location(n, loop)
+    indices, guard, branch = template
+    indices.value.args = loop.iter.args
+    guard.value.args[1].elts = [locate(Name(a, Load()), loop) for a in vectorizer.written]
+    guard.value.args[2].elts = [locate(Name(a, Load()), loop) for a in vectorizer.arrays
+                                if a not in vectorizer.written]
+    guard.value.args[3].elts = [locate(Name(a, Load()), loop) for a in vectorizer.scalars]
+    # the loop variable ends up with its last value
+    body.append(Assign([Name(loop.target.id, Store())],
+                       Subscript(Name('_pyns_r', Load()), Index(UnaryOp(USub(), Num(1))), Load())))
+    branch.body.extend(locate(s, loop) for s in body)
+    loop.iter = locate(Name('_pyns_r', Load()), loop.iter)
+    branch.orelse = [loop]
+    return template
+
+
+@macro_block
+def vectorize(var, items, body, container, transform, visitor, **kwargs):
+    """with vectorize: runs the loops of the block that map or reduce NumPy arrays elementwise, like
+        for i in range(n):
+            out[i] = a[i] * b[i] + c
+            total += a[i]
+    as expressions on whole arrays, when the arrays they index and the names they read at run time allow it (see
+    vectorizable). Each variable is accumulated by a single statement. The other statements, and the loops of other
+    shapes, are left as they are, just like everything when NumPy is not available.
+    NumPy computes both branches of the conditional expressions, gives NaN or infinities where the loop would raise
+    (math domain errors, divisions by zero), and sums floats pairwise: reductions may differ in their last bits.
+    """
+    body = transform(body)
+    if importlib.util.find_spec('numpy') is None:
+        return body
+    result = [parse('from pyns.macros import vectorizable as _pyns_vectorizable').body[0]]
+    for n in walk(result[0]):
+        copy_location(n, container)
+    for s in body:
+        vectorized = isinstance(s, For) and _vectorize(s, visitor)
+        result.extend(vectorized or [s])
+    return result
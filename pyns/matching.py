@@ -2,62 +2,74 @@ from pyns.utils import *
 import re
 
 # a matcher is a function returning True or False to indicate whether the argument fits or not
+# the matchers built here also have a spec attribute describing them, which m_compile uses to generate a single
+# function out of a composition of matchers, and m_bind one returning what the m_capture matchers in it captured
+
+
+def _spec(spec, match):
+    match.spec = spec
+    return match
+
+
+def _expr(template, a, match):
+    """template is the Python expression computing match(x) from {x}, and {c}, the constant a"""
+    return _spec(('expr', template, a), match)
 
 
 def m_gt(a):
-    return lambda b: b > a
+    return _expr('{x} > {c}', a, lambda b: b > a)
 
 
 def m_ge(a):
-    return lambda b: b >= a
+    return _expr('{x} >= {c}', a, lambda b: b >= a)
 
 
 def m_lt(a):
-    return lambda b: b < a
+    return _expr('{x} < {c}', a, lambda b: b < a)
 
 
 def m_le(a):
-    return lambda b: b <= a
+    return _expr('{x} <= {c}', a, lambda b: b <= a)
 
 
 def m_is(a):
-    return lambda b: a is b
+    return _expr('{c} is {x}', a, lambda b: a is b)
 
 
 def m_nis(a):
-    return lambda b: a is not b
+    return _expr('{c} is not {x}', a, lambda b: a is not b)
 
 
 def m_eq(a):
-    return lambda b: a == b
+    return _expr('{c} == {x}', a, lambda b: a == b)
 
 
 def m_neq(a):
-    return lambda b: a != b
+    return _expr('{c} != {x}', a, lambda b: a != b)
 
 
 def m_len(a):
-    return lambda b: len(b) == a
+    return _expr('len({x}) == {c}', a, lambda b: len(b) == a)
 
 
 def m_inst(a, **kwargs):
     if len(kwargs) > 0:
         return m_and(m_inst(a), m_dict(**kwargs))
 
-    return lambda b: isinstance(b, a)
+    return _spec(('inst', a), lambda b: isinstance(b, a))
 
 
 def m_contains(a):
-    return lambda b: a in b
+    return _expr('{c} in {x}', a, lambda b: a in b)
 
 
 def m_ncontains(a):
-    return lambda b: a not in b
+    return _expr('{c} not in {x}', a, lambda b: a not in b)
 
 
 def m_regex(a, flags=0):
     p = re.compile(a, flags)
-    return lambda b: p.match(b)
+    return _expr('{c}({x})', p.match, lambda b: p.match(b))
 
 
 shortcuts = {
@@ -115,7 +127,7 @@ def m_dict(*, custom=True, self=None):
                         return False
                 return True
 
-        return match
+        return _spec(('dict', newd), match)
 
     if self is not None:
         _.gen = self
@@ -133,7 +145,7 @@ def m_and(*matchers):
                 return False
         return True
 
-    return match
+    return _spec(('and', matchers), match)
 
 
 def m_or(*matchers):
@@ -144,7 +156,7 @@ def m_or(*matchers):
 
         return False
 
-    return match
+    return _spec(('or', matchers), match)
 
 
 def m_all(matcher):
@@ -154,7 +166,7 @@ def m_all(matcher):
                 return False
         return True
 
-    return match
+    return _spec(('all', matcher), match)
 
 
 def m_any(matcher):
@@ -164,7 +176,7 @@ def m_any(matcher):
                 return True
         return False
 
-    return match
+    return _spec(('any', matcher), match)
 
 
 def m_atleast(n, matcher):
@@ -185,7 +197,29 @@ def m_store(lst, matcher):
             return True
         return False
 
-    return match
+    return _spec(('store', lst, matcher), match)
+
+
+def m_capture(name, matcher):
+    """Matches what matcher matches, capturing it as name in the bindings m_bind returns"""
+    return _spec(('capture', name, matcher), lambda a: matcher(a))
+
+
+def m_captures(matcher):
+    """Returns whether matcher captures anything (see m_capture)"""
+    spec = getattr(matcher, 'spec', None)
+    kind = spec[0] if spec is not None else None
+    if kind == 'capture':
+        return True
+    if kind in ('and', 'or'):
+        return any(m_captures(m) for m in spec[1])
+    if kind == 'dict':
+        return any(m_captures(m) for m in spec[1].values())
+    if kind in ('any', 'all'):
+        return m_captures(spec[1])
+    if kind == 'store':
+        return m_captures(spec[2])
+    return False
 
 
 def m_array(*args):
@@ -198,3 +232,245 @@ def m_array(*args):
         return True
 
     return match
+
+
+class _MatcherCompiler:
+    """Generates the source of one function per composition of and, dict and inst matchers, checking the attributes
+    one after the other and returning False as soon as one does not fit. Matchers without spec are called as is.
+
+    With bind, the functions also take the dict b the captures are put in. The branches of or, and the elements any
+    tries, put theirs in a dict of their own, only merged into b if they match: b only holds what the match captured.
+    The elements of all are captured one after the other, the last one wins.
+    """
+
+    def __init__(self, bind=False):
+        self.consts = {'_not_found': object()}
+        self.funcs = []
+        self.bind = bind
+
+    def const(self, value):
+        name = '_c%d' % len(self.consts)
+        self.consts[name] = value
+        return name
+
+    def function(self, matcher, known=None):
+        name = '_m%d' % len(self.funcs)
+        self.funcs.append(None)
+        self.nvars = 0
+        lines = ['def %s(x0, b):' % name if self.bind else 'def %s(x0):' % name]
+        self.emit(matcher, 'x0', lines, known)
+        lines.append('    return True')
+        self.funcs[int(name[2:])] = '\n'.join(lines)
+        return name
+
+    def var(self):
+        self.nvars += 1
+        return 'x%d' % self.nvars
+
+    def emit(self, matcher, x, lines, known):
+        """Appends to lines the checks of matcher on the variable x, whose class is known to be known, if not None.
+        Returns the class x is known to be afterwards.
+        """
+        spec = getattr(matcher, 'spec', None)
+        kind = spec[0] if spec is not None else None
+        if kind == 'inst':
+            lines.append('    if not isinstance(%s, %s): return False' % (x, self.const(spec[1])))
+            return spec[1] if isinstance(spec[1], type) else known
+        elif kind == 'expr':
+            lines.append('    if not (%s): return False' % spec[1].format(x=x, c=self.const(spec[2])))
+        elif kind == 'and':
+            for m in spec[1]:
+                known = self.emit(m, x, lines, known)
+        elif kind == 'dict':
+            for k, m in spec[1].items():
+                y = self.var()
+                if known is not None and not issubclass(known, dict):
+                    lines.append('    %s = getattr(%s, %r, _not_found)' % (y, x, k))
+                else:
+                    lines.append('    %s = %s.get(%r, _not_found) if isinstance(%s, dict) else getattr(%s, %r, _not_found)'
+                                 % (y, x, k, x, x, k))
+                self.emit(m, y, lines, None)
+        elif kind == 'or':
+            nvars = self.nvars
+            names = [self.function(m) for m in spec[1]]
+            self.nvars = nvars
+            if self.bind and m_captures(matcher):
+                lines.append('    for m in (%s,):' % ', '.join(names))
+                lines.append('        c = {}')
+                lines.append('        if m(%s, c): b.update(c); break' % x)
+                lines.append('    else: return False')
+            else:
+                lines.append('    if not (%s): return False' % ' or '.join('%s(%s%s)' % (n, x, self.b) for n in names))
+        elif kind in ('any', 'all'):
+            nvars = self.nvars
+            name = self.function(spec[1])
+            self.nvars = nvars
+            if kind == 'any' and self.bind and m_captures(spec[1]):
+                lines.append('    for e in %s:' % x)
+                lines.append('        c = {}')
+                lines.append('        if %s(e, c): b.update(c); break' % name)
+                lines.append('    else: return False')
+            elif kind == 'any':
+                lines.append('    for e in %s:' % x)
+                lines.append('        if %s(e%s): break' % (name, self.b))
+                lines.append('    else: return False')
+            else:
+                lines.append('    for e in %s:' % x)
+                lines.append('        if not %s(e%s): return False' % (name, self.b))
+        elif kind == 'store':
+            known = self.emit(spec[2], x, lines, known)
+            lines.append('    %s.append(%s)' % (self.const(spec[1]), x))
+        elif kind == 'capture':
+            known = self.emit(spec[2], x, lines, known)
+            if self.bind:
+                lines.append('    b[%r] = %s' % (spec[1], x))
+        else:
+            lines.append('    if not %s(%s): return False' % (self.const(matcher), x))
+        return known
+
+    @property
+    def b(self):
+        """The argument passing the bindings along"""
+        return ', b' if self.bind else ''
+
+
+def m_compile(matcher, cls=None):
+    """Turns a composition of matchers into a single function matching the same things, without going through the
+    closures of each of them. The source of the generated code is available as its source attribute.
+
+    If cls is given, the matched objects are known to be instances of it. Only compositions of and, or and dict
+    matchers are compiled, the other ones are returned as they are.
+    """
+    spec = getattr(matcher, 'spec', None)
+    if spec is None or spec[0] not in ('and', 'or', 'dict'):
+        return matcher
+    compiler = _MatcherCompiler()
+    name = compiler.function(matcher, cls)
+    source = '\n\n'.join(compiler.funcs)
+    namespace = dict(compiler.consts)
+    exec(compile(source, '<m_compile>', 'exec'), namespace)
+    match = namespace[name]
+    match.spec = spec
+    match.source = source
+    return match
+
+
+_not_found = object()
+
+
+def _discriminant(matcher):
+    """Returns a condition what matcher matches fulfills, as (path, values): the value found at path (a tuple of
+    attribute names, or keys, where None stands for any element of a list) is one of values. Returns None if there is
+    none to be found in its spec.
+    """
+    spec = getattr(matcher, 'spec', None)
+    kind = spec[0] if spec is not None else None
+    if kind == 'expr':
+        if spec[1] == '{c} == {x}':
+            try:
+                hash(spec[2])
+            except TypeError:
+                return None
+            return (), (spec[2],)
+    elif kind == 'and':
+        for m in spec[1]:
+            found = _discriminant(m)
+            if found is not None:
+                return found
+    elif kind == 'dict':
+        for k, m in spec[1].items():
+            found = _discriminant(m)
+            if found is not None:
+                return (k,) + found[0], found[1]
+    elif kind == 'any':
+        found = _discriminant(spec[1])
+        if found is not None:
+            return (None,) + found[0], found[1]
+    elif kind == 'or':
+        found = [_discriminant(m) for m in spec[1]]
+        if found and all(f is not None and f[0] == found[0][0] for f in found):
+            return found[0][0], tuple(v for f in found for v in f[1])
+    elif kind in ('store', 'capture'):
+        return _discriminant(spec[2])
+    return None
+
+
+def _values(x, path):
+    """The values found at path in x (see _discriminant)"""
+    for i, k in enumerate(path):
+        if k is None:
+            if not isinstance(x, (list, tuple)):
+                return ()
+            return [v for e in x for v in _values(e, path[i + 1:])]
+        x = x.get(k, _not_found) if isinstance(x, dict) else getattr(x, k, _not_found)
+        if x is _not_found:
+            return ()
+    return x,
+
+
+class MatcherTree:
+    """Finds the matchers, among many, an object may fit, without trying all of them. Each matcher is filed under a
+    condition it tests, when its spec tells one (see _discriminant): m_dict(value=m_inst(Name, id='q')) only matches
+    objects whose value.id is 'q'. The matchers of an object are then found with a lookup per path, in the tables
+    mapping the values found there to the matchers testing them, and the matchers without such a condition.
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.rest = []
+        self.size = 0
+
+    def add(self, matcher, value=None):
+        entry = (self.size, matcher, value)
+        self.size += 1
+        found = _discriminant(matcher)
+        if found is None:
+            self.rest.append(entry)
+        else:
+            path, keys = found
+            table = self.tables.setdefault(path, {})
+            for key in keys:
+                table.setdefault(key, []).append(entry)
+
+    def entries(self):
+        """The (index, matcher, value) of all the matchers, in the order they were added"""
+        entries = {e[0]: e for t in self.tables.values() for es in t.values() for e in es}
+        entries.update((e[0], e) for e in self.rest)
+        return sorted(entries.values(), key=lambda e: e[0])
+
+    def candidates(self, obj):
+        """The (index, matcher, value) of the matchers obj may fit, in the order they were added"""
+        found = []
+        for path, table in self.tables.items():
+            for key in _values(obj, path):
+                try:
+                    entries = table.get(key)
+                except TypeError:
+                    # unhashable, the condition cannot be looked up
+                    entries = [e for es in table.values() for e in es]
+                if entries:
+                    found.append(entries)
+        if self.rest:
+            found.append(self.rest)
+        if len(found) == 1:
+            return found[0]
+        return sorted({e[0]: e for entries in found for e in entries}.values(), key=lambda e: e[0])
+
+
+def m_bind(matcher, cls=None):
+    """Turns matcher into a function returning the dict of what its m_capture matchers captured (see m_capture), or
+    None if it does not match, in a single pass, and without any state shared between the calls. cls is as in
+    m_compile. The matchers without spec are called as they are, their captures are lost.
+    """
+    if getattr(matcher, 'spec', None) is None:
+        return lambda x: {} if matcher(x) else None
+    compiler = _MatcherCompiler(bind=True)
+    name = compiler.function(matcher, cls)
+    compiler.funcs.append('def match(x0):\n    b = {}\n    return b if %s(x0, b) else None' % name)
+    source = '\n\n'.join(compiler.funcs)
+    namespace = dict(compiler.consts)
+    exec(compile(source, '<m_bind>', 'exec'), namespace)
+    match = namespace['match']
+    match.spec = matcher.spec
+    match.source = source
+    return match
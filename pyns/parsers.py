@@ -1,5 +1,7 @@
 import re
-from collections import Iterable
+import mmap
+import threading
+from collections import Iterable, OrderedDict
 
 
 # a parser is a function of str, offset, returns (node, length)
@@ -101,6 +103,12 @@ class SugarParser:
 
         return parse
 
+    def memo(self):
+        return p_memo(self._parser)
+
+    def fuse(self):
+        return p_fuse(self._parser)
+
 
 _SugarParser = SugarParser
 
@@ -111,18 +119,32 @@ def desugarize(parser):
     return parser._parser if isinstance(parser, _SugarParser) else parser
 
 
+def _spec(parser, *spec):
+    """Records how parser was built on its raw function, for the passes rebuilding grammars (see p_fuse)"""
+    desugarize(parser).spec = spec
+    return parser
+
+
 class DeferredParser(SugarParser):
+    """A parser built on first use (or given later, through the parser attribute), to write recursive grammars.
+    Deferred parsers are memoized by packrat parsers (see p_memo), which makes left recursion through them terminate.
+    """
     def __init__(self, anon):
+        target = []
+
         def replace_and_parse(str, offset=0):
-            self._parser = p = anon()
-            return p(str, offset)
-        super(DeferredParser, self).__init__(replace_and_parse)
+            if not target:
+                target.append(desugarize(anon()))
+            return target[0](str, offset)
+
+        self._target = target
+        super(DeferredParser, self).__init__(_spec(p_memo(replace_and_parse), 'defer', target, anon)._parser)
 
     def __setattr__(self, key, value):
         if key == 'parser':
-            self._parser = value
+            self._target[:] = [desugarize(value)]
             return
-        return SugarParser.__setattr__(self, key, value)
+        return _SugarParser.__setattr__(self, key, value)
 
     @property
     def _(self):
@@ -146,7 +168,7 @@ def p_not(parser):
             return None, 0
         return None, -1
 
-    return parse
+    return _spec(parse, 'not', parser)
 
 # ########  ########  ######   ######## ##     ##
 # ##     ## ##       ##    ##  ##        ##   ##
@@ -168,7 +190,7 @@ def p_regex(regex, flags=0):
         match = match.group(0)
         return match, len(match)
 
-    return parse
+    return _spec(parse, 'regex', r)
 
 #  ######  ######## ########
 # ##    ##    ##    ##     ##
@@ -180,6 +202,18 @@ def p_regex(regex, flags=0):
 
 def p_str(s):
     """ p_str returns a parser that matches a string at the current offset """
+    if not isinstance(s, str):
+        # bytes-like inputs (memoryview, mmap) have no startswith, but can be matched by a regex
+        r = re.compile(re.escape(s))
+
+        @SugarParser
+        def parse(str, offset=0):
+            if r.match(str, offset) is None:
+                return None, -1
+            return s, len(s)
+
+        return _spec(parse, 'str', s)
+
     @SugarParser
     def parse(str, offset=0):
         if not str.startswith(s, offset):
@@ -187,7 +221,7 @@ def p_str(s):
         else:
             return s, len(s)
 
-    return parse
+    return _spec(parse, 'str', s)
 
 # ##     ## ##     ## ##       ########
 # ###   ### ##     ## ##          ##
@@ -198,7 +232,7 @@ def p_str(s):
 # ##     ##  #######  ########    ##
 
 def p_mult(parser, *, separator=p_regex(r'[\t\n ]*'), min_len=0):
-    parsers = desugarize(parsers)
+    parser = desugarize(parser)
     @SugarParser
     def parse(str, offset=0):
         nodes = []
@@ -221,7 +255,7 @@ def p_mult(parser, *, separator=p_regex(r'[\t\n ]*'), min_len=0):
             return None, -1
         return nodes, length
 
-    return parse
+    return _spec(parse, 'mult', parser, separator, min_len)
 
 #  #######  ########  ########
 # ##     ## ##     ##    ##
@@ -239,7 +273,7 @@ def p_opt(parser, node=None):
     @SugarParser
     def parse(str, offset=0):
         return node, 0
-    return p_or(parser, parse)
+    return _spec(p_or(parser, parse), 'opt', parser, node)
 
 
 #    ###    ##    ## ########
@@ -276,7 +310,7 @@ def p_and(*parsers, extract=None, keep=_all):
 
         return nodes if extract is None else nodes[extract], length
 
-    return parse
+    return _spec(parse, 'and', parsers, extract, keep)
 
 # ########  ##     ## ########     ###     ######  ########
 # ##     ## ##     ## ##     ##   ## ##   ##    ## ##
@@ -316,7 +350,7 @@ def p_phrase(*parsers, extract=None, keep=_all, wp=p_regex(r'[\t\n ]*')):
 
         return nodes if extract is None else nodes[extract], length
 
-    return parse
+    return _spec(parse, 'phrase', parsers, extract, keep, wp)
 
 #  #######  ########
 # ##     ## ##     ##
@@ -340,7 +374,7 @@ def p_or(*parsers):
             return n, l
         return None, -1
 
-    return parse
+    return _spec(parse, 'or', parsers)
 
 # ########  ######## ######## ######## ########
 # ##     ## ##       ##       ##       ##     ##
@@ -352,3 +386,382 @@ def p_or(*parsers):
 
 def p_defer(anon=None):
     return DeferredParser(anon)
+
+
+# ########     ###     ######  ##    ## ########     ###    ########
+# ##     ##   ## ##   ##    ## ##   ##  ##     ##   ## ##      ##
+# ##     ##  ##   ##  ##       ##  ##   ##     ##  ##   ##     ##
+# ########  ##     ## ##       #####    ########  ##     ##    ##
+# ##        ######### ##       ##  ##   ##   ##   #########    ##
+# ##        ##     ## ##    ## ##   ##  ##    ##  ##     ##    ##
+# ##        ##     ##  ######  ##    ## ##     ## ##     ##    ##
+
+class _Memo:
+    """The results of the memoized parsers on one input, by (parser, offset). Only the max_entries most recently used
+    ones are kept.
+
+    growing holds the (parser, offset) being computed: reaching one of them again means a left recursion. The results
+    computed from a seed that is still growing are not remembered, since they will change with it.
+    """
+    def __init__(self, text, max_entries):
+        self.text = text
+        self.max_entries = max_entries
+        self.table = OrderedDict()
+        self.growing = {}
+        self.stack = []
+        self.involved = set()
+
+    def recursion(self, key):
+        self.growing[key] = True
+        self.involved.update(self.stack[self.stack.index(key)+1:])
+
+
+class _Packrat(threading.local):
+    """The _Memo of the packrat parser running in the current thread, if any"""
+    memo = None
+
+
+_packrat = _Packrat()
+
+
+def p_memo(parser):
+    """
+        p_memo returns a parser remembering the results of parser when it runs under a packrat parser (see p_packrat),
+        and otherwise just calls it. A left recursion through it fails at first, then its result is grown as long as it
+        consumes more of the input.
+    """
+    parser = desugarize(parser)
+    @SugarParser
+    def parse(str, offset=0):
+        memo = _packrat.memo
+        if memo is None or memo.text is not str:
+            return parser(str, offset)
+
+        key = (parse, offset)
+        table = memo.table
+        if key in memo.growing:
+            memo.recursion(key)
+            return table.get(key, (None, -1))
+        res = table.get(key)
+        if res is not None:
+            table.move_to_end(key)
+            return res
+
+        memo.growing[key] = False
+        memo.stack.append(key)
+        try:
+            res = parser(str, offset)
+            if memo.growing[key]:
+                while res[1] >= 0:
+                    table[key] = res
+                    grown = parser(str, offset)
+                    if grown[1] <= res[1]:
+                        break
+                    res = grown
+        finally:
+            memo.stack.pop()
+            del memo.growing[key]
+
+        if key in memo.involved:
+            memo.involved.discard(key)
+            table.pop(key, None)
+        else:
+            table[key] = res
+            if len(table) > memo.max_entries:
+                table.popitem(last=False)
+        return res
+
+    return _spec(parse, 'memo', parser)
+
+
+def p_packrat(parser, max_entries=1 << 20):
+    """
+        p_packrat returns a parser running parser in packrat mode: the memoized parsers (p_memo, and the deferred ones)
+        it goes through remember their results on the input, so that no parser runs twice at the same offset.
+        At most max_entries results are kept at once.
+    """
+    parser = desugarize(parser)
+    @SugarParser
+    def parse(str, offset=0):
+        previous = _packrat.memo
+        if previous is not None and previous.text is str:
+            return parser(str, offset)
+        _packrat.memo = _Memo(str, max_entries)
+        try:
+            return parser(str, offset)
+        finally:
+            _packrat.memo = previous
+
+    return _spec(parse, 'packrat', parser, max_entries)
+
+
+# ######## ##     ##  ######  ####  #######  ##    ##
+# ##       ##     ## ##    ##  ##  ##     ## ###   ##
+# ##       ##     ## ##        ##  ##     ## ####  ##
+# ######   ##     ##  ######   ##  ##     ## ## ## ##
+# ##       ##     ##       ##  ##  ##     ## ##  ####
+# ##       ##     ## ##    ##  ##  ##     ## ##   ###
+# ##        #######   ######  ####  #######  ##    ##
+
+_anchors = ('^', '$', '\\A', '\\Z', '\\b', '\\B', '(?=', '(?!', '(?<')
+
+
+def _terminal(parser):
+    """
+        Returns (pattern, node) if parser can be part of a fused regex, None otherwise. pattern has no group, and node
+        tells how to get the result of parser back from the match: ('const', s) for p_str, ('text',) for the matched
+        text, and ('opt', inner node, default) for p_opt.
+    """
+    spec = getattr(parser, 'spec', None)
+    if spec is None:
+        return None
+    kind = spec[0]
+    if kind == 'str' and isinstance(spec[1], str):
+        return re.escape(spec[1]), ('const', spec[1])
+    if kind == 'regex':
+        r = spec[1]
+        if isinstance(r.pattern, str) and r.flags == re.UNICODE and r.groups == 0:
+            return r.pattern, ('text',)
+    if kind == 'opt':
+        inner = _terminal(desugarize(spec[1]))
+        if inner is not None and inner[1][0] != 'opt':
+            return inner[0], ('opt', inner[1], spec[2])
+    return None
+
+
+def _blank(parser):
+    """Whether parser is a terminal that matches anywhere, which makes it safe to fuse as a whitespace parser"""
+    spec = getattr(parser, 'spec', None)
+    if spec is None or spec[0] != 'regex' or _terminal(parser) is None:
+        return False
+    return spec[1].match('') is not None and not any(a in spec[1].pattern for a in _anchors)
+
+
+def _group(i, pattern, node):
+    # (?=(?P<g>...))(?P=g) is an atomic group: what it matched is never given back to the rest of the regex, like a
+    # parser result is never given back to the next parsers of a sequence
+    if node[0] == 'opt':
+        return '(?=(?P<g%d>(?P<o%d>%s)?))(?P=g%d)' % (i, i, pattern, i)
+    return '(?=(?P<g%d>%s))(?P=g%d)' % (i, pattern, i)
+
+
+def _node(match, i, node):
+    kind = node[0]
+    if kind == 'const':
+        return node[1]
+    if kind == 'text':
+        return match.group('g%d' % i)
+    if match.group('o%d' % i) is None:
+        return node[2]
+    return _node(match, i, node[1])
+
+
+def _p_fused(items, extract, keep):
+    """
+        Returns a parser for a sequence, as p_and does. items are (parser, kept) pairs, where kept tells whether the
+        node of parser is part of the sequence. Runs of terminals are matched by one regex.
+    """
+    steps = []
+    run = []
+
+    def flush():
+        if len(run) == 1:
+            steps.append((False, run[0][0], run[0][1]))
+        elif run:
+            r = re.compile(''.join(_group(i, t[0], t[1]) for i, (p, kept, t) in enumerate(run)))
+            steps.append((True, r.match, [(i, t[1]) for i, (p, kept, t) in enumerate(run) if kept]))
+        del run[:]
+
+    for p, kept in items:
+        t = _terminal(p)
+        if t is None:
+            flush()
+            steps.append((False, p, kept))
+        else:
+            run.append((p, kept, t))
+    flush()
+
+    def parse(str, offset=0):
+        nodes = []
+        length = 0
+        for fused, p, kept in steps:
+            if fused:
+                match = p(str, offset+length)
+                if match is None:
+                    return None, -1
+                for i, node in kept:
+                    nodes.append(_node(match, i, node))
+                length = match.end() - offset
+            else:
+                n, l = p(str, offset+length)
+                if l < 0:
+                    return None, -1
+                if kept:
+                    nodes.append(n)
+                length += l
+
+        if keep is not _all:
+            kept = [None for i in range(len(keep))]
+            for i, n in enumerate(nodes):
+                if i in keep:
+                    kept[keep.index(i)] = n
+            nodes = kept
+        return nodes if extract is None else nodes[extract], length
+
+    return parse
+
+
+class _Fuser:
+    """Rebuilds a grammar with its runs of terminals fused. done maps the parsers already seen to their rebuilt
+    version (keeping them alive), so that shared parsers stay shared and recursive grammars terminate."""
+    def __init__(self):
+        self.done = {}
+
+    def fuse(self, parser):
+        parser = desugarize(parser)
+        if id(parser) in self.done:
+            return self.done[id(parser)][1]
+        spec = getattr(parser, 'spec', None)
+        fused = parser if spec is None else getattr(self, 'fuse_' + spec[0], self.fuse_terminal)(parser, *spec[1:])
+        self.done[id(parser)] = (parser, fused)
+        return fused
+
+    def fuse_terminal(self, parser, *spec):
+        return parser
+
+    def rebuild(self, parser, children, build):
+        fused = [self.fuse(p) for p in children]
+        if all(f is p for f, p in zip(fused, children)):
+            return parser
+        return desugarize(build(*fused))
+
+    def fuse_not(self, parser, inner):
+        return self.rebuild(parser, [inner], p_not)
+
+    def fuse_opt(self, parser, inner, node):
+        return self.rebuild(parser, [inner], lambda p: p_opt(p, node))
+
+    def fuse_mult(self, parser, inner, separator, min_len):
+        return self.rebuild(parser, [inner, separator], lambda p, s: p_mult(p, separator=s, min_len=min_len))
+
+    def fuse_memo(self, parser, inner):
+        return self.rebuild(parser, [inner], p_memo)
+
+    def fuse_packrat(self, parser, inner, max_entries):
+        return self.rebuild(parser, [inner], lambda p: p_packrat(p, max_entries))
+
+    def fuse_defer(self, parser, target, anon):
+        if not target:
+            target.append(desugarize(anon()))
+        deferred = DeferredParser(None)
+        self.done[id(parser)] = (parser, deferred._parser)
+        deferred.parser = self.fuse(target[0])
+        return deferred._parser
+
+    def fuse_or(self, parser, children):
+        parsers = [self.fuse(p) for p in children]
+        terminals = [_terminal(p) for p in parsers]
+        if len(parsers) > 1 and all(t is not None and t[1][0] != 'opt' for t in terminals):
+            # the first alternative matching wins in a regex too, as long as nothing follows it
+            return desugarize(p_regex('|'.join('(?:%s)' % t[0] for t in terminals)))
+        return self.rebuild(parser, children, p_or)
+
+    def fuse_and(self, parser, children, extract, keep):
+        parsers = [self.fuse(p) for p in children]
+        if sum(_terminal(p) is not None for p in parsers) < 2:
+            return self.rebuild(parser, children, lambda *p: p_and(*p, extract=extract, keep=keep))
+        return _spec(_p_fused([(p, True) for p in parsers], extract, keep), 'fused')
+
+    def fuse_phrase(self, parser, children, extract, keep, wp):
+        parsers = [self.fuse(p) for p in children]
+        if not _blank(self.fuse(wp)):
+            # a whitespace parser that can fail ends the phrase early, which a fused regex can't do
+            return self.rebuild(parser, children + [wp],
+                                lambda *p: p_phrase(*p[:-1], extract=extract, keep=keep, wp=p[-1]))
+        items = []
+        for p in parsers:
+            items += [(self.fuse(wp), False), (p, True)]
+        return _spec(_p_fused(items, extract, keep), 'fused')
+
+
+def p_fuse(parser):
+    """
+        p_fuse returns parser with the sequences (p_and, p_phrase) of terminal parsers it is made of matched by a
+        single regex, as well as p_or of terminals. Terminals are p_str, p_regex without groups nor flags, and p_opt of
+        one of them. The resulting parser gives the same nodes and lengths, with fewer Python calls.
+    """
+    return SugarParser(_Fuser().fuse(parser))
+
+
+#  ######  ######## ########  ########    ###    ##     ##
+# ##    ##    ##    ##     ## ##         ## ##   ###   ###
+# ##          ##    ##     ## ##        ##   ##  #### ####
+#  ######     ##    ########  ######   ##     ## ## ### ##
+#       ##    ##    ##   ##   ##       ######### ##     ##
+# ##    ##    ##    ##    ##  ##       ##     ## ##     ##
+#  ######     ##    ##     ## ######## ##     ## ##     ##
+
+_buffers = (str, bytes, bytearray, memoryview, mmap.mmap)
+
+
+def parse_stream(parser, source, *, separator=None, window=1 << 20, chunk=1 << 16, lookahead=64):
+    """
+        parse_stream parses source as p_mult(parser, separator=separator) would, but yields the nodes one by one.
+
+        source is either a buffer (str, bytes, bytearray, memoryview or mmap), parsed in place, or something with a
+        read or a recv method (file, socket), read chunk by chunk. Only the unparsed part of what was read is kept, and
+        at most window characters of it: a node that needs more raises a ValueError.
+        A result is only trusted once lookahead characters past it have been read (or the input has ended), since the
+        parsers might have looked that far to decide what they match.
+        The separator defaults to whitespaces, of the type of the input (str or bytes).
+        A ValueError is raised if the input is not entirely parsed.
+    """
+    parser = desugarize(parser)
+    if isinstance(source, _buffers):
+        read = None
+        buf, eof = source, True
+    else:
+        read = getattr(source, 'read', None) or source.recv
+        buf = read(chunk)
+        eof = not buf
+    if separator is None:
+        separator = p_regex(r'[\t\n ]*' if isinstance(buf, str) else rb'[\t\n ]*')
+    separator = desugarize(separator)
+    base = 0  # position of buf in the input
+    offset = 0
+
+    def attempt(p):
+        nonlocal buf, eof, base, offset
+        while True:
+            n, l = p(buf, offset)
+            if eof or (l >= 0 and offset + l + lookahead < len(buf)):
+                return n, l
+            if len(buf) - offset >= window:
+                if l >= 0:
+                    return n, l
+                raise ValueError('nothing parsed at %d within a window of %d' % (base + offset, window))
+            buf, base, offset = buf[offset:], base + offset, 0
+            data = read(chunk)
+            if data:
+                buf += data
+            else:
+                eof = True
+
+    while True:
+        n, l = attempt(parser)
+        if l < 0:
+            break
+        yield n
+        offset += l
+
+        w, wl = attempt(separator)
+        if wl < 0:
+            break
+        offset += wl
+        if l + wl == 0:
+            if offset == len(buf) and eof:
+                break
+            raise ValueError('parser matched nothing at %d' % (base + offset))
+
+    if offset < len(buf):
+        raise ValueError('cannot parse at %d' % (base + offset))
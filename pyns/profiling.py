@@ -0,0 +1,225 @@
+from ast import AST, walk
+from contextlib import contextmanager
+from time import perf_counter
+
+
+# while a profile is active, the macro visitors built report to it how their matchers and macros are doing, and
+# with_macros, compile_with_macros and the import hook how long they spend parsing, expanding and compiling
+
+
+# ########  ########   #######  ######## #### ##       ########
+# ##     ## ##     ## ##     ## ##        ##  ##       ##
+# ##     ## ##     ## ##     ## ##        ##  ##       ##
+# ########  ########  ##     ## ######    ##  ##       ######
+# ##        ##   ##   ##     ## ##        ##  ##       ##
+# ##        ##    ##  ##     ## ##        ##  ##       ##
+# ##        ##     ##  #######  ##       #### ######## ########
+
+
+class MacroStats:
+    """What a macro cost: its matchers ran attempts times, and matched hits times. instr_time only counts the time
+    spent in the instrumentation of the macro itself, not in the expansion of the macros nested in its site."""
+
+    def __init__(self, name):
+        self.name = name
+        self.attempts = 0
+        self.hits = 0
+        self.match_time = 0.
+        self.instr_time = 0.
+        self.nodes = 0
+
+    @property
+    def cost(self):
+        return self.match_time + self.instr_time
+
+
+class Record:
+    """The time spent in each phase (parse, expand, compile, or load for a cache hit) of the expansion of a module or
+    a function."""
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.times = {}
+
+    @property
+    def cost(self):
+        return sum(self.times.values())
+
+    def __enter__(self):
+        self._last = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def lap(self, phase):
+        """Ends phase, which has begun at the previous lap"""
+        now = perf_counter()
+        self.times[phase] = self.times.get(phase, 0.) + now - self._last
+        self._last = now
+
+
+class _NoRecord:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def lap(self, phase):
+        pass
+
+
+_no_record = _NoRecord()
+
+
+class Profile:
+    """The statistics gathered while active (see profile): macros maps the macro names to their MacroStats (the
+    macros of a MacroMixer are reported as "name/Macro"), records lists the Records of the expansions, and sites maps
+    (file, line, macro) to the time spent expanding it there, nested sites included.
+    """
+
+    def __init__(self):
+        self.macros = {}
+        self.records = []
+        self.sites = {}
+        self._files = []
+        self._nested = []
+
+    def stats(self, name):
+        stats = self.macros.get(name)
+        if stats is None:
+            stats = self.macros[name] = MacroStats(name)
+        return stats
+
+    @contextmanager
+    def record(self, kind, name):
+        rec = Record(kind, name)
+        self.records.append(rec)
+        self._files.append(name)
+        try:
+            with rec:
+                yield rec
+        finally:
+            self._files.pop()
+
+    def _timed(self, f, arg, **kwargs):
+        """Returns f(arg, **kwargs), the time it took, minus the one taken by the timed calls it made, and the total
+        time"""
+        self._nested.append(0.)
+        start = perf_counter()
+        try:
+            result = f(arg, **kwargs) if kwargs else f(arg)
+        finally:
+            elapsed = perf_counter() - start
+            nested = self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+        return result, elapsed - nested, elapsed
+
+    def matcher(self, name, matcher):
+        stats = self.stats(name)
+
+        def timed(node):
+            result, own, elapsed = self._timed(matcher, node)
+            stats.attempts += 1
+            stats.match_time += own
+            if result is not None and result is not False:
+                stats.hits += 1
+            return result
+
+        timed.spec = getattr(matcher, 'spec', None)
+        return timed
+
+    def instr(self, name, instr):
+        stats = self.stats(name)
+
+        def timed(node, **bindings):
+            result, own, elapsed = self._timed(instr, node, **bindings) if bindings else self._timed(instr, node)
+            stats.instr_time += own
+            stats.nodes += sum(1 for n in (result if isinstance(result, list) else [result])
+                               if isinstance(n, AST) for _ in walk(n))
+            site = (self._files[-1] if self._files else None, getattr(node, 'lineno', None), name)
+            self.sites[site] = self.sites.get(site, 0.) + elapsed
+            return result
+
+        return timed
+
+    def report(self, sort='cost', limit=None):
+        return report(self, sort, limit)
+
+
+_profile = None
+
+
+def active():
+    return _profile
+
+
+@contextmanager
+def profile():
+    """Usage:
+        with profile() as stats:
+            import my_module
+        print(stats.report())
+    """
+    global _profile
+    previous = _profile
+    _profile = Profile()
+    try:
+        yield _profile
+    finally:
+        _profile = previous
+
+
+def record(kind, name):
+    """Returns a context manager recording the phases of an expansion in the active profile, if any"""
+    if _profile is None:
+        return _no_record
+    return _profile.record(kind, name)
+
+
+# ########  ######## ########   #######  ########  ########
+# ##     ## ##       ##     ## ##     ## ##     ##    ##
+# ##     ## ##       ##     ## ##     ## ##     ##    ##
+# ########  ######   ########  ##     ## ########     ##
+# ##   ##   ##       ##        ##     ## ##   ##      ##
+# ##    ##  ##       ##        ##    ##  ##    ##     ##
+# ##     ## ######## ##         #######  ##     ##    ##
+
+
+_sorts = {
+    'cost': lambda s: -s.cost,
+    'name': lambda s: s.name,
+    'hits': lambda s: -s.hits,
+    'attempts': lambda s: -s.attempts,
+}
+
+
+def _ms(seconds):
+    return '%.2f' % (seconds * 1000)
+
+
+def report(profile, sort='cost', limit=None):
+    """Formats profile as tables of the macros, the hottest sites and the expansions, the most costly first (or
+    sorted by name, hits or attempts for the macros). limit is the number of lines of each table."""
+    lines = []
+    row = '%-24s %10s %8s %10s %10s %8s'
+    lines.append(row % ('macro', 'attempts', 'hits', 'match ms', 'instr ms', 'nodes'))
+    for s in sorted(profile.macros.values(), key=_sorts[sort])[:limit]:
+        lines.append(row % (s.name, s.attempts, s.hits, _ms(s.match_time), _ms(s.instr_time), s.nodes))
+
+    lines.append('')
+    row = '%-48s %8s %-24s %10s'
+    lines.append(row % ('site', 'line', 'macro', 'total ms'))
+    for (file, line, name), t in sorted(profile.sites.items(), key=lambda i: -i[1])[:limit]:
+        lines.append(row % (file, line, name, _ms(t)))
+
+    lines.append('')
+    phases = ['load', 'parse', 'expand', 'compile']
+    row = '%-48s %-20s' + ' %10s' * len(phases)
+    lines.append(row % tuple(['expansion', 'kind'] + [p + ' ms' for p in phases]))
+    for r in sorted(profile.records, key=lambda r: -r.cost)[:limit]:
+        lines.append(row % tuple([r.name, r.kind] + [_ms(r.times[p]) if p in r.times else '-' for p in phases]))
+    return '\n'.join(lines)
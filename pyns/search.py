@@ -0,0 +1,200 @@
+"""Searches trees for what matchers match, through an index built once per tree.
+
+A TreeIndex walks its tree once, filing the nodes by class, the Name nodes by id, and each node under its parent. The
+queries (compositions of m_dict and m_inst, see pyns.matching) then only try the nodes that may fit: the nodes of the
+classes they test, or, when they test the id of a Name at some path, the nodes found going up from the Names of that
+id. Usage:
+    index = TreeIndex(ast.parse(source, filename))
+    for found in index.search(m_inst(Call, func=m_inst(Name, id='eval'))):
+        print(filename, found.lineno, found.col_offset)
+        print(index.parent(found.node))
+"""
+from ast import AST, Name, expr_context, operator, unaryop, boolop, cmpop, iter_fields, parse
+from collections import namedtuple
+from weakref import WeakKeyDictionary
+
+from .matching import _discriminant, m_bind, m_captures, m_compile
+
+Match = namedtuple('Match', 'node lineno col_offset bindings')
+Match.__doc__ = """A node a query matched, where it is, and what the m_capture matchers of the query captured there"""
+
+# the contexts and operators may be shared between the nodes of a tree, they have no parent of their own
+_shared = (expr_context, operator, unaryop, boolop, cmpop)
+
+
+def _classes(matcher):
+    """The classes matcher tests its argument is an instance of, as a tuple, or None if its spec does not tell"""
+    spec = getattr(matcher, 'spec', None)
+    kind = spec[0] if spec is not None else None
+    if kind == 'inst':
+        return spec[1] if isinstance(spec[1], tuple) else (spec[1],)
+    if kind == 'and':
+        for m in spec[1]:
+            found = _classes(m)
+            if found is not None:
+                return found
+    elif kind == 'or':
+        found = [_classes(m) for m in spec[1]]
+        if found and all(f is not None for f in found):
+            return tuple(c for f in found for c in f)
+    elif kind in ('store', 'capture'):
+        return _classes(spec[2])
+    return None
+
+
+class _Query:
+    """How a matcher is looked up in the indexes: the classes of the nodes it may match, the (path, ids) of the Names
+    it tests (see _discriminant), and the function matching (or binding, if it captures) the candidates"""
+
+    def __init__(self, matcher, cls=None):
+        self.classes = (cls,) if cls is not None else _classes(matcher)
+        self.names = None
+        found = _discriminant(matcher)
+        if found is not None:
+            path, ids = found
+            if len(path) > 0 and path[-1] == 'id' and path[0] is not None and all(isinstance(i, str) for i in ids):
+                self.names = path[:-1], ids
+        known = self.classes[0] if self.classes is not None and len(self.classes) == 1 else None
+        self.binds = m_captures(matcher)
+        self.match = m_bind(matcher, known) if self.binds else m_compile(matcher, known)
+
+
+_queries = WeakKeyDictionary()
+
+
+def _query(matcher, cls):
+    """The _Query of matcher, compiled once for all the trees it is looked for in"""
+    try:
+        queries = _queries.get(matcher)
+    except TypeError:
+        # not weakly referenceable, compiled every time
+        return _Query(matcher, cls)
+    if queries is None:
+        queries = _queries[matcher] = {}
+    query = queries.get(cls)
+    if query is None:
+        query = queries[cls] = _Query(matcher, cls)
+    return query
+
+
+class TreeIndex:
+    """The nodes of tree, indexed for searching it with many matchers (see search). The index describes the tree as it
+    was built: the nodes added, moved or removed since are not accounted for.
+
+    types maps the classes to their nodes, names the ids to their Name nodes, both in the order of the source (a
+    depth-first walk), and parents the id of each node to (parent, field, index), where it is found in its parent:
+    getattr(parent, field)[index], or getattr(parent, field) if index is None. The contexts and operators (Load, Add,
+    ...) are not indexed, as they may be shared.
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.types = {}
+        self.names = {}
+        self.parents = {}
+        self.order = {}
+        stack = [(tree, None, None, None)]
+        while stack:
+            node, parent, field, index = stack.pop()
+            self.order[id(node)] = len(self.order)
+            self.parents[id(node)] = parent, field, index
+            self.types.setdefault(type(node), []).append(node)
+            if type(node) is Name:
+                self.names.setdefault(node.id, []).append(node)
+            children = []
+            for f, value in iter_fields(node):
+                if isinstance(value, list):
+                    children.extend((v, node, f, i) for i, v in enumerate(value)
+                                    if isinstance(v, AST) and not isinstance(v, _shared))
+                elif isinstance(value, AST) and not isinstance(value, _shared):
+                    children.append((value, node, f, None))
+            stack.extend(reversed(children))
+
+    @classmethod
+    def parse(cls, source, filename='<unknown>'):
+        return cls(parse(source, filename))
+
+    def _sorted(self, nodes):
+        return sorted(nodes, key=lambda n: self.order[id(n)])
+
+    def nodes(self, cls=AST):
+        """The nodes that are instances of cls (a class or a tuple of classes), in the order of the source"""
+        buckets = [nodes for t, nodes in self.types.items() if issubclass(t, cls)]
+        if len(buckets) == 1:
+            return list(buckets[0])
+        return self._sorted(n for nodes in buckets for n in nodes)
+
+    def parent(self, node):
+        """The node node is a child of, None for the root"""
+        return self.parents[id(node)][0]
+
+    def ancestors(self, node):
+        """Yields the parent of node, its parent, and so on up to the root"""
+        node = self.parents[id(node)][0]
+        while node is not None:
+            yield node
+            node = self.parents[id(node)][0]
+
+    def _climb(self, node, path):
+        """The node whose value at path (see _discriminant) is node, or None"""
+        i = len(path)
+        while i > 0:
+            parent, field, index = self.parents[id(node)]
+            if path[i - 1] is None:
+                if index is None or i < 2 or path[i - 2] != field:
+                    return None
+                i -= 2
+            else:
+                if index is not None or path[i - 1] != field:
+                    return None
+                i -= 1
+            node = parent
+        return node
+
+    def _candidates(self, query):
+        """The nodes query may match, in the order of the source"""
+        classes = query.classes
+        bucket = None
+        if classes is not None:
+            bucket = [nodes for t, nodes in self.types.items() if issubclass(t, classes)]
+        if query.names is not None:
+            path, ids = query.names
+            postings = [self.names[i] for i in ids if i in self.names]
+            if bucket is None or sum(map(len, postings)) < sum(map(len, bucket)):
+                found = {}
+                for names in postings:
+                    for name in names:
+                        node = self._climb(name, path)
+                        if node is not None and (classes is None or isinstance(node, classes)):
+                            found[id(node)] = node
+                return self._sorted(found.values())
+        if bucket is None:
+            return self._sorted(n for nodes in self.types.values() for n in nodes)
+        if len(bucket) == 1:
+            return bucket[0]
+        return self._sorted(n for nodes in bucket for n in nodes)
+
+    def search(self, matcher, cls=None):
+        """The Matches of the nodes matcher matches, in the order of the source. cls, if given, restricts the search
+        to its instances, which matcher may then assume its argument is (see m_compile)."""
+        query = _query(matcher, cls)
+        match = query.match
+        found = []
+        for node in self._candidates(query):
+            result = match(node)
+            if result is None or result is False:
+                continue
+            bindings = result if query.binds else {}
+            found.append(Match(node, getattr(node, 'lineno', None), getattr(node, 'col_offset', None), bindings))
+        return found
+
+    def find(self, matcher, cls=None):
+        """The nodes matcher matches, in the order of the source (see search)"""
+        query = _query(matcher, cls)
+        match = query.match
+        found = []
+        for node in self._candidates(query):
+            result = match(node)
+            if result is not None and result is not False:
+                found.append(node)
+        return found
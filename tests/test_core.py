@@ -0,0 +1,650 @@
+import config
+import pyns.core
+from pyns.core import import_macro, MacroLoader, PathFinder, Macro, MacroError, MacroVisitor, unparse, ast_repr, ast_dumps, ast_loads
+from pyns.matching import m_dict, m_inst, m_any, m_capture
+from pyns.profiling import profile
+import pyns.compileall
+from pyns.compileall import compile_all
+from pyns.utils import *
+from unittest import TestCase, main
+import importlib
+import importlib.util
+import tempfile
+import threading
+import glob
+import io
+import shutil
+import sys
+import os
+from ast import parse, dump, fix_missing_locations, Call, List, Name, Load, BinOp, Mult, Num, Subscript, Index, Module, Expr
+
+
+class ModuleTestCase(TestCase):
+    """Writes modules to a temporary directory, and imports them from there.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        sys.path.insert(0, self.dir)
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        shutil.rmtree(self.dir)
+
+    def write(self, name, src):
+        path = os.path.join(self.dir, name + '.py')
+        with open(path, 'w') as f:
+            f.write(src)
+        importlib.invalidate_caches()
+        return path
+
+    def load(self, name):
+        sys.modules.pop(name, None)
+        return importlib.import_module(name)
+
+
+def _no_expansion(*args, **kwargs):
+    raise AssertionError('The module should not have been expanded again')
+
+
+class CacheTest(ModuleTestCase):
+
+    src = '''
+from pyns.macros import *
+
+if with_macros(__name__, globals(), locals()):
+    x = 3
+    value = s["{x}%s"]
+'''
+
+    def test_warm_import(self):
+        path = self.write('cached_mod', self.src % '')
+        with tmp_attr(sys, dont_write_bytecode=False):
+            assert self.load('cached_mod').value == '3'
+            assert os.path.exists(pyns.core._cache_path(path))
+
+            with tmp_attr(pyns.core, MacroVisitor=_no_expansion):
+                assert self.load('cached_mod').value == '3'
+
+    def test_invalidation(self):
+        self.write('stale_mod', self.src % '')
+        with tmp_attr(sys, dont_write_bytecode=False):
+            assert self.load('stale_mod').value == '3'
+            self.write('stale_mod', self.src % '!')
+            assert self.load('stale_mod').value == '3!'
+
+    def test_evaluated_globals(self):
+        self.write('const_cfg', 'N = 3\n')
+        path = self.write('const_mod', '''
+from pyns.macros import *
+from const_cfg import N
+M = 4
+
+if with_macros(__name__, globals(), locals()):
+    value = const[M * 2]
+    imported = const[N * 2]
+''')
+        with tmp_attr(sys, dont_write_bytecode=False):
+            mod = self.load('const_mod')
+            assert (mod.value, mod.imported) == (8, 6)
+            # the value of N is not known from the sources, the expansion is redone
+            self.write('const_cfg', 'N = 10\n')
+            sys.modules.pop('const_cfg')
+            mod = self.load('const_mod')
+            assert (mod.value, mod.imported) == (8, 20)
+        assert not os.path.exists(pyns.core._cache_path(path))
+
+        # the globals the module writes out do not prevent caching it
+        self.write('const_mod', '''
+from pyns.macros import *
+M = 4
+
+if with_macros(__name__, globals(), locals()):
+    value = const[M * 2]
+''')
+        with tmp_attr(sys, dont_write_bytecode=False):
+            assert self.load('const_mod').value == 8
+            with tmp_attr(pyns.core, MacroVisitor=_no_expansion):
+                assert self.load('const_mod').value == 8
+
+    def test_base_module(self):
+        base = '''
+from ast import Num
+from pyns.core import Macro
+
+class Base(Macro):
+    def instr_Subscript(self, node):
+        return Num(%d)
+'''
+        self.write('macro_base', base % 1)
+        self.write('macro_child', '''
+from ast import Subscript, Name
+from pyns.matching import m_dict, m_inst
+from macro_base import Base
+
+class answer(Base):
+    def matchers(self, name):
+        return {Subscript: m_dict(value=m_inst(Name, id=name))}
+''')
+        self.write('based_mod', '''
+from pyns.core import with_macros
+from macro_child import answer
+
+if with_macros(__name__, globals(), locals()):
+    value = answer[0]
+''')
+        with tmp_attr(sys, dont_write_bytecode=False):
+            assert self.load('based_mod').value == 1
+            # editing the module of a base class of the macro invalidates the expansion
+            self.write('macro_base', base % 42)
+            for name in ('macro_base', 'macro_child'):
+                sys.modules.pop(name)
+            assert self.load('based_mod').value == 42
+
+    def test_disabled(self):
+        path = self.write('uncached_mod', self.src % '')
+        with tmp_attr(sys, dont_write_bytecode=False), tmp_attr(pyns.core, cache_enabled=False):
+            assert self.load('uncached_mod').value == '3'
+        assert not os.path.exists(pyns.core._cache_path(path))
+
+
+class ImportHookTest(ModuleTestCase):
+
+    src = '''
+from pyns.macros import s, q, u, with_macros
+
+if with_macros(__name__, globals(), locals()):
+    x = %d
+    value = s["{x}"]
+'''
+
+    def test_executed_once(self):
+        self.write('hooked_side', 'calls = []\n')
+        self.write('hooked_mod', '''
+import hooked_side
+from pyns.macros import s, q, u, with_macros
+
+hooked_side.calls.append('prelude')
+
+if with_macros(__name__, globals(), locals()):
+    hooked_side.calls.append('body')
+    x = 3
+    value = s["{x}"]
+''')
+        side = self.load('hooked_side')
+        with import_macro():
+            mod = self.load('hooked_mod')
+        assert isinstance(mod.__loader__, MacroLoader)
+        assert side.calls == ['prelude', 'body']
+        assert mod.value == '3'
+
+    def test_regular_modules(self):
+        path = self.write('plain_mod', 'value = 3\n')
+        with import_macro(), tmp_attr(sys, dont_write_bytecode=False):
+            mod = self.load('plain_mod')
+        assert mod.value == 3
+        assert sys.meta_path.count(PathFinder) == 0
+        assert not os.path.exists(pyns.core._cache_path(path))
+
+        # neither are the modules only mentioning with_macros
+        path = self.write('mentioning_mod', '# with_macros(__name__, globals(), locals())\n'
+                                            'def with_macros(name):\n    return "with_macros(%s)" % name\n')
+        with import_macro(), tmp_attr(sys, dont_write_bytecode=False):
+            mod = self.load('mentioning_mod')
+        assert not mod.__loader__.expanded and mod.with_macros('x') == 'with_macros(x)'
+        assert not os.path.exists(pyns.core._cache_path(path))
+        assert list(pyns.compileall.find_modules([path, pyns.core.__file__])) == []
+
+    def test_own_macros(self):
+        self.write('hooked_own', '''
+from ast import Num
+from pyns.core import macro_inline, compile_with_macros, with_macros
+
+@macro_inline
+def seven(node, **kwargs):
+    return Num(7)
+
+@compile_with_macros(globals(), locals())
+def f():
+    return seven[0]
+
+if with_macros(__name__, globals(), locals()):
+    value = seven[0] + f()
+''')
+        with import_macro():
+            assert self.load('hooked_own').value == 14
+
+    def test_plain_imports(self):
+        self.write('hooked_side', 'calls = []\n')
+        self.write('hooked_plain', 'import hooked_side\nhooked_side.calls.append(\'plain\')\nvalue = 3\n')
+        self.write('hooked_user', '''
+import hooked_side
+hooked_side.calls.append('prelude')
+
+from hooked_plain import value
+from pyns.macros import s, with_macros
+
+if with_macros(__name__, globals(), locals()):
+    text = s["{value}"]
+''')
+        side = self.load('hooked_side')
+        sys.modules.pop('hooked_plain', None)
+        with import_macro():
+            assert self.load('hooked_user').text == '3'
+        # hooked_plain does not bring macros, it is only imported when the module runs
+        assert side.calls == ['prelude', 'plain']
+
+    def test_evaluated_globals(self):
+        path = self.write('hooked_const', '''
+from pyns.macros import const, unroll, with_macros
+N = 3
+
+if with_macros(__name__, globals(), locals()):
+    value = const[N * 2]
+    squares = []
+    with unroll:
+        for i in range(N):
+            squares.append(i * i)
+''')
+        with import_macro():
+            mod = self.load('hooked_const')
+        assert (mod.value, mod.squares) == (6, [0, 1, 4])
+        assert compile_all([path], jobs=1, out=io.StringIO()) == []
+
+        # the values the source does not tell are not known before the module runs
+        path = self.write('hooked_const', 'from pyns.macros import const, with_macros\nN = len("abc")\n\n'
+                                          'if with_macros(__name__, globals(), locals()):\n    value = const[N]\n')
+        with import_macro(), self.assertRaises(MacroError) as raised:
+            self.load('hooked_const')
+        error = raised.exception
+        assert (error.filename, error.lineno, error.text.strip()) == (path, 5, 'value = const[N]')
+
+
+class CompileAllTest(ModuleTestCase):
+
+    def test_cache(self):
+        os.mkdir(os.path.join(self.dir, 'batch_pkg'))
+        self.write('batch_pkg/__init__', '')
+        self.write('batch_pkg/plain', 'value = 3\n')
+        paths = [self.write('batch_pkg/mod%d' % i, ImportHookTest.src % i) for i in range(4)]
+        broken = self.write('batch_pkg/broken', 'from pyns.macros import with_macros\nwith_macros(\n')
+
+        out = io.StringIO()
+        failures = compile_all([os.path.join(self.dir, 'batch_pkg')], jobs=2, out=out)
+        assert [path for path, error in failures] == [broken] and 'SyntaxError' in failures[0][1]
+        assert '4 modules expanded, 1 failed' in out.getvalue()
+        for path in paths:
+            assert os.path.exists(pyns.core._cache_path(path))
+
+        with import_macro(), tmp_attr(pyns.core, MacroVisitor=_no_expansion):
+            assert self.load('batch_pkg.mod2').value == '2'
+
+    def test_worker_settings(self):
+        path = self.write('batch_opt', ImportHookTest.src.replace('value =', 'assert False\n    value =') % 6)
+        # the workers write the cache whatever the environment says
+        with tmp_attr(sys, dont_write_bytecode=True):
+            assert compile_all([path], jobs=1, out=io.StringIO()) == []
+        assert os.path.exists(pyns.core._cache_path(path, 0))
+        assert not os.path.exists(pyns.core._cache_path(path, 1))
+
+        # and compile at the optimization level they are given, to the cache entry of that level
+        with tmp_attr(sys, dont_write_bytecode=True), tmp_attr(pyns.compileall, _optimize=-1):
+            pyns.compileall._init_worker(False, 1)
+            assert pyns.compileall.compile_module(path) is None
+        with open(path, 'rb') as f:
+            digest = pyns.core._digest(f.read())
+        assert 'AssertionError' in pyns.core.cache_load(path, digest, optimize=0).co_names
+        assert 'AssertionError' not in pyns.core.cache_load(path, digest, optimize=1).co_names
+
+        # the import loads the entry of its own level
+        with import_macro(), tmp_attr(pyns.core, MacroVisitor=_no_expansion):
+            with self.assertRaises(AssertionError) as raised:
+                self.load('batch_opt')
+            assert raised.exception.args == ()
+
+    def test_source(self):
+        path = self.write('batch_src', ImportHookTest.src % 5)
+        out = os.path.join(self.dir, 'out')
+        assert compile_all([path], jobs=1, source_dir=out, out=io.StringIO()) == []
+        with open(os.path.join(out, 'batch_src.py')) as f:
+            expanded = f.read()
+        assert 'with_macros' in expanded and 's[' not in expanded
+
+
+class ExpandTest(TestCase):
+
+    def test_cold_subtrees(self):
+        calls = []
+
+        class twice(Macro):
+            def matchers(self, name):
+                def match(node):
+                    calls.append(node)
+                    return isinstance(node.func, Name) and node.func.id == name
+                return {Call: match}
+
+            def instr_Call(self, node):
+                return BinOp(self.transform(node.args[0]), Mult(), Num(2))
+
+        src = 'a = f(1)\n' * 50 + 'b = twice(f(twice(2)))\n'
+        for source in (None, src):
+            del calls[:]
+            tree = MacroVisitor({'twice': twice}).expand(parse(src), source)
+            assert len(calls) == 3
+            env = {'f': lambda x: x + 1}
+            exec(compile(tree, '<test>', 'exec'), env)
+            assert env['b'] == 10
+
+    def test_emitted_sites(self):
+        class twice(Macro):
+            def matchers(self, name):
+                return {Call: lambda node: isinstance(node.func, Name) and node.func.id == name}
+
+            def instr_Call(self, node):
+                return BinOp(self.transform(node.args[0]), Mult(), Num(2))
+
+        class quad(twice):
+            def instr_Call(self, node):
+                # produces a site of twice, left for the expansion to find
+                return Call(Name('twice', Load()), [Call(Name('twice', Load()), node.args, [])], [])
+
+        env = {}
+        tree = MacroVisitor({'twice': twice, 'quad': quad}).expand(parse('b = quad(quad(1))\n'))
+        exec(compile(tree, '<test>', 'exec'), env)
+        assert env['b'] == 16
+
+    def test_captures(self):
+        class first(Macro):
+            def matchers(self, name):
+                return {Call: m_dict(func=m_inst(Name, id=name), args=m_any(m_capture('arg', m_inst(Name))))}
+
+            def instr_Call(self, node, arg):
+                return arg
+
+        tree = MacroVisitor({'first': first}).expand(parse('b = first(1, a, c) + first(2)\n'))
+        assert unparse(tree) == 'b = a + first(2)'
+
+    def test_bounded_visits(self):
+        import pyns.macros
+
+        visits = []
+
+        class CountingVisitor(MacroVisitor):
+            def visit(self, node):
+                visits.append(node)
+                return MacroVisitor.visit(self, node)
+
+        def nested(depth):
+            e = Name('y', Load())
+            for i in range(depth):
+                e = Subscript(Name('q', Load()), Index(Call(Name('g', Load()), [
+                    Subscript(Name('u', Load()), Index(e), Load())], [])), Load())
+            return fix_missing_locations(Module([Expr(e)]))
+
+        counts = []
+        for depth in (20, 40):
+            del visits[:]
+            CountingVisitor(vars(pyns.macros)).expand(nested(depth))
+            counts.append(len(visits))
+        assert counts[1] <= 2 * counts[0] + 10, counts
+
+
+class ProfileTest(ModuleTestCase):
+
+    def test_macros(self):
+        class twice(Macro):
+            def matchers(self, name):
+                return {Call: lambda node: isinstance(node.func, Name) and node.func.id == name}
+
+            def instr_Call(self, node):
+                return BinOp(self.transform(node.args[0]), Mult(), Num(2))
+
+        with profile() as stats:
+            MacroVisitor({'twice': twice}).expand(parse('b = twice(f(twice(2)))\n'))
+        s = stats.macros['twice']
+        assert (s.attempts, s.hits, s.nodes) == (3, 2, 4 + 10)
+        assert list(stats.sites) == [(None, 1, 'twice')]
+        assert 'twice' in stats.report()
+
+    def test_expansions(self):
+        self.write('profiled_mod', CacheTest.src % '')
+        with tmp_attr(pyns.core, cache_enabled=False), profile() as stats:
+            assert self.load('profiled_mod').value == '3'
+        [record] = stats.records
+        assert record.kind == 'with_macros' and set(record.times) == {'load', 'parse', 'expand', 'compile'}
+        assert stats.macros['s'].hits == 1
+        assert {name for file, line, name in stats.sites} == {'s'}
+
+
+class LazyTest(ModuleTestCase):
+
+    src = '''
+from pyns.macros import *
+calls = []
+
+
+@compile_with_macros(globals(), locals(), lazy=True)
+def greet(name, punctuation=calls.append(\'default\') or \'!\'):
+    return s["hello {name}{punctuation}"]
+
+
+@ASTModifier(lazy=True)
+def doubled(tree):
+    calls.append(tree.body[0].name)
+    ret = tree.body[0].body[-1]
+    ret.value = BinOp(ret.value, Mult(), Num(2))
+    return fix_missing_locations(tree)
+
+
+@doubled
+@doubled
+def four(x):
+    return x
+'''
+
+    def test_first_call(self):
+        self.write('lazy_mod', self.src)
+        with profile() as stats:
+            mod = self.load('lazy_mod')
+            greet, four = mod.greet, mod.four
+            assert stats.records == [] and mod.calls == ['default']
+
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(greet('you'))) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert results == ['hello you!'] * 4
+            assert mod.greet is greet and greet('me', '?') == 'hello me?'
+            # the defaults are not evaluated again
+            assert four(3) == 12 and mod.calls == ['default', 'four', 'four'] and four.ast is not None
+        assert [(r.name, r.kind) for r in stats.records] == [('lazy_mod.greet', 'lazy compile_with_macros'),
+                                                             ('lazy_mod.four', 'lazy ASTModifier')]
+        assert 'lazy compile_with_macros' in stats.report()
+
+
+    def test_locations(self):
+        path = self.write('located_mod', '''
+from pyns.macros import *
+import sys
+
+
+def where():
+    frame = sys._getframe(1)
+    return frame.f_code.co_filename, frame.f_lineno
+
+
+@compile_with_macros(globals(), locals())
+def eager():
+    return where()  # eager
+
+
+@compile_with_macros(globals(), locals(), lazy=True)
+def deferred():
+    return where()  # deferred
+
+
+@ASTModifier
+def same(tree):
+    return tree
+
+
+@same
+def modified():
+    return where()  # modified
+''')
+        mod = self.load('located_mod')
+        with open(path) as f:
+            lines = f.read().split('\n')
+        for f in (mod.eager, mod.deferred, mod.modified):
+            # the expanded code is compiled as coming from the file of its definition
+            line = next(i for i, l in enumerate(lines, 1) if l.endswith('# ' + f.__name__))
+            assert f() == (path, line), (f(), path, line)
+            with tmp_attr(pyns.core, source_index=lambda obj: None):
+                assert pyns.core.definition_ast(f)[0].body[0].body[0].lineno == line
+
+
+class SourceIndexTest(ModuleTestCase):
+
+    src = '''
+def deco(f):
+    return f
+
+
+class A:
+    @deco
+    def m(self):
+        return 1
+
+    class B:
+        pass
+
+
+def outer():
+    @deco
+    @deco
+    def inner(x):
+        return x%s
+    return inner
+'''
+
+    def test_definitions(self):
+        self.write('indexed_mod', self.src % '')
+        mod = self.load('indexed_mod')
+        index = pyns.core.source_index(mod.A.m)
+        assert pyns.core.source_index(mod.outer()) is index and pyns.core.source_index(mod.A.B) is index
+        for obj, name in [(mod.A.m, 'm'), (mod.A.B, 'B'), (mod.outer(), 'inner'), (mod.outer().__code__, 'inner')]:
+            ast, src = pyns.core.definition_ast(obj)
+            [node] = ast.body
+            assert node.name == name and node.decorator_list == [] and src == index.source
+        # copies of the definitions, which keep their decorators
+        assert pyns.core.definition_ast(mod.A.m)[0].body[0] is not pyns.core.definition_ast(mod.A.m)[0].body[0]
+        assert len(index.node(mod.A.m).decorator_list) == 1
+
+        # edited, the file is indexed again
+        self.write('indexed_mod', self.src % ' + 1')
+        mod = self.load('indexed_mod')
+        assert pyns.core.source_index(mod.A.m) is not index
+        assert unparse(pyns.core.definition_ast(mod.outer())[0]).endswith('return x + 1')
+
+    def test_bounded(self):
+        for i in range(4):
+            self.write('indexed_%d' % i, self.src % '')
+        mods = [self.load('indexed_%d' % i) for i in range(4)]
+        with tmp_attr(pyns.core, _source_indexes_max=2):
+            first = pyns.core.source_index(mods[0].A.m)
+            for mod in mods[1:] + mods[:1]:
+                pyns.core.source_index(mod.A.m)
+            # the most recently used files are kept, the others parsed again
+            assert list(pyns.core._source_indexes) == [mods[-1].__file__, mods[0].__file__]
+            assert pyns.core.source_index(mods[0].A.m) is not first
+            assert pyns.core.source_index(mods[0].A.m) is pyns.core.source_index(mods[0].A.B)
+
+
+class UnparseTest(TestCase):
+
+    snippet = '''
+@dec.a(1, *b, c=2, **d)
+class A(B, metaclass=M):
+    """doc"""
+    async def f(self, a, b: int = 1, *args, c, d=(), **kwargs) -> 'A':
+        async with a as (b, c), d:
+            await x
+        async for i in y:
+            r = [i async for i in x if i]
+        return (yield from g), (yield)
+
+def g(a, b=2, *, c):
+    global h
+    x = lambda *a, k=1, **kw: (a, k)
+    try:
+        del x[1:2, ::3], x.y
+    except (A, B) as e:
+        raise C from e
+    except:
+        pass
+    else:
+        assert x, 'msg'
+    finally:
+        x += -1 ** 2 + (-1) ** 2 - (a - b) - (a ** b) ** c // ~x
+    if not a < b <= c is not d and (e or f):
+        pass
+    elif (a if b else c) if d else lambda: e:
+        nonlocal_ = {1: 2, **d}, {1, 2}, {*()}, (1,), [*a, b], {k: v for k, v in x}, {i for i in x}, (i for i in x)
+    while 1:
+        break
+    else:
+        continue
+    s = f"{x!r:>{w}} {{}} {y['k']}\\n", f'{"q"}', b'\\x00', 1e309, 1j, (1).real, ...
+    v: int = 3
+    (w): int
+'''
+
+    def assertRoundTrip(self, src):
+        tree = parse(src)
+        assert ast_repr(parse(unparse(tree))) == ast_repr(tree), unparse(tree)
+
+    def test_snippet(self):
+        self.assertRoundTrip(self.snippet)
+
+    def test_repo(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        files = glob.glob(os.path.join(root, 'pyns', '*.py')) + glob.glob(os.path.join(root, 'tests', '*.py'))
+        assert files
+        for path in files:
+            with open(path) as f:
+                self.assertRoundTrip(f.read())
+
+
+class SerializeTest(TestCase):
+
+    def test_round_trip(self):
+        for path in [pyns.core.__file__, __file__]:
+            with open(path) as f:
+                tree = parse(f.read())
+            loaded = ast_loads(ast_dumps(tree))
+            assert dump(loaded, include_attributes=True) == dump(tree, include_attributes=True)
+            compile(loaded, path, 'exec')
+        tree = parse(UnparseTest.snippet)
+        assert ast_repr(ast_loads(ast_dumps(tree.body))) == ast_repr(tree.body)
+
+    def test_constants(self):
+        tree = parse('(1, 1.0, True, 0.0, 0.0, 1j, "1", b"1")', mode='eval')
+        tree.body.elts[4] = Num(-0.)
+        fix_missing_locations(tree)
+        values = eval(compile(ast_loads(ast_dumps(tree)), 'c', 'eval'))
+        assert [type(v) for v in values] == [int, float, bool, float, float, complex, str, bytes]
+        assert values == (1, 1., True, 0., 0., 1j, '1', b'1') and str(values[4]) == '-0.0'
+        with self.assertRaises(ValueError):
+            ast_dumps(Num(object()))
+
+    def test_long_lists(self):
+        # the lengths are written among the indices, and may need wider integers than them
+        for n in [128, 40000]:
+            tree = List([Num(1)] * n, Load())
+            assert ast_repr(ast_loads(ast_dumps(tree))) == ast_repr(tree)
+
+
+if __name__ == '__main__':
+    main()
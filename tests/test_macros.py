@@ -1,4 +1,5 @@
 import config
+import pyns.macros
 from pyns.macros import *
 from unittest import TestCase, main
 
@@ -58,6 +59,26 @@ def execute(var, items, body, **kwargs):
     return body
 
 
+_offset = 1
+
+
+_size = 4
+
+
+@compile_with_macros(globals(), locals())
+def _greeting():
+    """Formats _late, defined after it"""
+    return s['{_late}!']
+
+
+_late = 'hi'
+
+
+def _poly(x, a=2):
+    """Inlined by test_inline"""
+    return a * x * x + x + _offset
+
+
 if __name__ == '__main__' and with_macros(__name__, globals(), locals()):
 
     class BlockTest(TestCase):
@@ -105,6 +126,23 @@ if __name__ == '__main__' and with_macros(__name__, globals(), locals()):
             asrteq(s['{x}{x}'], x*2)
             asrteq(s[x], x)
 
+        def test_compiled_interpolation(self):
+            x, w, d = 'test', 8, {'k': [1.5]}
+            template = '{x!r:>{w}}|{d[k][0]:.2f}|{x.upper}{{}}'
+            asrteq(s['{x!r:>{w}}|{d[k][0]:.2f}|{x.upper}{{}}'], template.format(**locals()))
+            asrteq(s['{len}'], str(len))
+            asrtast(q[s['a{x}']], JoinedStr([Str('a'), FormattedValue(Name('x', Load()), -1, None)]))
+
+            asrteq(_greeting(), 'hi!')
+
+            for template in ['{}', '{0}', '{x!z}', '{x']:
+                try:
+                    MacroVisitor(globals()).expand(parse('def g(x):\n    return s[%r]' % template))
+                except MacroError:
+                    assert True
+                else:
+                    assert False, 'Should have failed to expand %r' % template
+
         def test_quote(self):
             x = 4
             asrtast(q[4], Num(4))
@@ -119,10 +157,18 @@ if __name__ == '__main__' and with_macros(__name__, globals(), locals()):
             asrteq(f[_0*_1](4, 2), 8)
             asrtast(f[q[x]](), q[x])
 
+            asrteq(f[_0 + _1].__code__.co_argcount, 2)
+            asrteq(f[_1 - _0](1, 3), 2)
+            asrteq(f[f[_0 * 2](_0) + 1](3), 7)
+            asrteq(sorted([3, 1, 2], key=f[-_0]), [3, 2, 1])
+
             args_f = f["{}".format(_macro_args)]
             asrteq(args_f(), '()')
             asrteq(args_f(0), '(0,)')
             asrteq(args_f(0, 2), '(0, 2)')
+            # the placeholders of a nested f are not the arguments of the outer one
+            asrteq(f[(_macro_args, f[_0 * 2](5))](), ((), 10))
+            asrteq(f[(_macro_args, f[_0 * 2](_1))](1, 3), ((1, 3), 6))
 
         def test_mix(self):
             x = "lol"
@@ -136,13 +182,158 @@ if __name__ == '__main__' and with_macros(__name__, globals(), locals()):
             asrteq(q[u[f[1]]](), 1)
 
             asrteq(f[s["{_macro_args}"]](), '()')
-
+            # the names of a literal template are looked up like the ones of the code around it
+            asrteq(f[s["{x}"]](), x)
+
+        def test_inline(self):
+            x, y = 3, 2.
+            asrteq(inline[_poly(x) + _poly(y, a=-1)], 22 - 1)
+            asrteq(inline[_poly(x + 1)], 37)
+
+            def expand(src):
+                return unparse(MacroVisitor(globals()).expand(parse(src)))
+            asrteq(expand('inline[_poly(v)]'), '2 * v * v + v + _offset')
+            # the argument is not a name, _offset means another thing
+            asrteq(expand('inline[_poly(v + 1)]'), '_poly(v + 1)')
+            asrteq(expand('def g(v, _offset):\n    return inline[_poly(v)]'), 'def g(v, _offset):\n    return _poly(v)')
+
+        def test_const(self):
+            asrteq(const[tuple(i * i for i in range(_size))], (0, 1, 4, 9))
+            asrteq(const[{'k': (b'1', {2.5}), 'e': set()}], {'k': (b'1', {2.5}), 'e': set()})
+            asrtast(q[const[-2 ** 2 + abs(-1)]], Num(-3))
+            for expr in ['const[x]', 'const[open("f")]', 'const[1 / 0]', 'const[object()]']:
+                try:
+                    MacroVisitor(globals()).expand(parse('def g(x):\n    return %s' % expr))
+                except MacroError:
+                    assert True
+                else:
+                    assert False, 'Should have failed to expand %s' % expr
+
+        def test_unroll(self):
+            out = []
+            with unroll:
+                for i in range(_size):
+                    out.append(i * 2)
+                for a, b in ((1, 'x'), (2, 'y')):
+                    out.append(b * a)
+            asrteq(out, [0, 2, 4, 6, 'x', 'yy'])
+            asrteq((i, a, b), (3, 2, 'y'))
+
+            asrteq(unparse(MacroVisitor(globals()).expand(parse('with unroll:\n    for i in (1, 2):\n        f(i)'))),
+                   'f(1)\nf(2)\ni = 2')
+            for loop in ['for i in range(n):\n    pass', 'for i in range(3):\n    break',
+                         'for i in range(3):\n    i += 1', 'for i in range(3):\n    g = lambda: i']:
+                try:
+                    MacroVisitor(globals()).expand(parse('def g(n):\n    with unroll:\n        ' +
+                                                         loop.replace('\n', '\n        ')))
+                except MacroError:
+                    assert True
+                else:
+                    assert False, 'Should have failed to unroll %s' % loop
+
+        def test_vectorize(self):
+            def run(a, b, out):
+                total = 0
+                with vectorize:
+                    for i in range(1, len(a)):
+                        out[i] = a[i] * b[i] - 1 if a[i] > b[i] else abs(b[i])
+                        total += a[i] * i
+                return total, i
+
+            out = [0] * 4
+            asrteq(run([1, 2, 3, 4], [2, 1, 1, 5], out), (20, 3))
+            asrteq(out, [0, 1, 2, 5])
+
+            # not elementwise: left as it is
+            loop = 'for i in range(n):\n    out[i] = out[i - 1]'
+            src = 'with vectorize:\n    ' + loop.replace('\n', '\n    ')
+            assert unparse(MacroVisitor(globals()).expand(parse(src))).endswith(loop)
             try:
-                asrteq(f[s["{x}"]](), x)
-            except KeyError:
-                assert True
-            else:
-                assert False, '''Shouldn't have found x in the local context of the quick lambda'''
+                import numpy
+            except ImportError:
+                return
+            a, b = numpy.arange(1, 5), numpy.array([2, 1, 1, 5])
+            for out in [numpy.zeros(4, int), b]:
+                asrteq(run(a, b, out), (20, 3))
+                asrteq(list(out), [2 if out is b else 0, 1, 2, 5])
+
+        def test_vectorize_equivalence(self):
+            try:
+                import numpy
+            except ImportError:
+                self.skipTest('NumPy is not installed')
+            guards = []
+
+            def recording(*args):
+                found = vectorizable(*args)
+                guards.append(found is not None)
+                return found
+
+            def check(run, vectorized, *args):
+                # the loop runs on lists, vectorizable only accepts arrays
+                lists = [a.tolist() if isinstance(a, numpy.ndarray) else a for a in args]
+                expected = run(*lists)
+                del guards[:]
+                with tmp_attr(pyns.macros, vectorizable=recording):
+                    found = run(*args)
+                asrteq(guards, vectorized)
+                asrteq(numpy.asarray(found, float).tolist(), numpy.asarray(expected, float).tolist())
+                asrteq([a.tolist() if isinstance(a, numpy.ndarray) else a for a in args], lists)
+
+            def reductions(a, b, c):
+                t, p, d = 0, 1, 10
+                with vectorize:
+                    for i in range(len(a)):
+                        t += a[i] * c
+                        p *= b[i]
+                        d -= a[i] - b[i] * i
+                return t, p, d, i
+
+            def conditionals(a, b, out, other, c):
+                with vectorize:
+                    for i in range(1, len(a), 2):
+                        out[i] = a[i] if a[i] > b[i] else -b[i]
+                        other[i] = max(a[i], c) + abs(a[i] - b[i]) * math.sqrt(b[i]) if not a[i] == c else 0.5
+                return i
+
+            def mixed(a, b):
+                t = 0
+                with vectorize:
+                    for i in range(len(a)):
+                        t += a[i]
+                        t *= b[i]
+                return t
+
+            def shifted(a, out, c):
+                with vectorize:
+                    for i in range(len(a)):
+                        out[i] = a[i] + c
+                return i
+
+            a, b = numpy.array([3, 1, 4, 1, 5, 9, 2, 6]), numpy.array([1, 4, 9, 16, 1, 4, 9, 16])
+            check(reductions, [True], a, b, 2)
+            check(reductions, [True], a, b, 0.5)
+            check(conditionals, [True], a, b, numpy.zeros(8), numpy.zeros(8), 4)
+            check(shifted, [True], a, numpy.zeros(8), numpy.float64(0.5))
+
+            # several updates of a variable are not separate reductions: the loop is left as it is
+            check(mixed, [], numpy.array([1, 1]), numpy.array([2, 2]))
+            asrteq(mixed(numpy.array([1, 1]), numpy.array([2, 2])), 6)
+
+            # the values the run time gives fall back to the loop: an array read as a scalar, with which the loop
+            # fails instead of broadcasting, ranges out of bounds, arrays of other dimensions, and overlapping arrays
+            check(shifted, [False], a, numpy.zeros(8), numpy.array(2))
+            with tmp_attr(pyns.macros, vectorizable=recording):
+                self.assertRaises(ValueError, shifted, a, numpy.zeros(8), numpy.arange(8))
+                self.assertRaises(IndexError, reductions, a, b[:5], 3)
+                rows, out = numpy.array([[1, 2], [3, 4]]), numpy.zeros((2, 2))
+                shifted(rows, out, 1)
+                # each element reads the one written just before
+                overlapping = numpy.ones(9)
+                shifted(overlapping[:8], overlapping[1:], 1)
+            asrteq(guards[-4:], [False] * 4)
+            asrteq(out.tolist(), [[2, 3], [4, 5]])
+            asrteq(overlapping.tolist(), list(range(1, 10)))
 
         def test_should_fail(self):
             with asrt_fail:
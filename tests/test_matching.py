@@ -0,0 +1,103 @@
+import config
+from pyns.matching import *
+from unittest import TestCase, main
+from ast import parse, Call, Name, With, withitem
+
+
+def expr(src):
+    return parse(src).body[0].value
+
+
+class CompileTest(TestCase):
+
+    def assertSame(self, matcher, *things):
+        compiled = m_compile(matcher)
+        assert compiled is not matcher, 'The matcher should have been compiled'
+        for t in things:
+            assert bool(matcher(t)) == bool(compiled(t)), '%r:\n%s' % (t, compiled.source)
+
+    def test_shortcuts(self):
+        self.assertSame(m_dict(id__re=r'^\_[0-9]+$'), expr('_0'), expr('x'), {'id': '_12'}, {'id': 'y'})
+        self.assertSame(m_dict(args__len=2, func__inst=Name), expr('f(1, 2)'), expr('f(1)'), expr('f.x(1, 2)'))
+        self.assertSame(m_dict(a__gt=2, b__ne=None, c__cont=3), {'a': 3, 'b': 1, 'c': [3]}, {'a': 1, 'b': 1, 'c': []})
+
+    def test_nested(self):
+        call = m_dict(func=m_inst(Name, id='q'), args=list, args__len=2)
+        self.assertSame(call, expr('q(1, 2)'), expr('q(1)'), expr('f(1, 2)'), expr('q.x(1, 2)'))
+
+        block = m_inst(With, items=m_any(m_inst(withitem, context_expr=m_inst(Name, id='q'))))
+        nodes = [parse(src).body[0] for src in ('with q: pass', 'with a, q as x: pass', 'with a: pass')]
+        self.assertSame(block, *nodes)
+        assert m_compile(block, With)(nodes[1])
+
+    def test_or_and_opaque(self):
+        m = m_or(m_dict(x=1), m_dict(x=lambda v: v > 10, y=m_all(m_eq(0))))
+        self.assertSame(m, {'x': 1}, {'x': 11, 'y': [0, 0]}, {'x': 11, 'y': [0, 1]}, {'x': 5})
+
+    def test_store(self):
+        lst = []
+        compiled = m_compile(m_dict(func=m_store(lst, m_inst(Name))))
+        assert compiled(expr('f(1)')) and not compiled(expr('f.x(1)'))
+        assert [n.id for n in lst] == ['f']
+
+    def test_not_compiled(self):
+        m = m_inst(Name)
+        assert m_compile(m) is m
+
+
+class BindTest(TestCase):
+
+    def test_captures(self):
+        call = m_bind(m_dict(func=m_capture('f', m_inst(Name)), args=m_any(m_capture('arg', m_inst(Name, id='x')))))
+        bindings = call(expr('g(1, x)'))
+        assert bindings['f'].id == 'g' and bindings['arg'].id == 'x'
+        assert call(expr('g(1)')) is None and call(expr('g.h(x)')) is None
+        # a new dict per match
+        assert call(expr('g(x)')) is not call(expr('g(x)'))
+
+    def test_branches(self):
+        # the captures of the branches and elements not matching are dropped
+        m = m_bind(m_or(m_dict(a=m_capture('a', m_eq(1)), b=2), m_dict(c=m_capture('c', m_eq(3)))))
+        assert m({'a': 1, 'c': 3}) == {'c': 3} and m({'a': 1, 'b': 2}) == {'a': 1} and m({}) is None
+        m = m_bind(m_any(m_dict(x=m_capture('x', m_gt(0)), y=0)))
+        assert m([{'x': 1, 'y': 1}, {'x': 2, 'y': 0}]) == {'x': 2}
+        assert m_bind(m_all(m_capture('x', m_gt(0))))([1, 2]) == {'x': 2}
+        assert m_bind(m_dict(x=1))({'x': 1}) == {} and m_bind(lambda x: x)(0) is None
+
+    def test_spec(self):
+        m = m_capture('x', m_inst(Name, id='y'))
+        assert m(expr('y')) and not m(expr('z')) and m_captures(m) and not m_captures(m_inst(Name))
+        assert not m_compile(m_dict(value=m))(expr('y')) and m_compile(m_dict(value=m))(expr('y[0]'))
+
+
+class TreeTest(TestCase):
+
+    def test_candidates(self):
+        tree = MatcherTree()
+        call = lambda name: m_dict(func=m_inst(Name, id=name))
+        block = lambda name: m_inst(With, items=m_any(m_inst(withitem, context_expr=m_inst(Name, id=name))))
+        matchers = [call('f'), call('g'), m_dict(func=m_or(m_inst(Name, id='g'), m_inst(Name, id='h'))),
+                    m_dict(args=list), block('q'), block('r')]
+        for i, m in enumerate(matchers):
+            tree.add(m, i)
+        assert set(tree.tables) == {('func', 'id'), ('items', None, 'context_expr', 'id')}
+
+        def found(node):
+            return [value for i, m, value in tree.candidates(node)]
+
+        assert found(expr('g(1)')) == [1, 2, 3] and found(expr('h()')) == [2, 3] and found(expr('x.f()')) == [3]
+        nodes = [parse(src).body[0] for src in ('with q, r: pass', 'with a: pass')]
+        assert found(nodes[0]) == [3, 4, 5] and found(nodes[1]) == [3]
+        # the candidates include every matcher matching
+        for node in [expr('g(1)'), expr('f()'), expr('f.g(1)')] + nodes:
+            assert {i for i, m in enumerate(matchers) if m(node)} <= set(found(node))
+        assert [value for i, m, value in tree.entries()] == list(range(6))
+
+    def test_unhashable(self):
+        tree = MatcherTree()
+        tree.add(m_dict(x=1), 'one')
+        assert [v for i, m, v in tree.candidates({'x': [1]})] == ['one'] and not tree.candidates({'x': 2})
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,12 @@ from pyns.utils import *
 from pyns.parsers import *
 from unittest import TestCase, main
 from contextlib import contextmanager
+import threading
 import weakref
 import gc
+import io
+import mmap
+import tempfile
 
 
 @contextmanager
@@ -42,6 +46,146 @@ class TestParsers(TestCase):
         assert parser('3') == (None, -1)
 
 
+class PackratTest(TestCase):
+
+    def test_left_recursion(self):
+        num = p_regex(r'[0-9]+')
+        term = p_defer(lambda: p_or(p_and(term, p_str('*'), num), num))
+        expr = p_defer(lambda: p_or(p_and(expr, p_str('+'), term), term))
+        assert p_packrat(expr)('1+2*3+4') == ([['1', '+', ['2', '*', '3']], '+', '4'], 7)
+
+    def test_memoized(self):
+        calls = []
+        letter = p_regex('[a-z]')
+
+        def leaf(str, offset=0):
+            calls.append(offset)
+            return letter(str, offset)
+
+        grammar = leaf
+        for i in range(6):
+            prev = p_defer((lambda g: lambda: g)(grammar))
+            grammar = p_or(p_and(prev, p_str('x')), p_and(prev, p_str('y')), prev)
+
+        assert grammar('a') == ('a', 1) and len(calls) == 3**6
+        del calls[:]
+        assert p_packrat(grammar)('a') == ('a', 1) and len(calls) == 1
+        del calls[:]
+        assert p_packrat(grammar)('ay') == (['a', 'y'], 2) and len(calls) == 1
+
+    def test_bounded(self):
+        sizes = []
+
+        def size(str, offset=0):
+            sizes.append(len(pyns.parsers._packrat.memo.table))
+            return None, 0
+
+        item = p_and(p_str('a').memo(), size).memo()
+        assert p_packrat(p_mult(item, separator=p_str(',')), max_entries=3)('a,' * 50) == ([['a', None]] * 50, 99)
+        assert max(sizes) <= 3
+
+    def test_threads(self):
+        first, second = '1+2*3+4', '4+3*2+1'
+        started, entered, done = threading.Event(), threading.Event(), threading.Event()
+
+        def sync(str, offset=0):
+            # the first parse ends while the second one runs
+            if str == first:
+                started.set()
+                entered.wait(5)
+            else:
+                entered.set()
+                done.wait(5)
+            return None, 0
+
+        num = p_regex(r'[0-9]+')
+        term = p_defer(lambda: p_or(p_and(term, p_str('*'), num), num))
+        expr = p_defer(lambda: p_or(p_and(expr, p_str('+'), term), term))
+        grammar = p_packrat(p_and(sync, expr))
+        results = {}
+
+        def parse(text):
+            try:
+                results[text] = grammar(text)
+            except BaseException as e:
+                results[text] = e
+            finally:
+                if text == first:
+                    done.set()
+
+        threads = [threading.Thread(target=parse, args=(first,)), threading.Thread(target=parse, args=(second,))]
+        threads[0].start()
+        started.wait(5)
+        threads[1].start()
+        for t in threads:
+            t.join()
+        assert results[first] == ([None, [['1', '+', ['2', '*', '3']], '+', '4']], 7), results[first]
+        assert results[second] == ([None, [['4', '+', ['3', '*', '2']], '+', '1']], 7), results[second]
+
+
+class FuseTest(TestCase):
+
+    def assertSame(self, parser, *texts):
+        fused = p_fuse(parser)
+        for text in texts:
+            assert parser(text) == fused(text), '%r: %r != %r' % (text, parser(text), fused(text))
+        return fused
+
+    def test_sequence(self):
+        parser = p_and(p_str('a'), p_regex('[0-9]+'), p_opt(p_str('b'), 'none'), p_str(';'))
+        fused = self.assertSame(parser, 'a12;', 'a12b;', 'a;', 'a1', 'xa1;', '')
+        assert fused._.spec == ('fused',)
+        self.assertSame(p_and(p_str('x'), p_regex('[a-z]*'), p_str('y'), keep=[2, 0]), 'xaby', 'xy', 'xyy')
+        self.assertSame(p_and(p_str('x'), p_regex('[a-z]*'), p_str('y'), extract=1), 'xaby', 'xy')
+
+    def test_no_backtrack(self):
+        # a parser never gives back what it matched: a* eats every a, and the sequence fails
+        self.assertSame(p_and(p_regex('a*'), p_str('a')), 'aaa', 'aab')
+        self.assertSame(p_and(p_regex('a*?'), p_str('a')), 'aaa')
+        self.assertSame(p_and(p_opt(p_str('ab')), p_str('abc')), 'abc', 'ababc')
+        self.assertSame(p_and(p_or(p_str('a'), p_str('ab')), p_str('c')), 'abc', 'ac')
+
+    def test_phrase(self):
+        parser = p_phrase(p_str('let'), p_regex('[a-z]+'), p_str('='), p_regex('[0-9]+'), keep=[1, 3])
+        self.assertSame(parser, 'let x = 1', '  let  abc=12 ', 'let x =', 'letx=1')
+        self.assertSame(p_phrase(p_str('a'), p_str('b'), wp=p_str(' ')), 'a b', 'ab', ' a b')
+
+    def test_recursive(self):
+        num = p_regex(r'[0-9]+')
+        item = p_defer(lambda: p_or(p_phrase(p_str('('), p_mult(item, separator=p_str(',')), p_str(')'), extract=1),
+                                    num, p_str('x'), p_str('y')))
+        self.assertSame(item, '(1,(2,x),y)', '((()))', '(1,', 'y')
+
+
+class StreamTest(TestCase):
+
+    record = p_phrase(p_regex('[a-z]+'), p_str('='), p_regex('[0-9]+'), p_str(';'), keep=[0, 2]).tuple()
+    text = ' '.join('k%s=%d;' % (chr(97 + i % 26), i) for i in range(200))
+
+    def test_file(self):
+        expected = [('k%s' % chr(97 + i % 26), str(i)) for i in range(200)]
+        assert list(parse_stream(self.record, io.StringIO(self.text), chunk=7, lookahead=4)) == expected
+
+        with should_fail():
+            list(parse_stream(self.record, io.StringIO(self.text + ' k=;'), chunk=7))
+        with should_fail():
+            list(parse_stream(self.record, io.StringIO('a=%s;' % ('1' * 100)), chunk=7, window=50))
+
+    def test_buffers(self):
+        record = p_phrase(p_regex(b'[a-z]+'), p_str(b'='), p_regex(b'[0-9]+'), p_str(b';'), keep=[0, 2],
+                          wp=p_regex(b' *')).tuple()
+        data = self.text.encode()
+        expected = list(parse_stream(record, io.BytesIO(data), chunk=5))
+        assert len(expected) == 200 and expected[-1] == (b'kr', b'199')
+        assert list(parse_stream(record, memoryview(data))) == expected
+
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                assert list(parse_stream(record, m)) == expected
+
+
 class MemoryTest(TestCase):
 
     def test_ref(self):
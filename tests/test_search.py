@@ -0,0 +1,70 @@
+import config
+from pyns.matching import *
+from pyns.search import TreeIndex
+from unittest import TestCase, main
+from ast import parse, walk, iter_child_nodes, Attribute, Call, FunctionDef, Name, With, expr, stmt
+
+source = '''
+import os
+
+def f(x, y):
+    with open(x) as fp:
+        data = fp.read()
+    return eval(data) + eval(y)
+
+class C:
+    def g(self):
+        print(os.path.join(self.x, 'y'))
+        return [eval(z) for z in self.x]
+'''
+
+
+def walked(tree, matcher):
+    return [n for n in walk(tree) if matcher(n)]
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        self.index = TreeIndex(parse(source))
+
+    def assertFinds(self, matcher, cls=None):
+        expected = walked(self.index.tree, matcher if cls is None else m_and(m_inst(cls), matcher))
+        found = self.index.find(matcher, cls)
+        key = lambda n: (n.lineno, n.col_offset) if hasattr(n, 'lineno') else (0, 0)
+        assert sorted(map(id, found)) == sorted(map(id, expected)), '%r != %r' % (found, expected)
+        assert [key(n) for n in found] == sorted(key(n) for n in found)
+        return found
+
+    def test_queries(self):
+        evals = self.assertFinds(m_inst(Call, func=m_inst(Name, id='eval')))
+        assert [n.lineno for n in evals] == [7, 7, 12]
+        self.assertFinds(m_inst(Name, id=m_or(m_eq('x'), m_eq('y'))))
+        self.assertFinds(m_inst(With, items=m_any(m_dict(context_expr=m_inst(Call, func=m_dict(id='open'))))))
+        self.assertFinds(m_inst(Call, func=m_inst(Attribute, attr='join')))
+        self.assertFinds(m_inst((FunctionDef, Call)))
+        self.assertFinds(m_dict(id='self'))
+        self.assertFinds(m_dict(attr='x'), Attribute)
+        assert self.assertFinds(m_inst(Name, id='missing')) == []
+        assert len(self.index.nodes(stmt)) == len(walked(self.index.tree, m_inst(stmt)))
+
+    def test_search(self):
+        call = m_inst(Call, func=m_inst(Name, id='eval'), args=m_any(m_capture('arg', m_inst(Name))))
+        found = self.index.search(call)
+        assert [(m.lineno, m.col_offset, m.bindings['arg'].id) for m in found] == [(7, 11, 'data'), (7, 24, 'y'),
+                                                                                 (12, 16, 'z')]
+        assert found[0].node.args[0] is found[0].bindings['arg']
+
+    def test_parents(self):
+        index = self.index
+        call, = index.find(m_inst(Call, func=m_inst(Attribute, attr='join')))
+        parents = list(index.ancestors(call))
+        assert isinstance(parents[0], Call) and parents[0].args[0] is call
+        assert [type(p).__name__ for p in parents[1:]] == ['Expr', 'FunctionDef', 'ClassDef', 'Module']
+        assert index.parent(index.tree) is None
+        assert all(index.parent(c) is n for n in walk(index.tree) for c in iter_child_nodes(n)
+                   if isinstance(c, (expr, stmt)))
+
+
+if __name__ == '__main__':
+    main()